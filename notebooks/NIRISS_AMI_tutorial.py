@@ -73,8 +73,9 @@ ff_t.fit_fringes(test_tar)
 ff_c.fit_fringes(test_cal)
 
 
-# You'll find some new files. Text files save the observables you are trying to
-# measure, but there are also some diagnostic fits files written: centered_X
+# You'll find some new files. fringefit_results.fits holds the observables you are
+# trying to measure (text_output=True also writes them to text files), and there
+# are also some diagnostic fits files written (diagnostics="all"): centered_X
 # are the cropped/centered data, modelsolution_XX are the best fit model to the
 # data, and residual_XX is the difference between the two. 
 
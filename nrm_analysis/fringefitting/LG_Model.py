@@ -24,6 +24,8 @@ from argparse import ArgumentParser
 from . import leastsqnrm as leastsqnrm
 from . import analyticnrm2
 from . import subpix
+from . import envelope
+from .modelcache import model_key
 
 _default_log = logging.getLogger('NRM_Model')
 #_default_log.setLevel(logging.INFO)
@@ -93,12 +95,30 @@ class NRM_Model():
             phi=None, refdir="",
             chooseholes=False,
             affine2d = None,
+            modelcache = None,
+            precision = np.float64,
+            tabulated_envelope = False,
             **kwargs):
         """
         mask will either be a string keyword for built-in values or
         an NRM_mask_geometry object.
         pixscale should be input in radians.
         phi (rad) default changedfrom "perfect" to None (with bkwd compat.)
+        modelcache: None, or a modelcache.ModelCache used by make_model()
+        to reuse fringe models built from identical inputs.
+        precision: dtype of models made by make_model().  np.float32 builds the
+        fringe phases, fringe and model cubes and their binning in single
+        precision, halving model memory and bandwidth, and fit_image() then solves
+        in single precision with float64 refinement (see leastsqnrm.matrix_operations,
+        leastsqnrm.precision_report).  Primary beams, derivatives, channel models and
+        the FFTs of fouriershift models are still computed in float64.
+        tabulated_envelope: if True make_model() interpolates primary beams from
+        this process's envelope.EnvelopeTable for the hole shape (to 1e-6 of peak)
+        instead of evaluating them analytically.
+        pixweight: (over, over) intrapixel response - relative sensitivity of each
+        oversampled sub-pixel within a detector pixel.  simulate() and make_model()
+        weight sub-pixels by it as they bin to detector pixels (subpix.binpixels).
+        Default None (uniform response).
         """ 
 
         # define a handler to write log messages to stdout
@@ -115,6 +135,9 @@ class NRM_Model():
         self.over = over
         self.maskname = mask
         self.pixweight = pixweight 
+        self.modelcache = modelcache
+        self.precision = precision
+        self.tabulated_envelope = tabulated_envelope
 
         # WARNING! JWST CHOOSEHOLES CODE NOW DUPLICATED IN mask_definitions.py WARNING! ###
         holedict = {} # as_built names, C2 open, C5 closed, but as designed coordinates
@@ -349,13 +372,14 @@ class NRM_Model():
             nspec += 1
 
         # store the detector pixel scale psf in the object
-        self.psf = utils.rebin(self.psf_over, (over, over))
+        self.psf = subpix.binpixels(self.psf_over, over, self.pixel_response(over))
 
         return self.psf
 
     ############################################################################### AS 10 2017 mark
 
-    def make_model(self, fov=None, bandpass=None, over=1, psf_offset=(0,0), pixscale=None):
+    def make_model(self, fov=None, bandpass=None, over=1, psf_offset=(0,0), pixscale=None,
+                   fouriershift=False, shiftpad=8, smeared=False, maxbytes=None):
         
         """
         make_model generates the fringe model with the attributes of the object.
@@ -363,6 +387,32 @@ class NRM_Model():
         21 cosines, 21 sines, a DC-like, and a flux slice: 44 2D slices in all.
         It can take either a single wavelength or a bandpass as a list of tuples.
         The bandpass should be of the form [(weight1, wavl1), (weight2, wavl2),...]
+        If the object has a modelcache and the model is found there, the cached
+        (read-only) model is returned, and model_beam and fringes are set to None.
+
+        fouriershift: if True build the oversampled model once at zero psf offset
+        on a field padded by shiftpad detector pixels each side, then move it to
+        psf_offset with a Fourier shift before trimming and binning.  The zero
+        offset model is kept in the modelcache when there is one, so later
+        offsets cost only FFTs.  For shiftpad >= 8 and |psf_offset| < 1 it agrees
+        with the analytic model to 2e-4 of its peak at over=3, 1e-5 at over>=5
+        (the error is set by the oversampling, not shiftpad).  model_beam and 
+        fringes are set to None.  The zero offset model is oversampled and padded: 
+        ((fov+2*shiftpad)*over)**2 * (N*(N-1)+2) float64s, about 400 MB for 
+        fov=81, over=11 and 7 holes, with FFT temporaries of the same size.
+        It is held in the modelcache's memory tier of every process using it
+        (each pool worker), evicting other models, so keep over small or give
+        the cache a large enough memsize.
+
+        smeared: if True build a polychromatic model in one pass, with fringes at
+        the bandpass's mean wavenumber times an analytic bandwidth-smearing 
+        envelope (analyticnrm2.model_array_smeared).  Approximate - for quick-look 
+        and simulations.  The default sums monochromatic models exactly.
+
+        maxbytes: if set, build each wavelength's model in blocks of detector rows
+        binned straight into self.model (analyticnrm2.binned_model), keeping 
+        working memory near maxbytes instead of the full oversampled cube.
+        model_beam and fringes are set to None.
         """
         if fov:
             self.fov = fov
@@ -386,14 +436,73 @@ class NRM_Model():
             self.logger.debug("------Simulating Polychromatic------")
             simbandpass = bandpass
 
+        options = {}
+        if np.dtype(self.precision) != np.float64:
+            options["precision"] = np.dtype(self.precision).name
+        if fouriershift:
+            options["fouriershift"] = shiftpad
+        if smeared:
+            options["smeared"] = True
+        envtable = None
+        if self.tabulated_envelope:
+            envtable = envelope.get_table(self.holeshape)
+            options["envtable"] = envtable.tol
+        pixweight = self.pixel_response(self.over)
+        if pixweight is not None:
+            options["pixweight"] = tuple(pixweight.ravel())
+        cachekey = None
+        if self.modelcache is not None:
+            cachekey = model_key(self.modelctrs, self.d, self.holeshape,
+                                 self.modelpix, self.affine2d, simbandpass,
+                                 self.fov, self.over, psf_offset, **options)
+            cached = self.modelcache.get(cachekey)
+            if cached is not None:
+                self.model = cached
+                self.model_beam = None
+                self.fringes = None
+                return self.model
+
+        if smeared:
+            pb, ff = analyticnrm2.model_array_smeared(self.modelctrs, simbandpass, self.over,
+                              self.modelpix, self.fov, self.d,
+                              shape=self.holeshape, psf_offset=psf_offset,
+                              affine2d=self.affine2d,
+                              envtable=envtable, dtype=self.precision)
+            self.model_beam = pb
+            self.fringes = ff
+            self.model_over = analyticnrm2.multiplyenv(pb, ff)
+            self.model = np.asarray(simbandpass, dtype=float)[:,0].sum() * \
+                subpix.binpixels(self.model_over, self.over, pixweight)
+            return self.store_model(cachekey)
+
+        if fouriershift:
+            self.model = self.fourier_shifted_model(simbandpass, psf_offset, shiftpad, envtable,
+                                                    pixweight)
+            self.model_beam = None
+            self.fringes = None
+            return self.store_model(cachekey)
+
+        if maxbytes is not None:
+            self.model = np.zeros((self.fov, self.fov, self.N*(self.N-1)+2), dtype=self.precision)
+            self.model_beam = None
+            self.fringes = None
+            for w,l in simbandpass: # w: weight, l: lambda (wavelength)
+                analyticnrm2.binned_model(self.modelctrs, l, self.over, self.modelpix,
+                              self.fov, self.d, shape=self.holeshape,
+                              psf_offset=psf_offset, affine2d=self.affine2d,
+                              weight=w, out=self.model, maxbytes=maxbytes,
+                              envtable=envtable, pixweight=pixweight)
+            return self.store_model(cachekey)
+
         # The model shape is (fov) x (fov) x (# solution coefficients)
         # the coefficient refers to the terms in the analytic equation
         # There are N(N-1) independent pistons, double-counted by cosine
         # and sine, one constant term and a DC offset.
         #elf.model = np.ones((self.fov, self.fov, self.N*(self.N-1)+2)) # corrected below AZG AS LG++
-        self.model = np.zeros((self.fov, self.fov, self.N*(self.N-1)+2))
+        self.model = np.zeros((self.fov, self.fov, self.N*(self.N-1)+2), dtype=self.precision)
         self.model_beam = np.zeros((self.over*self.fov, self.over*self.fov))
-        self.fringes = np.zeros((self.N*(self.N-1)+1, self.over*self.fov, self.over*self.fov))
+        self.fringes = np.zeros((self.N*(self.N-1)+1, self.over*self.fov, self.over*self.fov),
+                                dtype=self.precision)
         for w,l in simbandpass: # w: weight, l: lambda (wavelength)
             vprint("weight: {0}, lambda: {1}".format(w,l))
             # model_array returns the envelope and fringe model (a list of oversampled fov x fov slices)
@@ -404,7 +513,9 @@ class NRM_Model():
                               shape=self.holeshape,
                               psf_offset=psf_offset,
                               affine2d=self.affine2d, 
-                              verbose=False)
+                              verbose=False,
+                              envtable=envtable,
+                              dtype=self.precision)
             self.logger.debug("Passed to model_array: psf_offset: {0}".format(psf_offset))
             self.logger.debug("Primary beam in the model created: {0}".format(pb))
             self.model_beam += pb
@@ -414,19 +525,109 @@ class NRM_Model():
             self.model_over = analyticnrm2.multiplyenv(pb, ff)
             #print("LG_Model.make_model: NRM MODEL model shape:", self.model_over.shape)
 
-            model_binned = np.zeros((self.fov,self.fov, self.model_over.shape[2]))
-            # loop over slices "sl" in the model
-            for sl in range(self.model_over.shape[2]):
-                model_binned[:,:,sl] =  utils.rebin(self.model_over[:,:,sl],  (self.over, self.over))
-
-            self.model += w*model_binned
+            # bin all slices at once, weighting sub-pixels by the intrapixel response
+            self.model += w*subpix.binpixels(self.model_over, self.over, pixweight)
     
         #print("LG_Model.make_model: self.model", type(self.model), type(self.model[0,0,0]))
+        return self.store_model(cachekey)
+
+    def make_derivatives(self, fov, bandpass, over=1, psf_offset=(0,0), pixscale=None):
+        """
+        Derivatives of make_model's model with respect to psf_offset[0] and 
+        psf_offset[1] (detector pixels), shape (2, fov, fov, nslices), for fitting
+        small centering corrections with the fringe coefficients 
+        (fit_image(derivatives=...)).  Stored as self.derivatives.
+        """
+        if pixscale is None:
+            pixscale = self.pixel
+        if hasattr(bandpass, '__iter__') == False:
+            bandpass = [(1.0, bandpass)]
+        envtable = envelope.get_table(self.holeshape) if self.tabulated_envelope else None
+        self.derivatives = np.zeros((2, fov, fov, self.N*(self.N-1)+2))
+        for w,l in bandpass:
+            analyticnrm2.offset_derivatives(self.ctrs, l, over, pixscale, fov, self.d,
+                          psf_offset=psf_offset, shape=self.holeshape, affine2d=self.affine2d,
+                          weight=w, out=self.derivatives, envtable=envtable,
+                          pixweight=self.pixel_response(over))
+        return self.derivatives
+
+    def make_channel_models(self, fov, bandpasses, over=1, psf_offset=(0,0), pixscale=None):
+        """
+        Models of all the channels of a spectral cube at once, one bandpass (or
+        wavelength) per channel, sharing psf_offset and the mask geometry 
+        (analyticnrm2.channel_models).  Shape (nchan, fov, fov, nslices), 
+        stored as self.channel_models; each channel's model equals make_model's.
+        """
+        if pixscale is None:
+            pixscale = self.pixel
+        self.fov = fov
+        self.over = over
+        self.modelpix = pixscale
+        envtable = envelope.get_table(self.holeshape) if self.tabulated_envelope else None
+        self.channel_models = analyticnrm2.channel_models(self.ctrs, bandpasses, over,
+                          pixscale, fov, self.d, psf_offset=psf_offset, shape=self.holeshape,
+                          affine2d=self.affine2d, envtable=envtable,
+                          pixweight=self.pixel_response(over))
+        self.channel_models = self.channel_models.astype(self.precision, copy=False)
+        return self.channel_models
+
+    def pixel_response(self, over):
+        """ self.pixweight as an (over, over) float array, or None """
+        if self.pixweight is None:
+            return None
+        pixweight = np.asarray(self.pixweight, dtype=float)
+        if pixweight.shape != (over, over):
+            raise ValueError("pixweight shape {0} does not match oversampling {1}".format(
+                             pixweight.shape, over))
+        return pixweight
+
+    def store_model(self, cachekey):
+        """ make_model() finish: cast self.model to self.precision, add it to the modelcache """
+        self.model = self.model.astype(self.precision, copy=False)
+        if self.modelcache is not None:
+            self.model = self.modelcache.put(cachekey, self.model)
         return self.model
 
+    def fourier_shifted_model(self, simbandpass, psf_offset, shiftpad, envtable=None,
+                              pixweight=None):
+        """
+        make_model(fouriershift=True) worker: bandpass-weighted oversampled model
+        at zero offset on a padded field (cached), shifted to psf_offset, trimmed 
+        to fov and binned to detector pixels.
+        """
+        padfov = self.fov + 2*shiftpad
+        model_over = None
+        if self.modelcache is not None:
+            zerokey = model_key(self.modelctrs, self.d, self.holeshape,
+                                self.modelpix, self.affine2d, simbandpass,
+                                padfov, self.over, (0,0), oversampled=True,
+                                envtable=None if envtable is None else envtable.tol,
+                                precision=np.dtype(self.precision).name)
+            model_over = self.modelcache.get(zerokey)
+        if model_over is None:
+            model_over = np.zeros((padfov*self.over, padfov*self.over, self.N*(self.N-1)+2),
+                                  dtype=self.precision)
+            for w,l in simbandpass: # w: weight, l: lambda (wavelength)
+                pb, ff = analyticnrm2.model_array(self.modelctrs, l, self.over,
+                                  self.modelpix, padfov, self.d,
+                                  shape=self.holeshape, psf_offset=(0,0),
+                                  affine2d=self.affine2d, verbose=False,
+                                  envtable=envtable, dtype=self.precision)
+                model_over += w*analyticnrm2.multiplyenv(pb, ff)
+            if self.modelcache is not None:
+                model_over = self.modelcache.put(zerokey, model_over)
+
+        # image_center() puts psf_offset[1] along the first array axis
+        shifted = analyticnrm2.fourier_shift(model_over,
+                                (psf_offset[1]*self.over, psf_offset[0]*self.over))
+        trim = shiftpad*self.over
+        shifted = shifted[trim:trim+self.fov*self.over, trim:trim+self.fov*self.over]
+        return subpix.binpixels(shifted, self.over, pixweight)
+
 
     def fit_image(self, image, reference=None, pixguess=None, rotguess=0, psf_offset=(0,0),
-                  modelin=None, savepsfs=False):
+                  modelin=None, savepsfs=False, covariance=False, weights=None,
+                  clip=None, clipiter=5, derivatives=None, offsetiter=1):
 
         vprint("\n    **** LG_Model.NRM_Model.fit_image: psf_offset {}".format(psf_offset))
         if hasattr(modelin, 'shape'):
@@ -446,9 +647,26 @@ class NRM_Model():
         (a cropped deNaNed version of the data) to run correlations. It is 
         recommended that the symmetric part of the data be used to avoid piston
         confusion in scaling. Good luck!
+
+        weights: per-pixel 1/sigma image (eg noise.weights(variance)) for a 
+        weighted fit (leastsqnrm.weighted_operations).  Default unweighted.
+
+        clip: reject pixels with residuals above clip sigma, up to clipiter times
+        (leastsqnrm.clipped_operations); self.rejected is the mask of rejected
+        pixels.  Default None (no clipping)
+
+        derivatives: make_derivatives() output for modelin.  Fits a psf_offset
+        correction with the coefficients, linearly (offsetiter Gauss-Newton steps,
+        leastsqnrm.offset_operations): self.offset_correction, and self.psf_offset_fit
+        = psf_offset + correction.  Default None (psf_offset fixed)
+
+        covariance=True also makes a weighted fit (self.linfit_result), with 
+        photon-noise weights unless weights are given, and propagates its 
+        coefficient covariance to self.fringephase_cov, fringeamp_cov, cp_cov 
+        and ca_cov.
         """
         self.model_in=modelin
-        self.weighted="unused"
+        self.weighted = weights is not None
         self.saveval = savepsfs
 
         if modelin is None:
@@ -489,13 +707,64 @@ class NRM_Model():
             vprint("    **** LG_Model.NRM_Model.fit_image: fittingmodel=modelin")
             self.fittingmodel = modelin
             
-        self.soln, self.residual, self.cond,self.linfit_result = \
-                leastsqnrm.matrix_operations(image, self.fittingmodel, \
-                verbose=False)
+        self.rejected = None
+        if clip is not None:
+            self.soln, self.residual, self.cond, self.rejected = \
+                    leastsqnrm.clipped_operations(image, self.fittingmodel, weights=weights,
+                    nsigma=clip, maxiter=clipiter)
+            print("NRM_Model: {0} pixels rejected".format(self.rejected.sum()))
+            image = np.where(self.rejected, np.nan, image)
+        elif derivatives is not None:
+            pass # offset_operations makes the starting solve
+        elif weights is None:
+            self.soln, self.residual, self.cond = \
+                    leastsqnrm.matrix_operations(image, self.fittingmodel, \
+                    verbose=False)[:3]
+        else:
+            self.soln, self.residual, self.cond = \
+                    leastsqnrm.weighted_operations(image, self.fittingmodel, weights)
+        design = self.fittingmodel
+        if derivatives is not None:
+            x, self.residual, self.cond, design = leastsqnrm.offset_operations(image, 
+                    self.fittingmodel, derivatives, weights=weights, niter=offsetiter,
+                    x0=self.soln if clip is not None else None)
+            self.soln, self.offset_correction = x[:-2], x[-2:]
+            self.psf_offset_fit = np.array(psf_offset) + self.offset_correction
+            # the model at the fitted offset, for plot_model (modelsolution images)
+            self.fittingmodel = self.fittingmodel + \
+                    self.offset_correction[0] * derivatives[0] + \
+                    self.offset_correction[1] * derivatives[1]
+            print("NRM_Model: psf_offset correction {0}".format(self.offset_correction))
 
         print("NRM_Model Raw Soln:")
         print(self.soln)
 
+        self.linfit_result = None
+        if covariance:
+            self.linfit_result = leastsqnrm.weighted_fit(image, design, weights)
+            cov = self.linfit_result.p_normalised_covariance_matrix
+            if derivatives is not None:
+                self.offset_cov = cov[-2:, -2:]
+                cov = cov[:-2, :-2]
+            self.fringephase_cov, self.fringeamp_cov, self.cp_cov, self.ca_cov = \
+                leastsqnrm.observable_covariances(self.soln, cov, N=self.N)
+        self.derive_observables()
+
+    def use_solution(self, soln, residual, cond, modelin, weighted=False):
+        """
+        Take fit_image's results from a fit made elsewhere (eg all the channels 
+        of a spectral cube solved together, leastsqnrm.channel_operations): raw
+        coefficients soln, residual and cond of the fit with model modelin.
+        """
+        self.model_in = self.fittingmodel = modelin
+        self.weighted = weighted
+        self.soln, self.residual, self.cond = soln, residual, cond
+        self.rejected = None
+        self.linfit_result = None
+        self.derive_observables()
+
+    def derive_observables(self):
+        """ flux, normalised coefficients, fringe amplitudes and phases, pistons, CPs and CAs from raw self.soln """
         self.rawDC = self.soln[-1]
         self.flux = self.soln[0]
         self.soln = self.soln/self.soln[0]
@@ -29,6 +29,7 @@ vprint("CWD: "+os.getcwd())
 # in a module...
 from  .. import misctools  # why can't I import misctools.utils this way too????
 from . import hextransformEE # change to rel imports!
+from . import subpix
 
 def image_center(fov, oversample, psf_offset):
     """ Image center location in oversampled pixels
@@ -182,7 +183,7 @@ def ASF(detpixel, fov, oversample, ctrs, d, lam, phi, psf_offset, affine2d, verb
             np.array((psf_offset[1],psf_offset[0]))*oversample # note flip 1 and 0
     ImCtr =  image_center(fov, oversample, psf_offset)
     vprint("ASF ImCtr {0}".format(ImCtr))
-    return np.fromfunction(Jinc, (oversample*fov,oversample*fov),
+    return misctools.utils.fromfunction_threaded(Jinc, (oversample*fov,oversample*fov),
                            c=ImCtr, 
                            D=d, 
                            lam=lam, 
@@ -198,7 +199,7 @@ def ASFfringe(detpixel, fov, oversample, ctrs, lam, phi, psf_offset, affine2d,
             np.array(psf_offset)*oversample 
     ImCtr =  image_center(fov, oversample, psf_offset)
     vprint("ASFfringe ImCtr {0}".format(ImCtr))
-    return np.fromfunction(interf, (oversample*fov,oversample*fov), 
+    return misctools.utils.fromfunction_threaded(interf, (oversample*fov,oversample*fov), 
                            c=ImCtr,
                            ctrs=ctrs, 
                            phi=phi,
@@ -334,15 +335,46 @@ def harmonicfringes(**kwargs):
         vprint(" over  {}".format( oversample), end="" )
         vprint(" fov/detpix  {}".format( fov), end="" )
 
-    return (np.fromfunction(ffc, (fov*oversample, fov*oversample), c=ImCtr,
+    return (misctools.utils.fromfunction_threaded(ffc, (fov*oversample, fov*oversample), c=ImCtr,
                                                                    baseline=baseline,
                                                                    lam=lam, pitch=cpitch,
                                                                    affine2d=affine2d),
-            np.fromfunction(ffs, (fov*oversample, fov*oversample), c=ImCtr,
+            misctools.utils.fromfunction_threaded(ffs, (fov*oversample, fov*oversample), c=ImCtr,
                                                                    baseline=baseline,
                                                                    lam=lam, pitch=cpitch,
                                                                    affine2d=affine2d))
 
+def baselines(ctrs):
+    """ returns (nbl, 2) array of hole-pair baseline vectors ctrs[i] - ctrs[j], i < j,
+        in the order the fringe model slices are stored (i-major, as in model_array).
+        nbl = nholes(nholes-1)/2
+    """
+    nholes = ctrs.shape[0]
+    ii, jj = np.triu_indices(nholes, k=1)
+    return ctrs[ii] - ctrs[jj]
+
+
+def fringe_stack(kx, ky, c, baselines, lam, pitch, affine2d):
+    """ LG++ batched ffc/ffs: cosine and sine fringes of every baseline at once.
+        kx, ky: oversampled pixel coordinates (any identical shapes), eg np.indices output
+        c: the PSF ctr in oversampled pixels, baselines: (nbl, 2) m, lam: m
+        pitch: pitch for calcn = detpixscale/oversample
+        The affine-distorted coordinates are computed once for all baselines, and
+        the phases of all baselines come from one broadcast outer product of the
+        (nbl, 2) baseline matrix with the (2, npix) distorted coordinates.
+        returns phase array (nbl,) + kx.shape in kx's precision, caller takes 2cos, 
+        2sin (cf ffc, ffs)
+    """
+    kxprime, kyprime = affine2d.distortFargs(kx-c[0], ky-c[1])
+    kxprime = np.asarray(kxprime, dtype=kx.dtype)
+    kyprime = np.asarray(kyprime, dtype=kx.dtype)
+    baselines = np.asarray(baselines, dtype=kx.dtype)
+    phase = np.multiply.outer(baselines[:,0], kxprime)
+    phase += np.multiply.outer(baselines[:,1], kyprime)
+    phase *= 2*np.pi*pitch/lam
+    return phase
+
+
 def ffc(kx, ky, **kwargs):
     ko = kwargs['c'] # the PSF ctr
     baseline = kwargs['baseline'] # hole centers' vector
@@ -365,15 +397,15 @@ def ffs(kx, ky, **kwargs):
 
 
 def model_array(ctrs, lam, oversample, pitch, fov, d, psf_offset=(0,0),
-                shape ='circ', affine2d=None, verbose=False):
+                shape ='circ', affine2d=None, verbose=False, envtable=None, dtype=float):
     # pitch is detpixel
     # psf_offset in detpix
-    # returns real 2d array of primary beam, list of fringe arays
+    # returns real 2d array of primary beam, array of fringe slices (2*nbl+1, fov*over, fov*over)
+    # dtype: precision of the fringe phases and slices (the primary beam is float64)
 
     #misctools.utils.printout(ctrs, "                                   analyticnrm2:model_array"+affine2d.name)
 
     nholes = ctrs.shape[0]
-    phi = np.zeros((nholes,)) # no phase errors in the model slices...
     modelshape = (fov*oversample, fov*oversample)  # spatial extent of image model - the oversampled array
     
     if verbose:
@@ -385,6 +417,40 @@ def model_array(ctrs, lam, oversample, pitch, fov, d, psf_offset=(0,0),
             " d: {0}, wavelength: {1}, shape: {2}".format(d, lam, shape) +\
             "\ncentering:{0}\n {1}".format(centering, off))
 
+    primary_beam = primarybeam(ctrs, lam, oversample, pitch, fov, d, psf_offset=psf_offset,
+                               shape=shape, affine2d=affine2d, envtable=envtable)
+
+    # LG++ all baselines' fringes in one pass over the oversampled grid:
+    # slice 0 is the constant term, then cos, sin for each baseline in turn.
+    ImCtr =  image_center(fov, oversample, psf_offset)
+    kx, ky = np.indices(modelshape, dtype=dtype)
+    phase = fringe_stack(kx, ky, ImCtr, baselines(ctrs), lam, pitch/oversample, affine2d)
+    del kx, ky
+    ffmodel = np.empty((2*phase.shape[0] + 1,) + modelshape, dtype=dtype)
+    ffmodel[0] = nholes
+    np.cos(phase, out=ffmodel[1::2])
+    np.sin(phase, out=ffmodel[2::2])
+    ffmodel[1:] *= 2
+
+    return primary_beam, ffmodel
+
+
+def primarybeam(ctrs, lam, oversample, pitch, fov, d, psf_offset=(0,0),
+                shape='circ', affine2d=None, envtable=None):
+    # pitch is detpixel
+    # returns real 2d array of the primary beam (intensity) of one hole
+    # envtable: an envelope.EnvelopeTable for this hole shape to interpolate instead
+    if envtable is not None:
+        if envtable.shape != shape:
+            raise ValueError("envelope table is for {0} holes, not {1}".format(envtable.shape, shape))
+        ImCtr =  image_center(fov, oversample, psf_offset)
+        kx, ky = np.indices((fov*oversample, fov*oversample), dtype=float)
+        pb = envtable.primarybeam(kx, ky, ImCtr, d, lam, pitch/oversample, affine2d)
+        if shape == 'hex': # as hextransform(), which sets this pixel to the central value
+            pb[int(ImCtr[0]), int(ImCtr[1])] = 0.75
+        return pb
+    nholes = ctrs.shape[0]
+    phi = np.zeros((nholes,)) # no phase errors in the model slices...
     # calculate primary beam envelope (non-negative real)
     # ASF(detpixel, fov, oversample, ctrs, d, lam, phi, psf_offset) * asf_fringe
     if shape=='circ':
@@ -399,39 +465,214 @@ def model_array(ctrs, lam, oversample, pitch, fov, d, psf_offset=(0,0),
     # test that this array is almost completely real...
     #print("***>>> asf_pb.reals: {}  asf_pb.imags:{} ".format( np.abs(asf_pb.real).sum(), np.abs(asf_pb.imag).sum()))
     # ... yes it is overwhelmingly real, like 1e-8ish in imaginary cf real.
-    primary_beam = (asf_pb*asf_pb.conj()).real
-    
+    return (asf_pb*asf_pb.conj()).real
+
 
-    alist = []
-    for i in range(nholes - 1):
-        for j in range(nholes - 1):
-            if j + i + 1 < nholes:
-                alist = np.append(alist, i)
-                alist = np.append(alist, j + i + 1)
-    alist = alist.reshape((len(alist)//2, 2))
-
-    ffmodel = []
-    ffmodel.append(nholes * np.ones(modelshape))
-    for basepair in alist:
-        #print("i", int(basepair[0]), end="")
-        #print("  j", int(basepair[1]), end="")
-        baseline = ctrs[int(basepair[0])] - ctrs[int(basepair[1])]
-        #print(baseline)
-        cosfringe, sinfringe = harmonicfringes(fov=fov, pitch=pitch, psf_offset=psf_offset,
-                                               baseline=baseline,
-                                               oversample=oversample,
-                                               lam=lam,
-                                               affine2d=affine2d)
-        ffmodel.append( cosfringe )
-        ffmodel.append( sinfringe )
+def model_array_smeared(ctrs, bandpass, oversample, pitch, fov, d, psf_offset=(0,0),
+                        shape='circ', affine2d=None, envtable=None, dtype=float):
+    """
+    Fast polychromatic alternative to summing model_array() over a bandpass.
+    bandpass: (weight, wavelength) pairs.  With the normalized bandpass's mean 
+    wavenumber sig0 = <1/lam> and spread sigsd, each baseline's fringe is 
+    evaluated at 1/sig0 and multiplied by the smearing envelope 
+        exp(-2 pi^2 s^2 sigsd^2) = exp(-(phase * sigsd/sig0)^2 / 2)
+    (s = OPD, the bandpass taken as gaussian in wavenumber), and the primary beam
+    is the two-point gaussian quadrature mean of primary beams at sig0 +/- sigsd.
+    Returns the same (primary beam, fringe slices) as model_array(), for unit 
+    total weight, the fringe slices in dtype.
+    """
+    bandpass = np.asarray(bandpass, dtype=float)
+    wght = bandpass[:,0] / bandpass[:,0].sum()
+    sigma = 1.0 / bandpass[:,1]
+    sig0 = (wght*sigma).sum()
+    sigsd = np.sqrt((wght*(sigma - sig0)**2).sum())
+
+    primary_beam = 0.5 * (primarybeam(ctrs, 1.0/(sig0 - sigsd), oversample, pitch, fov, d,
+                                      psf_offset=psf_offset, shape=shape, affine2d=affine2d,
+                                      envtable=envtable) +
+                          primarybeam(ctrs, 1.0/(sig0 + sigsd), oversample, pitch, fov, d,
+                                      psf_offset=psf_offset, shape=shape, affine2d=affine2d,
+                                      envtable=envtable))
+
+    modelshape = (fov*oversample, fov*oversample)
+    ImCtr =  image_center(fov, oversample, psf_offset)
+    kx, ky = np.indices(modelshape, dtype=dtype)
+    phase = fringe_stack(kx, ky, ImCtr, baselines(ctrs), 1.0/sig0, pitch/oversample, affine2d)
+    del kx, ky
+    smear = np.exp(-0.5 * (phase * sigsd/sig0)**2)
+    ffmodel = np.empty((2*phase.shape[0] + 1,) + modelshape, dtype=dtype)
+    ffmodel[0] = ctrs.shape[0]
+    np.cos(phase, out=ffmodel[1::2])
+    np.sin(phase, out=ffmodel[2::2])
+    ffmodel[1::2] *= 2*smear
+    ffmodel[2::2] *= 2*smear
 
     return primary_beam, ffmodel
 
 
+def binned_model(ctrs, lam, oversample, pitch, fov, d, psf_offset=(0,0),
+                 shape='circ', affine2d=None, weight=1.0, out=None, maxbytes=6.4e7,
+                 envtable=None, pixweight=None):
+    """
+    Detector-scale model, as rebinning multiplyenv(*model_array(...)) by oversample,
+    without building the oversampled fringe cube.  Fringes are made for blocks of
+    detector rows, multiplied by the primary beam and binned straight into the 
+    (fov, fov, 2*nbl+2) result, so working memory beyond the oversampled primary 
+    beam stays under about maxbytes.
+    weight: multiplies the model, which is added to out if given (eg to 
+    accumulate a bandpass).  Fringes are built in out's precision.
+    pixweight: (oversample, oversample) intrapixel response applied while binning
+    (subpix.binpixels).  Returns out.
+    """
+    nholes = ctrs.shape[0]
+    bls = baselines(ctrs)
+    nbl = bls.shape[0]
+    if out is None:
+        out = np.zeros((fov, fov, 2*nbl + 2))
+    pb = primarybeam(ctrs, lam, oversample, pitch, fov, d, psf_offset=psf_offset,
+                     shape=shape, affine2d=affine2d, envtable=envtable).astype(out.dtype)
+    ImCtr =  image_center(fov, oversample, psf_offset)
+
+    # phase block and one cos or sin scratch block per detector row
+    rowbytes = 2 * nbl * oversample * fov * oversample * out.itemsize
+    nrow = int(max(1, min(fov, maxbytes // rowbytes)))
+    ky = np.arange(fov*oversample, dtype=out.dtype)
+    for r0 in range(0, fov, nrow):
+        r1 = min(fov, r0 + nrow)
+        kx = np.arange(r0*oversample, r1*oversample, dtype=out.dtype)
+        kx, kyblock = np.meshgrid(kx, ky, indexing='ij')
+        phase = fringe_stack(kx, kyblock, ImCtr, bls, lam, pitch/oversample, affine2d)
+        env = pb[r0*oversample:r1*oversample]
+        out[r0:r1, :, 0] += weight * nholes * subpix.binpixels(env, oversample, pixweight)
+        fringe = np.cos(phase)
+        fringe *= 2 * weight * env
+        out[r0:r1, :, 1:-1:2] += binstack(fringe, oversample, pixweight)
+        np.sin(phase, out=fringe)
+        fringe *= 2 * weight * env
+        out[r0:r1, :, 2:-1:2] += binstack(fringe, oversample, pixweight)
+        # binned unit slice
+        out[r0:r1, :, -1] += weight * (oversample * oversample if pixweight is None 
+                                       else np.sum(pixweight))
+    return out
+
+
+def channel_models(ctrs, bandpasses, oversample, pitch, fov, d, psf_offset=(0,0),
+                   shape='circ', affine2d=None, envtable=None, pixweight=None):
+    """
+    Detector-scale models of every channel of a spectral cube (eg GPI PRISM),
+    as binning multiplyenv(*model_array(...)) for each channel's wavelength, 
+    for one psf_offset and geometry.  The affine-distorted baseline projections
+    (fringe phase * lam) are computed once for all channels, and each channel's
+    phases are a rescaling of them.
+    bandpasses: one wavelength or one [(weight, wavelength), ...] per channel
+    pixweight: intrapixel response, as binned_model.
+    returns (nchan, fov, fov, 2*nbl+2)
+    """
+    nholes = ctrs.shape[0]
+    bls = baselines(ctrs)
+    nbl = bls.shape[0]
+    out = np.zeros((len(bandpasses), fov, fov, 2*nbl + 2))
+    ImCtr =  image_center(fov, oversample, psf_offset)
+    kx, ky = np.indices((fov*oversample, fov*oversample), dtype=float)
+    projection = fringe_stack(kx, ky, ImCtr, bls, 1.0, pitch/oversample, affine2d)
+    del kx, ky
+    phase = np.empty(projection.shape)
+    fringe = np.empty(projection.shape)
+    unit = oversample * oversample if pixweight is None else np.sum(pixweight)
+    for chan, bandpass in enumerate(bandpasses):
+        if hasattr(bandpass, '__iter__') == False:
+            bandpass = [(1.0, bandpass)]
+        for w,l in bandpass:
+            pb = primarybeam(ctrs, l, oversample, pitch, fov, d, psf_offset=psf_offset,
+                             shape=shape, affine2d=affine2d, envtable=envtable)
+            np.divide(projection, l, out=phase)
+            out[chan, :, :, 0] += w * nholes * subpix.binpixels(pb, oversample, pixweight)
+            np.cos(phase, out=fringe)
+            fringe *= 2 * w * pb
+            out[chan, :, :, 1:-1:2] += binstack(fringe, oversample, pixweight)
+            np.sin(phase, out=fringe)
+            fringe *= 2 * w * pb
+            out[chan, :, :, 2:-1:2] += binstack(fringe, oversample, pixweight)
+            out[chan, :, :, -1] += w * unit
+    return out
+
+
+def binstack(stack, oversample, pixweight=None):
+    """ bin a (n, nx*oversample, ny*oversample) stack of images to (nx, ny, n), as subpix.binpixels """
+    n, sx, sy = stack.shape
+    b = stack.reshape(n, sx//oversample, oversample, sy//oversample, oversample)
+    if pixweight is None:
+        return np.moveaxis(b.sum(axis=(2,4)), 0, 2)
+    return np.einsum('niajb,ab->ijn', b, pixweight)
+
+
+def offset_derivatives(ctrs, lam, oversample, pitch, fov, d, psf_offset=(0,0),
+                       shape='circ', affine2d=None, weight=1.0, out=None, h=1.0e-3,
+                       envtable=None, pixweight=None):
+    """
+    Derivatives of the binned model slices (as rebinning multiplyenv(*model_array(...)))
+    with respect to psf_offset[0] and psf_offset[1], in detector pixels.  The 
+    fringe phases are linear in the psf center, so their derivatives are exact:
+    d(phase)/d(center) is one constant per baseline, from the linear part of
+    affine2d.distortFargs.  The primary beam's derivative is a central 
+    difference at +/- h detector pixels.
+    weight: multiplies the derivatives, which are added to out if given.
+    pixweight: intrapixel response, as binned_model.
+    returns out, (2, fov, fov, 2*nbl+2)
+    """
+    nholes = ctrs.shape[0]
+    bls = baselines(ctrs)
+    nbl = bls.shape[0]
+    if out is None:
+        out = np.zeros((2, fov, fov, 2*nbl + 2))
+    ImCtr =  image_center(fov, oversample, psf_offset)
+    kx, ky = np.indices((fov*oversample, fov*oversample), dtype=float)
+    phase = fringe_stack(kx, ky, ImCtr, bls, lam, pitch/oversample, affine2d)
+    pb = primarybeam(ctrs, lam, oversample, pitch, fov, d, psf_offset=psf_offset,
+                     shape=shape, affine2d=affine2d, envtable=envtable)
+    # distorted coordinates per unit kx and ky (distortFargs is linear + constant)
+    origin = np.array(affine2d.distortFargs(0.0, 0.0))
+    du = np.array(affine2d.distortFargs(1.0, 0.0)) - origin
+    dv = np.array(affine2d.distortFargs(0.0, 1.0)) - origin
+    # psf_offset[0] moves the center along axis 1 (ky), psf_offset[1] along axis 0 (kx)
+    for axis, dk in ((0, dv), (1, du)):
+        step = np.zeros(2)
+        step[axis] = h
+        dpb = (primarybeam(ctrs, lam, oversample, pitch, fov, d, psf_offset=tuple(np.add(psf_offset, step)),
+                           shape=shape, affine2d=affine2d, envtable=envtable) - \
+               primarybeam(ctrs, lam, oversample, pitch, fov, d, psf_offset=tuple(np.subtract(psf_offset, step)),
+                           shape=shape, affine2d=affine2d, envtable=envtable)) / (2*h)
+        # d(phase)/d(psf_offset): center moves oversample pixels per detector pixel
+        dphase = -2*np.pi*(pitch/oversample)/lam * oversample * (bls[:,0]*dk[0] + bls[:,1]*dk[1])
+        cos, sin = np.cos(phase), np.sin(phase)
+        dcos = 2 * (dpb * cos - pb * sin * dphase[:,None,None])
+        dsin = 2 * (dpb * sin + pb * cos * dphase[:,None,None])
+        out[axis, :, :, 0] += weight * nholes * subpix.binpixels(dpb, oversample, pixweight)
+        out[axis, :, :, 1:-1:2] += weight * binstack(dcos, oversample, pixweight)
+        out[axis, :, :, 2:-1:2] += weight * binstack(dsin, oversample, pixweight)
+    return out
+
+
 def multiplyenv(env, fringeterms):
     # The envelope is size (fov, fov). This multiplies the envelope by each of the 43 slices
-    # (if 7 holes) in the fringe model
-    full = np.ones((np.shape(fringeterms)[1], np.shape(fringeterms)[2], np.shape(fringeterms)[0]+1))
-    for i in range(len(fringeterms)):
-        full[:,:,i] = env * fringeterms[i]
+    # (if 7 holes) in the fringe model; the last slice is left at unity.  In the fringes' precision.
+    full = np.ones((np.shape(fringeterms)[1], np.shape(fringeterms)[2], np.shape(fringeterms)[0]+1),
+                   dtype=np.result_type(np.asarray(fringeterms).dtype, np.float32))
+    np.multiply(np.asarray(env, dtype=full.dtype), fringeterms, out=np.moveaxis(full, 2, 0)[:-1])
     return full
+
+
+def fourier_shift(arr, shift):
+    """
+    Shift real arr by shift=(s0,s1) pixels along its first two axes with the
+    Fourier shift theorem.  Any further axes (eg model slices) are shifted
+    together.  arr is treated as periodic, so pad it by more than the shift.
+    """
+    n0, n1 = arr.shape[:2]
+    extra = (1,) * (arr.ndim - 2)
+    ramp0 = np.exp(-2j*np.pi*np.fft.fftfreq(n0)*shift[0]).reshape((n0, 1) + extra)
+    ramp1 = np.exp(-2j*np.pi*np.fft.rfftfreq(n1)*shift[1]).reshape((1, n1//2 + 1) + extra)
+    ft = np.fft.rfft2(arr, axes=(0, 1))
+    ft *= ramp0
+    ft *= ramp1
+    return np.fft.irfft2(ft, s=(n0, n1), axes=(0, 1))
@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+"""
+Bandpass compression: replace a long (weight, wavelength) table (eg ~150
+samples of filter throughput x source spectrum) by a few quadrature nodes, so
+polychromatic make_model() and simulate() build a handful of monochromatic
+models instead of one per table entry.
+
+Quadrature is done in wavenumber sigma = 1/lambda, since a fringe of optical
+path difference s is cos(2 pi s sigma).  Methods:
+
+    moments  - Gaussian quadrature for the discrete measure given by the table
+               (Stieltjes recurrence, Golub-Welsch nodes & weights).  Matches
+               the first 2*nodes moments of the bandpass in sigma.
+    legendre - Gauss-Legendre nodes on the bandpass's sigma range, weighted by
+               the throughput density interpolated at the nodes.
+
+compress_bandpass() also reports the largest error, relative to the total
+weight, of the compressed bandpass-averaged exp(2 pi i s sigma) for OPDs
+0 <= s <= maxopd.  Each model slice is a bandpass average of such terms (the
+envelope and the fringes together span OPDs up to (Bmax + d) * theta over the
+field - see max_opd()), so this bounds the fractional error of the model
+slices, apart from the slow sigma dependence of the envelope's amplitude.
+"""
+from __future__ import print_function
+import numpy as np
+
+
+def max_opd(ctrs, d, fov, pixscale):
+    """
+    largest optical path difference (m) any model term reaches in a fov x fov
+    (detector pixels) field: (longest baseline + hole size) * field corner angle
+    """
+    ctrs = np.asarray(ctrs)
+    bmax = np.sqrt(((ctrs[:,None,:] - ctrs[None,:,:])**2).sum(axis=-1)).max()
+    return (bmax + d) * pixscale * fov / np.sqrt(2.0)
+
+
+def bandpass_error(bandpass, compressed, maxopd, nopd=None):
+    """
+    max over 0 <= s <= maxopd of |<exp(2 pi i s sigma)>_bandpass - <...>_compressed|
+    divided by the total bandpass weight.
+    """
+    bandpass = np.asarray(bandpass, dtype=float)
+    compressed = np.asarray(compressed, dtype=float)
+    sig, sigc = 1.0/bandpass[:,1], 1.0/compressed[:,1]
+    if nopd is None: # 16 samples per cycle of the bluest fringe
+        nopd = int(16 * maxopd * sig.max()) + 2
+    s = np.linspace(0.0, maxopd, nopd)
+    full = (np.exp(2j*np.pi*s[:,None]*sig[None,:]) * bandpass[:,0]).sum(axis=1)
+    comp = (np.exp(2j*np.pi*s[:,None]*sigc[None,:]) * compressed[:,0]).sum(axis=1)
+    return np.abs(full - comp).max() / bandpass[:,0].sum()
+
+
+def gauss_moments(sigma, weights, nodes):
+    """ Gaussian quadrature nodes and weights for the discrete measure (sigma, weights) """
+    total = weights.sum()
+    # work on [-1, 1] for a well-conditioned recurrence
+    center, half = 0.5*(sigma.max() + sigma.min()), 0.5*(sigma.max() - sigma.min())
+    x = (sigma - center) / half
+    w = weights / total
+    alpha, beta = np.zeros(nodes), np.zeros(nodes)
+    p_prev, p = np.zeros(len(x)), np.ones(len(x))
+    norm_prev = 1.0
+    for k in range(nodes):
+        norm = (w * p * p).sum()
+        alpha[k] = (w * x * p * p).sum() / norm
+        if k > 0:
+            beta[k] = norm / norm_prev
+        p_prev, p = p, (x - alpha[k]) * p - beta[k] * p_prev
+        norm_prev = norm
+    jacobi = np.diag(alpha) + np.diag(np.sqrt(beta[1:]), 1) + np.diag(np.sqrt(beta[1:]), -1)
+    xk, vecs = np.linalg.eigh(jacobi)
+    return center + half * xk, total * vecs[0]**2
+
+
+def gauss_legendre(sigma, weights, nodes):
+    """ Gauss-Legendre nodes on the sigma range, weighted by the interpolated throughput density """
+    order = np.argsort(sigma)
+    sigma, weights = sigma[order], weights[order]
+    density = weights / np.gradient(sigma) # weight per unit wavenumber
+    xk, wk = np.polynomial.legendre.leggauss(nodes)
+    center, half = 0.5*(sigma[-1] + sigma[0]), 0.5*(sigma[-1] - sigma[0])
+    sk = center + half * xk
+    wk = wk * half * np.interp(sk, sigma, density)
+    return sk, wk * weights.sum() / wk.sum()
+
+
+def compress_bandpass(bandpass, nodes=5, method="moments", maxopd=None):
+    """
+    bandpass: sequence of (weight, wavelength) pairs, wavelengths in m
+    nodes: number of quadrature nodes in the compressed bandpass
+    method: "moments" or "legendre"
+    maxopd: OPD range (m) for the error report (eg from max_opd()); None skips it
+
+    returns compressed bandpass as a (nodes, 2) array of (weight, wavelength),
+    and the error bound (None if maxopd is None)
+    """
+    bandpass = np.asarray(bandpass, dtype=float)
+    weights, sigma = bandpass[:,0], 1.0/bandpass[:,1]
+    if nodes >= np.count_nonzero(weights):
+        compressed = bandpass.copy()
+    elif method == "moments":
+        sk, wk = gauss_moments(sigma, weights, nodes)
+        compressed = np.array([wk, 1.0/sk]).T
+    elif method == "legendre":
+        sk, wk = gauss_legendre(sigma, weights, nodes)
+        compressed = np.array([wk, 1.0/sk]).T
+    else:
+        raise ValueError("compress_bandpass: unknown method {0}".format(method))
+    if maxopd is None:
+        return compressed, None
+    return compressed, bandpass_error(bandpass, compressed, maxopd)
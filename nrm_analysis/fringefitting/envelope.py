@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+"""
+EnvelopeTable: tabulated primary beams (hole transform intensities).
+
+The primary beam of one hole depends on the image plane angle only through
+the dimensionless, affine-distorted coordinates  u, v = (d/lam) * theta',
+so one table serves every wavelength, pixel scale, psf offset and Affine2d.
+
+    circ:  (2 J1(rho)/rho)^2, rho = pi * sqrt(u^2 + v^2)   1-d table in rho
+    hex:   |hex(u, v)|^2 (hextransformEE)                   2-d table on the
+           quadrant u, v >= 0, the hexagon being symmetric in u and in v
+
+Tables are interpolated with cubic splines (scipy.ndimage.map_coordinates).
+The table step is halved until the largest interpolation error at cell
+centers is below tol (as a fraction of the peak), and the table is extended
+whenever a primary beam needs larger arguments.  Use get_table() for one
+table per hole shape per process.
+"""
+from __future__ import print_function
+import numpy as np
+import scipy.special
+from scipy import ndimage
+from nrm_analysis.misctools import utils
+from . import hextransformEE
+
+_tables = {}  # per-process tables, by hole shape
+
+EPSILON = 1.0e-8  # keeps hex table nodes off the gfunction singular lines, as hextransform()
+
+
+def jinc2(rho):
+    """ (2 J1(rho)/rho)^2, unity at rho = 0 """
+    rho = np.where(rho == 0.0, EPSILON, rho)
+    return (2.0 * scipy.special.jv(1, rho) / rho)**2
+
+
+def hex2(u, v, rsmall=0.05):
+    """
+    |hex(u, v)|^2 for undistorted dimensionless coordinates u, v = (d/lam)*theta.
+    gfunction loses precision near the origin (cancellation ~1e-16/r^3), so for 
+    r < rsmall use the transform's series from the hexagon's (isotropic) second 
+    and fourth moments, <x^2> = 5/72 and <x^4> = 7/720 for unit flat-to-flat:
+        hex/A = 1 - 2 pi^2 <x^2> r^2 + (2 pi^4/3) <x^4> r^4,   A = sqrt(3)/2
+    """
+    ideal = utils.Affine2d(mx=1.0, my=1.0, sx=0.0, sy=0.0, xo=0.0, yo=0.0, name="Ideal")
+    u, v = np.broadcast_arrays(np.asarray(u, dtype=float), np.asarray(v, dtype=float))
+    hexc = hextransformEE.gfunction(u + EPSILON, v + EPSILON, c=(0.0, 0.0), pixel=1.0,
+                                    d=1.0, lam=1.0, affine2d=ideal, minus=False) + \
+           hextransformEE.gfunction(u + EPSILON, v + EPSILON, c=(0.0, 0.0), pixel=1.0,
+                                    d=1.0, lam=1.0, affine2d=ideal, minus=True)
+    h2 = (hexc * hexc.conj()).real
+    r2 = u*u + v*v
+    series = 0.75 * (1.0 - 2*np.pi**2 * (5.0/72.0) * r2 + (2*np.pi**4/3.0) * (7.0/720.0) * r2*r2)**2
+    return np.where(r2 < rsmall*rsmall, series, h2)
+
+
+class EnvelopeTable(object):
+
+    def __init__(self, shape, step=1.0/32, extent=4.0, tol=1.0e-6, minstep=1.0/512):
+        """
+        shape: 'circ' or 'hex'
+        step: initial table step in u, v (or rho/pi)
+        extent: initial table range in u, v (or rho/pi)
+        tol: interpolation accuracy, fraction of the envelope peak
+        """
+        if shape not in ('circ', 'hex'):
+            raise KeyError("Must provide a valid hole shape. Current supported shapes are" \
+                    " 'circ' and 'hex'.")
+        self.shape = shape
+        self.step = step
+        self.extent = extent
+        self.tol = tol
+        self.minstep = minstep
+        self.error = None
+        self.build()
+
+    def exact(self, u, v):
+        """ exact envelope intensity at dimensionless distorted coordinates u, v """
+        if self.shape == 'circ':
+            return jinc2(np.pi * np.sqrt(u*u + v*v))
+        return hex2(u, v)
+
+    def build(self):
+        """ tabulate to self.extent, refining the step until the error is within tol """
+        while True:
+            n = int(np.ceil(self.extent / self.step)) + 4 # spline margin
+            grid = np.arange(n) * self.step
+            if self.shape == 'circ':
+                table = self.exact(grid, 0.0)
+                check = (grid[:-4] + 0.5*self.step, 0.0*grid[:-4])
+            else:
+                u, v = np.meshgrid(grid, grid, indexing='ij')
+                table = self.exact(u, v)
+                mid = grid[:-4:3] + 0.5*self.step # every third cell center
+                check = np.meshgrid(mid, mid, indexing='ij')
+            self.coeffs = ndimage.spline_filter(table, order=3, mode='mirror')
+            self.error = np.abs(self.interpolate(*check) - self.exact(*check)).max() / table.max()
+            if self.error <= self.tol or self.step / 2.0 < self.minstep:
+                break
+            self.step /= 2.0
+        if self.error > self.tol:
+            print("EnvelopeTable: {0} table error {1:.1e} exceeds tol {2:.1e}".format(self.shape,
+                  self.error, self.tol))
+
+    def interpolate(self, u, v):
+        """ tabulated envelope intensity at u, v (within the table extent) """
+        if self.shape == 'circ':
+            coords = (np.sqrt(u*u + v*v) / self.step)[None]
+        else:
+            coords = np.array((np.abs(u) / self.step, np.abs(v) / self.step))
+        return ndimage.map_coordinates(self.coeffs, coords, order=3, mode='mirror',
+                                       prefilter=False)
+
+    def __call__(self, u, v):
+        """ envelope intensity at dimensionless distorted coordinates u, v """
+        reach = np.abs(np.array((u, v))).max()
+        if self.shape == 'circ':
+            reach *= np.sqrt(2.0)
+        if reach > self.extent:
+            while self.extent < reach:
+                self.extent *= 2.0
+            self.build()
+        return self.interpolate(u, v)
+
+    def primarybeam(self, kx, ky, c, d, lam, pitch, affine2d):
+        """
+        primary beam at oversampled pixel coordinates kx, ky (any shape) for a
+        psf centered at c (oversampled pixels), as analyticnrm2.primarybeam().
+        pitch: oversampled pixel pitch, rad
+        """
+        xprime, yprime = affine2d.distortFargs(kx - c[0], ky - c[1])
+        scale = pitch * d / lam
+        return self(scale * xprime, scale * yprime)
+
+
+def get_table(shape, tol=1.0e-6):
+    """ returns this process's EnvelopeTable for the hole shape, creating it if needed """
+    if (shape, tol) not in _tables:
+        _tables[(shape, tol)] = EnvelopeTable(shape, tol=tol)
+    return _tables[(shape, tol)]
@@ -0,0 +1,148 @@
+#! /usr/bin/env python
+"""
+Fixed-dtype records of fringe fit results, one per slice (integration).
+
+A fit leaves a lot in its NRM_Model (the model, fringes, model_beam,
+residual...), but what later steps need is small: fit_record() copies it into
+one numpy structured record,
+
+    slc          slice number in its file
+    wavelength   the slice's (bandpass weighted mean) wavelength, m
+    soln         normalised solution coefficients (nterms,)
+    flux         raw flux coefficient
+    phases       fringe phases, rad (nbl,)
+    amplitudes   fringe amplitudes (nbl,)
+    cps          closure phases, rad (N choose 3,)
+    cas          closure amplitudes (N choose 4,)
+    centroid     measured centroid offset, detector pixels
+    psf_offset   psf offset of the model (fitted if fit_offset), detector pixels
+    chi2         sum of squared (weighted, if weights) residuals
+    ndof         fitted pixels - nterms
+    nrejected    pixels rejected by clipping
+    cond         condition number of the fit
+    seconds      wall time of the slice's fit
+
+and with covariance=True the covariance matrices phases_cov, amplitudes_cov,
+cps_cov and cas_cov.  Workers return a few kB per slice, and gather() stacks
+a file's records into a structured array ordered by slice.  record_dtype(N)
+depends only on the number of holes (and covariance).
+
+Each exposure's records go in one file, STORE_NAME in its output directory
+(write_store, read_store): a FITS binary table, one row per integration,
+in extension FITRESULTS, with the science header in the primary HDU.
+"""
+from __future__ import print_function
+import os
+import numpy as np
+from scipy.special import comb
+from astropy.io import fits
+from .support import mean_wavelength
+
+STORE_NAME = "fringefit_results.fits"
+
+_dtypes = {}  # per-process dtypes, by number of holes and covariance
+
+
+def record_dtype(N, covariance=False):
+    """ structured dtype of the fit records of an N hole mask """
+    if (N, covariance) not in _dtypes:
+        nbl = N*(N-1)//2
+        ncp, nca = int(comb(N, 3)), int(comb(N, 4))
+        fields = [("slc", np.int32),
+                  ("wavelength", np.float64),
+                  ("soln", np.float64, (2*nbl + 2,)),
+                  ("flux", np.float64),
+                  ("phases", np.float64, (nbl,)),
+                  ("amplitudes", np.float64, (nbl,)),
+                  ("cps", np.float64, (ncp,)),
+                  ("cas", np.float64, (nca,)),
+                  ("centroid", np.float64, (2,)),
+                  ("psf_offset", np.float64, (2,)),
+                  ("chi2", np.float64),
+                  ("ndof", np.int32),
+                  ("nrejected", np.int32),
+                  ("cond", np.float64),
+                  ("seconds", np.float64)]
+        if covariance:
+            fields += [("phases_cov", np.float64, (nbl, nbl)),
+                       ("amplitudes_cov", np.float64, (nbl, nbl)),
+                       ("cps_cov", np.float64, (ncp, ncp)),
+                       ("cas_cov", np.float64, (nca, nca))]
+        _dtypes[(N, covariance)] = np.dtype(fields)
+    return _dtypes[(N, covariance)]
+
+
+def fit_record(nrm, slc, seconds=0.0, weights=None, covariance=False):
+    """ 
+    record of the fit_image() (or use_solution()) results in nrm, for slice slc 
+    covariance: include fit_image(covariance=True)'s covariance matrices
+    """
+    rec = np.zeros((), dtype=record_dtype(nrm.N, covariance))
+    rec["slc"] = slc
+    rec["wavelength"] = mean_wavelength(nrm.bandpass)
+    rec["soln"] = nrm.soln
+    rec["flux"] = nrm.flux
+    rec["phases"] = nrm.fringephase
+    rec["amplitudes"] = nrm.fringeamp
+    rec["cps"] = nrm.redundant_cps
+    rec["cas"] = nrm.redundant_cas
+    rec["centroid"] = (getattr(nrm, "xpos", np.nan), getattr(nrm, "ypos", np.nan))
+    rec["psf_offset"] = getattr(nrm, "psf_offset_fit", getattr(nrm, "bestcenter", (np.nan, np.nan)))
+    fitted = ~np.isnan(nrm.residual)
+    if getattr(nrm, "rejected", None) is not None:
+        fitted &= ~nrm.rejected
+        rec["nrejected"] = nrm.rejected.sum()
+    res = nrm.residual if weights is None else nrm.residual * weights
+    rec["chi2"] = (res[fitted]**2).sum()
+    rec["ndof"] = fitted.sum() - len(nrm.soln)
+    rec["cond"] = nrm.cond
+    rec["seconds"] = seconds
+    if covariance:
+        rec["phases_cov"] = nrm.fringephase_cov
+        rec["amplitudes_cov"] = nrm.fringeamp_cov
+        rec["cps_cov"] = nrm.cp_cov
+        rec["cas_cov"] = nrm.ca_cov
+    return rec
+
+
+def gather(records):
+    """ one structured array of a file's records, ordered by slice """
+    records = np.array(records)
+    return records[np.argsort(records["slc"], kind="stable")]
+
+
+def write_store(outdir, records, header=None, meta=None):
+    """
+    write an exposure's records (gather() output) to outdir/STORE_NAME.
+    header: the science header, copied to the primary HDU without its 
+    structural keywords.  meta: dict of extra keywords for FITRESULTS.
+    Written to a temporary file then renamed, so readers never see a partial store.
+    returns the store's path
+    """
+    primary = fits.PrimaryHDU()
+    if isinstance(header, fits.Header):
+        primary.header.extend(header.copy(strip=True), unique=True)
+    table = fits.BinTableHDU(data=records, name="FITRESULTS")
+    table.header["NRECORDS"] = (len(records), "integrations (rows)")
+    for key, value in (meta or {}).items():
+        table.header[key] = value
+    path = os.path.join(outdir, STORE_NAME)
+    tmp = path + ".part"
+    fits.HDUList([primary, table]).writeto(tmp, overwrite=True)
+    os.replace(tmp, path)
+    return path
+
+
+def read_store(path):
+    """ records (structured array) and primary header of a store, given it or its directory """
+    if os.path.isdir(path):
+        path = os.path.join(path, STORE_NAME)
+    with fits.open(path) as hdul:
+        records = np.array(hdul["FITRESULTS"].data)
+        header = hdul[0].header.copy()
+    return records.astype(records.dtype.newbyteorder("=")), header # FITS is big-endian
+
+
+def has_store(directory):
+    """ True if directory holds a result store """
+    return os.path.isfile(os.path.join(directory, STORE_NAME))
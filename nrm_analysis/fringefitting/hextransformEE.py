@@ -3,6 +3,7 @@ import numpy as np
 from astropy.io import fits
 import os
 import matplotlib.pyplot as pl
+from ..misctools.utils import fromfunction_threaded
 from astropy import units as u
 from astropy.units import cds
 cds.enable()
@@ -164,8 +165,8 @@ def hextransform(s=None, c=None, d=None, lam=None, pitch=None, affine2d=None,
         c_adjust[1] = c[1]+ epsilon_offset
         cpsingularityflag = True  # if so set up the central pixel singularity flag
 
-    hex_complex = np.fromfunction(gfunction, s, d=d, c=c_adjust, lam=lam, pixel=pitch, affine2d=affine2d, minus=False) + \
-                  np.fromfunction(gfunction, s, d=d, c=c_adjust, lam=lam, pixel=pitch, affine2d=affine2d, minus=True)
+    hex_complex = fromfunction_threaded(gfunction, s, d=d, c=c_adjust, lam=lam, pixel=pitch, affine2d=affine2d, minus=False) + \
+                  fromfunction_threaded(gfunction, s, d=d, c=c_adjust, lam=lam, pixel=pitch, affine2d=affine2d, minus=True)
 
     if cpsingularityflag:
         print("**** info:  central pixel singularity - nudge center by epsilon_offset {0:.1e}, c0,c1=({1:f},{2:f}), determinant={3:.4e} ".format(epsilon_offset, int(c[0]), int(c[1]), affine2d.determinant))
@@ -213,7 +214,7 @@ def recttransform(s=None, c=None, d=None, lam=None, pitch=None, affine2d=None,
     print(("Center:",c, "Shape:", s))
 
     rat = 0.5 # y dimension of rectangle / x dimension of rectangle
-    rect_complex = np.fromfunction(sincxy, s, a=d, b=rat*d, c=c, lam=lam, pitch=pitch, affine2d=affine2d)
+    rect_complex = fromfunction_threaded(sincxy, s, a=d, b=rat*d, c=c, lam=lam, pitch=pitch, affine2d=affine2d)
     return rect_complex
 
 
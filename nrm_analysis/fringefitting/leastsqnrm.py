@@ -6,10 +6,12 @@
 import numpy as np
 import scipy.special
 import numpy.linalg as linalg
+import scipy.linalg
 import sys
 from scipy.special import comb
 import os, pickle
 from uncertainties import unumpy  # pip install if you need
+from nrm_analysis.misctools import utils
 
 m = 1.0
 mm = 1.0e-3 * m
@@ -24,10 +26,40 @@ def scaling(img, photons):  # RENAME this function
     return photons / total
 
 
-def matrix_operations(img, model, flux = None, verbose=False, linfit=False):
+def blockwise_residual(flatmodel, flatimg, x, blocksize=8192):
+    # float64 b - A.x and At.(b - A.x) for a (possibly single precision) A,
+    # converting A to float64 a block of rows at a time.  flatimg and x may be
+    # 2-d, one column per image.
+    res = np.empty(np.shape(flatimg))
+    atr = np.zeros(np.shape(x))
+    for b0 in range(0, len(flatimg), blocksize):
+        a = flatmodel[b0:b0+blocksize].astype(np.float64)
+        res[b0:b0+blocksize] = flatimg[b0:b0+blocksize] - np.dot(a, x)
+        atr += np.dot(a.T, res[b0:b0+blocksize])
+    return res, atr
+
+
+def refine_solution(flatmodel, flatimg, inverse, x, niter=3):
+    # Iterative refinement of a single precision normal-equations solution:
+    # residuals in float64, corrections from the single precision inverse.
+    # Converges to the float64 solution when cond(At.A) * eps32 << 1.
+    x = x.astype(np.float64)
+    inverse = inverse.astype(np.float64)
+    for it in range(niter):
+        res, atr = blockwise_residual(flatmodel, flatimg, x)
+        x += np.dot(inverse, atr)
+    res, atr = blockwise_residual(flatmodel, flatimg, x)
+    return x, res
+
+
+def matrix_operations(img, model, flux = None, verbose=False, linfit=False, dtype=None):
     # least squares matrix operations to solve A x = b, where A is the model,
     # b is the data (image), and x is the coefficient vector we are solving for.
     # In 2-D data x = inv(At.A).(At.b) 
+    # linfit: also return a photon-noise weighted fit with coefficient covariance
+    # (LinearFitResult), else None.
+    # dtype: np.float32 forms and solves the normal equations in single precision,
+    # then refines x in float64 (refine_solution).  Default: the model's dtype.
 
     flatimg = img.reshape(np.shape(img)[0] * np.shape(img)[1])
     nanlist = np.where(np.isnan(flatimg))
@@ -37,7 +69,10 @@ def matrix_operations(img, model, flux = None, verbose=False, linfit=False):
 
     # A
     flatmodel_nan = model.reshape(np.shape(model)[0] * np.shape(model)[1], np.shape(model)[2])
-    flatmodel = np.zeros((len(flatimg), np.shape(model)[2]))
+    if dtype is None:
+        dtype = model.dtype
+    single = np.dtype(dtype) == np.float32
+    flatmodel = np.zeros((len(flatimg), np.shape(model)[2]), dtype=dtype)
 
     if verbose:
         print("flat model dimensions ", np.shape(flatmodel))
@@ -50,13 +85,17 @@ def matrix_operations(img, model, flux = None, verbose=False, linfit=False):
     # At.A (makes square matrix)
     modelproduct = np.dot(flatmodeltransp, flatmodel)
     # At.b
-    data_vector = np.dot(flatmodeltransp, flatimg)
+    data_vector = np.dot(flatmodeltransp, flatimg.astype(dtype))
     # inv(At.A)
     inverse = linalg.inv(modelproduct)
     cond = np.linalg.cond(inverse)
 
     x = np.dot(inverse, data_vector)
-    res = np.dot(flatmodel, x) - flatimg
+    if single:
+        x, res = refine_solution(flatmodel, flatimg, inverse, x)
+        res = -res
+    else:
+        res = np.dot(flatmodel, x) - flatimg
     naninsert = nanlist[0] - np.arange(len(nanlist[0]))
     res = np.insert(res, naninsert, np.nan)
     res = res.reshape(img.shape[0], img.shape[1])
@@ -70,86 +109,210 @@ def matrix_operations(img, model, flux = None, verbose=False, linfit=False):
         print("transpose * image data dimensions", np.shape(data_vector))
         print("flat img * transpose dimensions", np.shape(inverse))
 
-    if linfit: 
-        try:
-            from linearfit import linearfit
-
-            # dependent variables
-            M = np.mat(flatimg)
-
-            # photon noise
-            noise = np.sqrt(np.abs(flatimg))
-
-            # this sets the weights of pixels fulfilling condition to zero
-            weights = np.where(np.abs(flatimg)<=1.0, 0.0, 1.0/(noise**2))    
-
-            # uniform weight
-            wy = weights
-            S = np.mat(np.diag(wy));
-            # matrix of independent variables
-            C = np.mat(flatmodeltransp)
-
-            # initialize object
-            result = linearfit.LinearFit(M,S,C)
+    if linfit:
+        # photon noise weights; pixels with |b| <= 1 get zero weight
+        weights = np.where(np.abs(flatimg)<=1.0, 0.0, 1.0/np.abs(flatimg))
+        linfit_result = LinearFitResult(flatmodel, flatimg, weights)
+        if verbose:
+            print("weighted fit reduced chi2", linfit_result.chi2_reduced)
+    else:
+        linfit_result = None
 
-            # do the fit
-            result.fit()
+    return x, res, cond, linfit_result
+    
 
-            # delete inverse_covariance_matrix to reduce size of pickled file
-            result.inverse_covariance_matrix = []
+def normal_update(normal, removed, added):
+    # At.A - Ar.Ar + Aa.Aa for a few rows Ar removed and Aa added: rank-k down/update 
+    # of the normal matrix.  Outer products, not np.dot, for the k = 1, 2 row cases.
+    normal = normal - (removed[:,:,None] * removed[:,None,:]).sum(axis=0)
+    return normal + (added[:,:,None] * added[:,None,:]).sum(axis=0)
 
-            linfit_result = result
-            print("Returned linearfit result")
 
-        except ImportError:
-            linfit_result = None
-    #         if verbose:
-            print("linearfit module not imported, no covariances saved.")
+class LinearFitResult(object):
+    """
+    Weighted least squares fit of A p = b with per-pixel weights w (1/variance),
+    with the coefficient covariance inv(At.W.A) formed from the weight vector,
+    O(npix nterms^2), instead of a dense npix x npix diag(w).  Attribute names
+    follow linearfit.LinearFit, whose results used to be pickled here.
+    """
+    def __init__(self, flatmodel, flatimg, weights):
+        flatmodel = flatmodel.astype(np.float64, copy=False)
+        wmodel = flatmodel * weights[:,None]
+        self.p_formal_covariance_matrix = linalg.inv(np.dot(flatmodel.T, wmodel))
+        self.p = np.dot(self.p_formal_covariance_matrix, np.dot(wmodel.T, flatimg))
+        self.fit_residuals = flatimg - np.dot(flatmodel, self.p)
+        self.chi2 = (weights * self.fit_residuals**2).sum()
+        self.n_freedom_degrees = np.count_nonzero(weights) - len(self.p)
+        self.chi2_reduced = self.chi2 / self.n_freedom_degrees
+        self.p_normalised_covariance_matrix = self.p_formal_covariance_matrix * self.chi2_reduced
+        self.p_formal_uncertainty = np.sqrt(np.diag(self.p_formal_covariance_matrix))
+        self.p_normalised_uncertainty = np.sqrt(np.diag(self.p_normalised_covariance_matrix))
+
+
+def observable_covariances(coeffs, cov, N=7):
+    """
+    Propagate the covariance cov of raw solution coefficients coeffs (flux,
+    cos & sin fringe terms, DC) to the observables fit_image reports, to first
+    order with analytic Jacobians (no uncertainties objects):
+        fringe phase = arctan2(b, a), fringe amplitude = sqrt(a^2 + b^2)/flux
+        closure phases (linear in phases), closure amplitudes (linear in log amplitudes)
+    returns covariance matrices of fringe phases, fringe amplitudes, 
+    closure phases and closure amplitudes
+    """
+    coeffs = np.asarray(coeffs, dtype=float)
+    nbl = (len(coeffs) - 1)//2
+    q = np.arange(nbl)
+    a, b, flux = coeffs[2*q+1], coeffs[2*q+2], coeffs[0]
+    r2 = a*a + b*b
+    amp = np.sqrt(r2) / flux
+    jphase = np.zeros((nbl, len(coeffs)))
+    jphase[q, 2*q+1] = -b / r2
+    jphase[q, 2*q+2] = a / r2
+    jamp = np.zeros((nbl, len(coeffs)))
+    jamp[q, 2*q+1] = a / (np.sqrt(r2) * flux)
+    jamp[q, 2*q+2] = b / (np.sqrt(r2) * flux)
+    jamp[:, 0] = -amp / flux
+    geometry = get_geometry(N)
+    jcp = np.dot(geometry.K, jphase)
+    jca = geometry.closure_amplitudes(amp)[:,None] * np.dot(geometry.L, jamp / amp[:,None])
+    return [np.dot(np.dot(j, cov), j.T) for j in (jphase, jamp, jcp, jca)]
+
+
+def multi_matrix_operations(cube, model, flux=None, verbose=False, dtype=None,
+                            weights=None, maxrank=None):
+    """
+    Batched matrix_operations for a cube of images (nslices, ny, nx) that all 
+    share one model (ny, nx, nterms), eg the integrations of a calints file.
+    Slices are grouped by NaN pattern, with one Cholesky factorisation of At.A
+    per group, and each group is solved as one matrix right hand side.  The
+    normal matrix of the commonest pattern (the reference) is built once.  A 
+    pattern differing from it in at most maxrank pixels (default nterms), eg a 
+    few cosmic ray hits, gets its normal matrix by a rank-k downdate (update 
+    for pixels NaN only in the reference) instead of a rebuild.
+    flux: None, a number, or one number per slice (as matrix_operations)
+    dtype: as matrix_operations (ignored, float64, when weights are given)
+    weights: (ny, nx) pixel weights shared by all slices, as weighted_operations
+        (solves At.C.A x = At.C.b, C = weights**2), or (nslices, ny, nx) weights,
+        one set per slice (eg from a photon noise model), for which all the
+        normal matrices are made together by multi_weighted_operations
+
+    returns x (nslices, nterms), res (nslices, ny, nx) and cond (nslices,),
+    each slice as matrix_operations (weighted_operations) would return it.
+    """
+    cube = np.asarray(cube)
+    if np.ndim(weights) == 3:
+        return multi_weighted_operations(cube, model, weights, flux=flux)
+    nslices, nterms = cube.shape[0], model.shape[2]
+    if dtype is None:
+        dtype = model.dtype
+    if weights is not None:
+        dtype = np.float64
+    single = np.dtype(dtype) == np.float32
+    if maxrank is None:
+        maxrank = nterms
+    flux = np.broadcast_to(np.array(flux, dtype=object), (nslices,))
+
+    flatcube = cube.reshape(nslices, -1)
+    nanmask = np.isnan(flatcube)
+    patterns, group, counts = np.unique(nanmask, axis=0, return_inverse=True,
+                                        return_counts=True)
+    group = group.ravel()
+    ref = patterns[counts.argmax()]
+
+    # one column per slice, NaNs zeroed so At.b needs no masking
+    flatimgs = np.where(nanmask, 0.0, flatcube).T
+    for slc in range(nslices):
+        if flux[slc] is not None:
+            flatimgs[:, slc] = flux[slc] * flatimgs[:, slc] / flatimgs[:, slc].sum()
+    flatmodel = model.reshape(-1, nterms).astype(dtype, copy=False)
+    if weights is None:
+        wmodel, wimgs = flatmodel, flatimgs.astype(dtype)
     else:
-        linfit_result = None
+        w = weights.reshape(-1)
+        wmodel, wimgs = flatmodel * w[:,None], flatimgs * w[:,None]
+    data_vectors = np.dot(wmodel.T, wimgs)
+    refnormal = np.dot(wmodel[~ref].T, wmodel[~ref])
+
+    x = np.zeros((nslices, nterms))
+    res = np.zeros(flatimgs.shape)
+    cond = np.zeros(nslices)
+    for g, pattern in enumerate(patterns):
+        cols = np.where(group == g)[0]
+        removed, added = pattern & ~ref, ref & ~pattern
+        if removed.sum() + added.sum() <= maxrank:
+            normal = normal_update(refnormal, wmodel[removed], wmodel[added])
+        else:
+            normal = np.dot(wmodel[~pattern].T, wmodel[~pattern])
+        factor = scipy.linalg.cho_factor(normal)
+        eigs = linalg.eigvalsh(normal)
+        cond[cols] = eigs.max() / eigs.min() # cond(inv(At.A)), as matrix_operations
+        xs = scipy.linalg.cho_solve(factor, data_vectors[:, cols])
+        if single:
+            inverse = scipy.linalg.cho_solve(factor, np.eye(nterms, dtype=dtype))
+            xs, resid = refine_solution(flatmodel[~pattern], flatimgs[~pattern][:, cols],
+                                        inverse, xs)
+            res[np.ix_(~pattern, cols)] = -resid
+        x[cols] = xs.T
         if verbose:
-            print("linearfit module not imported, no covariances saved.")
+            print("multi_matrix_operations: {0} slices, {1} NaNs, {2}".format(len(cols),
+                  pattern.sum(), "downdate" if removed.sum() + added.sum() <= maxrank \
+                  else "rebuilt"))
+    if not single:
+        res = np.dot(flatmodel, x.T) - flatimgs
+    res[nanmask.T] = np.nan
+    return x, res.T.reshape(cube.shape), cond
+
+
+def precision_report(img, model, N=7, verbose=True):
+    """
+    Validation of the single precision path: fit img with model in float64 and 
+    with a float32 copy of the model (float32 solve, float64 refinement), and
+    compare the observables.  Returns dict of the largest differences:
+    cp (closure phases, rad), phase (fringe phases, rad), amp (fringe amplitudes)
+    and ca (closure amplitudes).
+    """
+    observables = []
+    for dtype in (np.float64, np.float32):
+        x = matrix_operations(img, model.astype(dtype), dtype=dtype)[0]
+        x = x/x[0]
+        amp, phase = tan2visibilities(x)
+        observables.append((redundant_cps(phase, N=N), phase, amp, return_CAs(amp, N=N)))
+    report = {}
+    for name, obs64, obs32 in zip(("cp", "phase", "amp", "ca"), observables[0], observables[1]):
+        report[name] = np.abs(np.asarray(obs32) - np.asarray(obs64)).max()
+    if verbose:
+        print("float32 - float64 max |difference|:  closure phase {cp:.2e} rad,  "
+              "fringe phase {phase:.2e} rad,  fringe amplitude {amp:.2e},  "
+              "closure amplitude {ca:.2e}".format(**report))
+    return report
 
-    return x, res, cond, linfit_result
-    
 
 def weighted_operations(img, model, weights, verbose=False):
     # least squares matrix operations to solve A x = b, where A is the model, b is the data (image), and x is the coefficient vector we are solving for. In 2-D data x = inv(At.A).(At.b) 
+    # weights are 1/sigma per pixel: solves At.C.A x = At.C.b, C = weights**2
 
-    clist = weights.reshape(weights.shape[0]*weights.shape[1])**2
-    flatimg = img.reshape(np.shape(img)[0] * np.shape(img)[1])
-    nanlist = np.where(np.isnan(flatimg))
-    flatimg = np.delete(flatimg, nanlist)
-    clist = np.delete(clist, nanlist)
+    flatimg = img.reshape(-1)
+    good = ~np.isnan(flatimg)
+    flatimg = flatimg[good]
+    clist = weights.reshape(-1)[good]**2
     # A
-    flatmodel_nan = model.reshape(np.shape(model)[0] * np.shape(model)[1], np.shape(model)[2])
-    #flatmodel = model.reshape(np.shape(model)[0] * np.shape(model)[1], np.shape(model)[2])
-    flatmodel = np.zeros((len(flatimg), np.shape(model)[2]))
-    for fringe in range(np.shape(model)[2]):
-        flatmodel[:,fringe] = np.delete(flatmodel_nan[:,fringe], nanlist)
-    # At (A transpose)
-    flatmodeltransp = flatmodel.transpose()
+    flatmodel = model.reshape(-1, np.shape(model)[2])[good].astype(np.float64, copy=False)
     # At.C.A (makes square matrix)
-    CdotA = flatmodel.copy()
-    for i in range(flatmodel.shape[1]):
-        CdotA[:,i] = clist * flatmodel[:,i]
-    modelproduct = np.dot(flatmodeltransp, CdotA)
+    CdotA = clist[:,None] * flatmodel
+    modelproduct = np.dot(flatmodel.T, CdotA)
     # At.C.b
-    Cdotb = clist * flatimg
-    data_vector = np.dot(flatmodeltransp, Cdotb)
+    data_vector = np.dot(CdotA.T, flatimg)
     # inv(At.C.A)
     inverse = linalg.inv(modelproduct)
     cond = np.linalg.cond(inverse)
 
     x = np.dot(inverse, data_vector)
-    res = np.dot(flatmodel, x) - flatimg
-    naninsert = nanlist[0] - np.arange(len(nanlist[0]))
-    res = np.insert(res, naninsert, np.nan)
+    res = np.full(img.size, np.nan)
+    res[good] = np.dot(flatmodel, x) - flatimg
     res = res.reshape(img.shape[0], img.shape[1])
 
     if verbose:
         print("flat model dimensions ", np.shape(flatmodel))
-        print("model transpose dimensions ", np.shape(flatmodeltransp))
         print("flat image dimensions ", np.shape(flatimg))
         print("transpose * image data dimensions", np.shape(data_vector))
         print("flat img * transpose dimensions", np.shape(inverse))
@@ -157,6 +320,174 @@ def weighted_operations(img, model, weights, verbose=False):
     return x, res,cond
 
 
+def clipped_operations(img, model, weights=None, nsigma=5.0, maxiter=5, verbose=False):
+    """
+    Outlier-rejecting fit (hot pixels, cosmic rays, persistence): solve, reject 
+    pixels whose residual exceeds nsigma sigma, repeat until the rejected set
+    settles or maxiter times.  Pixels rejected while a bad pixel still pulled the
+    fit come back when their residuals drop.  Rows go in and out of the normal 
+    equations incrementally (rank-k down/update of At.C.A and At.C.b) rather
+    than rebuilding them.
+    weights: 1/sigma image as weighted_operations, sigma = 1 for the normalised
+        residuals; None fits unweighted, sigma the (MAD) robust residual scatter
+    returns x, res, cond (as matrix_operations/weighted_operations, residuals
+    kept at rejected pixels) and the boolean image of rejected pixels
+    """
+    flatimg = img.reshape(-1)
+    good = ~np.isnan(flatimg)
+    flatmodel = model.reshape(-1, np.shape(model)[2]).astype(np.float64, copy=False)
+    w = np.ones(len(flatimg)) if weights is None else weights.reshape(-1).astype(float)
+    rejected = np.zeros(len(flatimg), dtype=bool)
+
+    wmodel = flatmodel[good] * w[good,None]
+    wimg = flatimg[good] * w[good]
+    normal = np.dot(wmodel.T, wmodel)
+    data_vector = np.dot(wmodel.T, wimg)
+    for it in range(maxiter + 1):
+        x = scipy.linalg.cho_solve(scipy.linalg.cho_factor(normal), data_vector)
+        res = np.dot(flatmodel, x) - flatimg
+        if it == maxiter:
+            break
+        normres = res * w
+        if weights is None:
+            keep = good & ~rejected
+            sigma = 1.4826 * np.median(np.abs(normres[keep] - np.median(normres[keep])))
+        else:
+            sigma = 1.0
+        clip = good & (np.abs(normres) > nsigma * sigma)
+        removed, restored = clip & ~rejected, rejected & ~clip
+        if verbose:
+            print("clipped_operations: iteration {0} rejects {1}, restores {2} pixels".format(
+                  it, removed.sum(), restored.sum()))
+        if not (removed.any() or restored.any()):
+            break
+        rows, back = flatmodel[removed] * w[removed,None], flatmodel[restored] * w[restored,None]
+        normal = normal_update(normal, rows, back)
+        data_vector = data_vector - (rows * (flatimg[removed] * w[removed])[:,None]).sum(axis=0) \
+                                  + (back * (flatimg[restored] * w[restored])[:,None]).sum(axis=0)
+        rejected = clip
+
+    eigs = linalg.eigvalsh(normal)
+    res = res.reshape(img.shape)
+    return x, res, eigs.max() / eigs.min(), rejected.reshape(img.shape)
+
+
+def offset_operations(img, model, derivatives, weights=None, niter=1, x0=None):
+    """
+    Fit the fringe coefficients together with a small psf_offset correction
+    (d0, d1), detector pixels, with the model linearised in the offset:
+        model(offset + d) ~ model + d0 derivatives[0] + d1 derivatives[1]
+    Each Gauss-Newton step adds the columns derivatives[i].x (x the current
+    coefficients) to the design and solves for new coefficients and an offset 
+    step; no model is rebuilt, so errors are second order in d (fringe 
+    amplitudes ~1e-2 for d ~ 0.05 pixel at 4.3um): for small corrections.
+    derivatives: (2, ny, nx, nterms), eg NRM_Model.make_derivatives()
+    weights: 1/sigma image for weighted_operations, None for matrix_operations
+    niter: Gauss-Newton steps
+    x0: starting coefficients (eg from a clipped fit), else solved for with model
+    returns x (nterms coefficients, then d0, d1), res, cond and the final
+    (ny, nx, nterms+2) design, eg for weighted_fit() covariances
+    """
+    def solve(design):
+        if weights is None:
+            return matrix_operations(img, design)[:3]
+        return weighted_operations(img, design, weights)
+
+    x = solve(model)[0] if x0 is None else x0
+    offset = np.zeros(2)
+    for it in range(niter):
+        shifted = model + offset[0] * derivatives[0] + offset[1] * derivatives[1]
+        columns = np.stack([(derivatives[i] * x).sum(axis=-1) for i in (0, 1)], axis=-1)
+        design = np.concatenate((shifted, columns), axis=-1)
+        xd, res, cond = solve(design)
+        x = xd[:-2]
+        offset = offset + xd[-2:]
+    return np.concatenate((x, offset)), res, cond, design
+
+
+def weighted_fit(img, model, weights=None):
+    """
+    LinearFitResult (coefficient covariance) for img, NaN pixels excluded, with
+    1/sigma weights, or matrix_operations' photon noise weights if None
+    """
+    good = ~np.isnan(img.ravel())
+    flatimg = img.ravel()[good]
+    if weights is None:
+        clist = np.where(np.abs(flatimg)<=1.0, 0.0, 1.0/np.abs(flatimg))
+    else:
+        clist = weights.ravel()[good]**2
+    return LinearFitResult(model.reshape(-1, model.shape[2])[good], flatimg, clist)
+
+
+def multi_weighted_operations(cube, model, weights, flux=None):
+    """
+    weighted_operations for every slice of a cube (nslices, ny, nx) sharing one
+    model (ny, nx, nterms), with per-slice weights (nslices, ny, nx), 1/sigma.
+    NaN pixels get zero weight.  All the At.C.A come from one GEMM of the
+    weights with the pixel products of the model columns (upper triangle), and
+    the systems are solved as one stack.
+    returns x (nslices, nterms), res (nslices, ny, nx) and cond (nslices,)
+    """
+    cube = np.asarray(cube)
+    nslices, nterms = cube.shape[0], model.shape[2]
+    flatcube = cube.reshape(nslices, -1)
+    nanmask = np.isnan(flatcube)
+    flatimgs = np.where(nanmask, 0.0, flatcube)
+    if flux is not None:
+        flux = np.broadcast_to(np.asarray(flux, dtype=float), (nslices,))
+        flatimgs = flux[:,None] * flatimgs / flatimgs.sum(axis=1)[:,None]
+    clist = np.where(nanmask, 0.0, np.asarray(weights, dtype=float).reshape(nslices, -1)**2)
+    flatmodel = model.reshape(-1, nterms).astype(np.float64, copy=False)
+
+    iu = np.triu_indices(nterms)
+    products = flatmodel[:,iu[0]] * flatmodel[:,iu[1]]   # (npix, nterms(nterms+1)/2)
+    normals = np.zeros((nslices, nterms, nterms))
+    normals[:, iu[0], iu[1]] = np.dot(clist, products)
+    normals[:, iu[1], iu[0]] = normals[:, iu[0], iu[1]]
+    data_vectors = np.dot(clist * flatimgs, flatmodel)
+    x = np.linalg.solve(normals, data_vectors[:,:,None])[:,:,0]
+    eigs = np.linalg.eigvalsh(normals)
+    cond = eigs[:,-1] / eigs[:,0] # cond(inv(At.C.A)), as weighted_operations
+
+    res = np.dot(x, flatmodel.T) - flatimgs
+    res[nanmask] = np.nan
+    return x, res.reshape(cube.shape), cond
+
+
+def channel_operations(cube, models, weights=None):
+    """
+    Fit every channel of a spectral cube (nchan, ny, nx), each with its own 
+    model (nchan, ny, nx, nterms): one block-diagonal least squares problem.
+    The nchan normal matrices and data vectors come from batched products
+    and the systems are solved as one stack.  NaN pixels are dropped.
+    weights: None, or 1/sigma (nchan, ny, nx) as weighted_operations
+    returns x (nchan, nterms), res (nchan, ny, nx) and cond (nchan,), each 
+    channel as matrix_operations (weighted_operations) would return it.
+    """
+    cube = np.asarray(cube)
+    nchan, nterms = cube.shape[0], models.shape[-1]
+    flatcube = cube.reshape(nchan, -1)
+    nanmask = np.isnan(flatcube)
+    flatimgs = np.where(nanmask, 0.0, flatcube)
+    if weights is None:
+        clist = (~nanmask).astype(float)
+    else:
+        clist = np.where(nanmask, 0.0, np.asarray(weights, dtype=float).reshape(nchan, -1)**2)
+    flatmodels = models.reshape(nchan, -1, nterms).astype(np.float64, copy=False)
+
+    wmodels = flatmodels * clist[:,:,None]
+    normals = np.matmul(wmodels.transpose(0,2,1), flatmodels)
+    data_vectors = np.einsum('cpi,cp->ci', wmodels, flatimgs)
+    del wmodels
+    x = np.linalg.solve(normals, data_vectors[:,:,None])[:,:,0]
+    eigs = np.linalg.eigvalsh(normals)
+    cond = eigs[:,-1] / eigs[:,0] # cond(inv(At.A)), as matrix_operations
+
+    res = np.einsum('cpi,ci->cp', flatmodels, x) - flatimgs
+    res[nanmask] = np.nan
+    return x, res.reshape(cube.shape), cond
+
+
 def deltapistons(pistons):
     # This function is used for comparison to calculate relative pistons from given pistons (only deltapistons are measured in the fit)
     N = len(pistons)
@@ -174,6 +505,78 @@ def deltapistons(pistons):
     return delta
 
 
+class ObservableGeometry(object):
+    """
+    Index tables for an N hole mask, in the order fit_image reports observables:
+        baselines (nbl, 2)   hole pairs h1 < h2, h1 slowest
+        triangles (ncp, 3)   baseline indices (ab, bc, ac): cp = ph_ab + ph_bc - ph_ac
+        quads (nca, 4)       baseline indices (ij, kl, ik, jl): ca = A_ij A_kl / (A_ik A_jl)
+        K                    closure phase matrix, cps = K . phases (utils.makeK)
+        L                    log closure amplitude matrix, log cas = L . log amps
+        Apinv                pinv(utils.makeA), pistons = Apinv . phases
+    The methods take stacks of solutions/phases/amplitudes (last axis), eg every 
+    slice of a cube or an archive of solutions, with fancy indexing, no loops.
+    Use get_geometry(N) for one instance per N per process.
+    """
+    def __init__(self, N):
+        self.N = N
+        self.baselines = np.array([(h1, h2) for h1 in range(N) for h2 in range(h1+1, N)])
+        blindex = np.zeros((N, N), dtype=int)
+        blindex[self.baselines[:,0], self.baselines[:,1]] = np.arange(len(self.baselines))
+        self.triangles = np.array([(blindex[a,b], blindex[b,c], blindex[a,c])
+                                   for a in range(N) for b in range(a+1, N)
+                                   for c in range(b+1, N)])
+        self.quads = np.array([(blindex[i,j], blindex[k,l], blindex[i,k], blindex[j,l])
+                               for i in range(N) for j in range(i+1, N)
+                               for k in range(j+1, N) for l in range(k+1, N)])
+        self.K = utils.makeK(N)
+        nbl = len(self.baselines)
+        self.L = np.zeros((len(self.quads), nbl))
+        for col, sign in enumerate((1, 1, -1, -1)):
+            self.L[np.arange(len(self.quads)), self.quads[:,col]] += sign
+        self.Apinv = utils.makeA_pinv(N)
+
+    def visibilities(self, coeffs):
+        """ fringe amplitudes and phases from (normalised) solution coefficients """
+        coeffs = np.asarray(coeffs)
+        a, b = coeffs[...,1:-1:2], coeffs[...,2::2]
+        return np.sqrt(b**2 + a**2), np.arctan2(b, a)
+
+    def closure_phases(self, phases):
+        phases = np.asarray(phases)
+        t = self.triangles
+        return phases[...,t[:,0]] + phases[...,t[:,1]] - phases[...,t[:,2]]
+
+    def closure_amplitudes(self, amps):
+        amps = np.asarray(amps)
+        q = self.quads
+        return amps[...,q[:,0]] * amps[...,q[:,1]] / (amps[...,q[:,2]] * amps[...,q[:,3]])
+
+    def pistons(self, phases):
+        return np.dot(np.asarray(phases), self.Apinv.T)
+
+    def observables(self, coeffs):
+        """
+        raw solution coefficients (..., nterms) -> normalised coefficients, fringe
+        amplitudes, fringe phases, pistons, closure phases and closure amplitudes,
+        as fit_image computes them
+        """
+        coeffs = np.asarray(coeffs)
+        soln = coeffs / coeffs[...,:1]
+        amp, phase = self.visibilities(soln)
+        return (soln, amp, phase, self.pistons(phase), self.closure_phases(phase),
+                self.closure_amplitudes(amp))
+
+
+_geometries = {}  # per-process ObservableGeometry, by N
+
+def get_geometry(N):
+    """ returns this process's ObservableGeometry for an N hole mask """
+    if N not in _geometries:
+        _geometries[N] = ObservableGeometry(N)
+    return _geometries[N]
+
+
 def tan2visibilities(coeffs, verbose=False):
     """
     Technically the fit measures phase AND amplitude, so to retrieve
@@ -194,11 +597,9 @@ def tan2visibilities(coeffs, verbose=False):
         
         # coefficients of sine terms mulitiplied by 2*pi
 
-        delta = np.zeros(int( (len(coeffs) -1)/2 ))  # py3
-        amp = np.zeros(int( (len(coeffs) -1)/2 ))  # py3
-        for q in range(int( (len(coeffs) -1)/2 )):  # py3
-            delta[q] = (np.arctan2(coeffs[2*q+2], coeffs[2*q+1])) 
-            amp[q] = np.sqrt(coeffs[2*q+2]**2 + coeffs[2*q+1]**2)
+        coeffs = np.asarray(coeffs)
+        amp = np.sqrt(coeffs[2::2]**2 + coeffs[1:-1:2]**2)
+        delta = np.arctan2(coeffs[2::2], coeffs[1:-1:2])
         if verbose:
             print("shape coeffs", np.shape(coeffs))
             print("shape delta", np.shape(delta))
@@ -292,11 +693,11 @@ def phases_and_amplitudes(solution_coefficients, N=7):
 
 
 def redundant_cps(deltaps, N = 7):
-    fringephasearray = populate_antisymmphasearray(deltaps, N=N)
     if type(deltaps[0]).__module__ != 'uncertainties.core':
-        cps = np.zeros(int(comb(N,3)))
-    else:
-        cps = unumpy.uarray( np.zeros(np.int(comb(N,3))),np.zeros(np.int(comb(N,3))) )    
+        return get_geometry(N).closure_phases(deltaps)
+    # propagate uncertainties
+    fringephasearray = populate_antisymmphasearray(deltaps, N=N)
+    cps = unumpy.uarray( np.zeros(np.int(comb(N,3))),np.zeros(np.int(comb(N,3))) )    
     nn=0
     for kk in range(N-2):
         for ii in range(N-kk-2):
@@ -305,10 +706,7 @@ def redundant_cps(deltaps, N = 7):
                        + fringephasearray[ii+kk+1, jj+ii+kk+2] \
                        + fringephasearray[jj+ii+kk+2, kk]
             nn = nn+jj+1
-    if type(deltaps[0]).__module__ != 'uncertainties.core':
-        return cps
-    else:
-        return cps, fringephasearray
+    return cps, fringephasearray
 
         
 def closurephase(deltap, N=7):
@@ -337,13 +735,12 @@ def closurephase(deltap, N=7):
 
 
 def return_CAs(amps, N=7):
+    if type(amps[0]).__module__ != 'uncertainties.core':
+        return get_geometry(N).closure_amplitudes(amps)
+    # propagate uncertainties
     fringeamparray = populate_symmamparray(amps, N=N)            
     nn=0
-    
-    if type(amps[0]).__module__ != 'uncertainties.core':
-        CAs = np.zeros(int(comb(N,4)))
-    else:
-        CAs = unumpy.uarray( np.zeros(np.int(comb(N,4))),np.zeros(np.int(comb(N,4))) )
+    CAs = unumpy.uarray( np.zeros(np.int(comb(N,4))),np.zeros(np.int(comb(N,4))) )
         
     for ii in range(N-3):
         for jj in range(N-ii-3):
@@ -0,0 +1,162 @@
+#! /usr/bin/env python
+"""
+ModelCache: content-addressed store of NRM_Model.make_model() fringe models.
+
+A fringe model depends only on the mask hole centers and hole size, the hole
+shape, the model pixel scale, the Affine2d pupil distortion, the bandpass,
+the field of view, the oversampling and the PSF offset.  The cache key is a
+hash of exactly those inputs, so repeated exposures with the same filter and
+geometry (e.g. many calibrator and target integrations) reuse one model.
+
+Two tiers:
+    memory - least-recently-used, capped at 'memsize' bytes.  Shared by all
+             ModelCache objects in a process with the same cachedir, so
+             caches unpickled in pool workers keep their models across tasks.
+    disk   - optional, one .npy file per model in 'cachedir', read back
+             memory-mapped, capped at 'disksize' bytes.  Least recently used
+             files are evicted first.  Files are written atomically, so
+             several processes may share one cache directory.
+
+Cached arrays are returned read-only.
+"""
+from __future__ import print_function
+import os
+import hashlib
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+CACHE_VERSION = "LG++1"  # change if the model calculation changes
+
+_memtiers = {} # per-process memory tiers, by cachedir
+
+
+class _MemoryTier(OrderedDict):
+    # models by key, least recently used first, with their running total of bytes
+
+    def __init__(self):
+        OrderedDict.__init__(self)
+        self.nbytes = 0
+
+    def clear(self):
+        OrderedDict.clear(self)
+        self.nbytes = 0
+
+
+def model_key(ctrs, d, holeshape, pixscale, affine2d, bandpass, fov, over, psf_offset,
+              **kwargs):
+    """ returns hex sha1 digest identifying a fringe model built from these inputs.
+        Extra keyword arguments (eg model-building options) are folded into the key.
+    """
+    h = hashlib.sha1()
+    h.update(CACHE_VERSION.encode())
+    h.update(str(holeshape).encode())
+    for arr in (ctrs, d, pixscale, bandpass, fov, over, psf_offset,
+                (affine2d.mx, affine2d.my, affine2d.sx, affine2d.sy, affine2d.xo, affine2d.yo)):
+        h.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+        h.update(b"|")
+    for k in sorted(kwargs):
+        h.update("{0}={1!r}|".format(k, kwargs[k]).encode())
+    return h.hexdigest()
+
+
+class ModelCache(object):
+
+    def __init__(self, cachedir=None, memsize=5.0e8, disksize=5.0e9):
+        """
+        cachedir: directory for the on-disk tier, None for memory only.
+        memsize:  bytes of models held in memory
+        disksize: bytes of models held on disk
+        """
+        self.cachedir = cachedir
+        self.memsize = memsize
+        self.disksize = disksize
+        self._mem = _memtiers.setdefault(cachedir, _MemoryTier())
+        self.hits = 0
+        self.misses = 0
+        if cachedir is not None and not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+    def __getstate__(self):
+        # Do not ship the memory tier to worker processes
+        state = self.__dict__.copy()
+        del state['_mem']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._mem = _memtiers.setdefault(self.cachedir, _MemoryTier())
+
+    def _fn(self, key):
+        return os.path.join(self.cachedir, key + ".npy")
+
+    def get(self, key):
+        """ returns cached model (read-only) or None """
+        if key in self._mem:
+            self._mem.move_to_end(key)
+            self.hits += 1
+            return self._mem[key]
+        if self.cachedir is not None:
+            fn = self._fn(key)
+            try:
+                model = np.load(fn, mmap_mode='r')
+                os.utime(fn, None) # mark as recently used for eviction
+            except (IOError, OSError, ValueError):
+                model = None
+            if model is not None:
+                self._remember(key, model)
+                self.hits += 1
+                return model
+        self.misses += 1
+        return None
+
+    def put(self, key, model):
+        """ store a model under key in memory, and on disk if there is a cachedir """
+        model = np.array(model)
+        model.flags.writeable = False
+        self._remember(key, model)
+        if self.cachedir is not None and not os.path.isfile(self._fn(key)):
+            fd, tmpfn = tempfile.mkstemp(suffix=".tmp", dir=self.cachedir)
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, model)
+            os.replace(tmpfn, self._fn(key))
+            self._evict_disk()
+        return model
+
+    def _remember(self, key, model):
+        if key in self._mem:
+            self._mem.nbytes -= self._mem[key].nbytes
+        self._mem[key] = model
+        self._mem.nbytes += model.nbytes
+        self._mem.move_to_end(key)
+        while len(self._mem) > 1 and self._mem.nbytes > self.memsize:
+            self._mem.nbytes -= self._mem.popitem(last=False)[1].nbytes
+
+    def _evict_disk(self):
+        files = []
+        for fn in os.listdir(self.cachedir):
+            if fn.endswith(".npy"):
+                path = os.path.join(self.cachedir, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue # removed by another process
+                files.append((st.st_mtime, st.st_size, path))
+        files.sort()
+        total = sum(f[1] for f in files)
+        for mtime, size, path in files[:-1]:
+            if total <= self.disksize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """ empty both tiers """
+        self._mem.clear()
+        if self.cachedir is not None:
+            for fn in os.listdir(self.cachedir):
+                if fn.endswith(".npy"):
+                    os.remove(os.path.join(self.cachedir, fn))
@@ -0,0 +1,75 @@
+#! /usr/bin/env python
+"""
+Per-pixel noise models for weighted fringe fitting (FringeFitter noise_model=...).
+
+A noise model has one method,
+
+    variance(scidata, filename) -> variance cube, same shape as scidata (nslices, ny, nx)
+
+with np.inf for pixels that should get no weight.  FringeFitter calls it once
+per exposure, crops each slice's variance like the science slice, and fits
+with weights() = 1/sigma.
+
+    PhotonNoise  - photon plus read noise from the data themselves
+    VarianceMap  - a user-supplied variance image or cube
+    JWSTErrDQ    - the ERR and DQ extensions of a JWST calints/cal file
+"""
+from __future__ import print_function
+import numpy as np
+from astropy.io import fits
+
+
+def weights(variance):
+    """ 1/sigma weights from a variance array: zero where variance is inf, NaN or <= 0 """
+    variance = np.asarray(variance, dtype=float)
+    usable = np.isfinite(variance) & (variance > 0.0)
+    return np.where(usable, 1.0 / np.sqrt(np.where(usable, variance, 1.0)), 0.0)
+
+
+class PhotonNoise(object):
+
+    def __init__(self, gain=1.0, readnoise=0.0, floor=1.0):
+        """
+        gain: electrons per data unit
+        readnoise: read noise in data units
+        floor: smallest variance, in data units squared (keeps faint pixels from
+               getting huge weights when readnoise is 0)
+        """
+        self.gain = gain
+        self.readnoise = readnoise
+        self.floor = floor
+
+    def variance(self, scidata, filename=None):
+        variance = np.clip(scidata, 0.0, None) / self.gain + self.readnoise**2
+        return np.maximum(variance, self.floor)
+
+
+class VarianceMap(object):
+
+    def __init__(self, variance):
+        """ variance: (ny, nx) image used for every slice, or (nslices, ny, nx) """
+        self.map = np.asarray(variance, dtype=float)
+
+    def variance(self, scidata, filename=None):
+        return np.broadcast_to(self.map, np.shape(scidata))
+
+
+class JWSTErrDQ(object):
+
+    def __init__(self, dqmask=None, errext="ERR", dqext="DQ"):
+        """
+        dqmask: DQ bits that make a pixel unusable (None: any nonzero DQ)
+        errext, dqext: extension names in the science file
+        """
+        self.dqmask = dqmask
+        self.errext = errext
+        self.dqext = dqext
+
+    def variance(self, scidata, filename):
+        with fits.open(filename) as hdul:
+            err = hdul[self.errext].data.astype(float)
+            dq = hdul[self.dqext].data
+        variance = (err * err).reshape(np.shape(scidata))
+        dq = np.broadcast_to(dq, err.shape).reshape(np.shape(scidata))
+        bad = dq != 0 if self.dqmask is None else (dq & self.dqmask) != 0
+        return np.where(bad, np.inf, variance)
@@ -0,0 +1,173 @@
+#! /usr/bin/env python
+"""
+OffsetModelGrid: fringe models for arbitrary sub-pixel psf offsets by
+bilinear interpolation between models computed on a lattice of offsets.
+
+Each integration's centroid differs slightly, so make_model() would otherwise
+rebuild the full model for every slice.  Lattice models are built on demand
+with NRM_Model.make_model() and kept, so a long series of integrations costs
+a handful of exact models.  The lattice step starts at 'step' detector pixels
+and is halved until interpolation at the worst place in a lattice cell (its
+center) agrees with the exact model to within 'tol' times the model's peak,
+checked at cells spread over offsets within +/- 'span' pixels (the corners,
+edge midpoints and middle of that range).
+
+A grid holds no NRM_Model: the one passed to model() builds the lattice
+models, and get_grid() keys grids on everything that changes them (geometry,
+bandpass, fov, oversampling, make_model options, precision, tabulated
+envelope, pixweight).
+
+Each process (every pool worker) keeps its own grids, at most memsize bytes
+of lattice models, dropping the least recently used nodes and grids beyond
+that.  Lattice nodes go through the NRM_Model's modelcache, and get_grid()
+grids also keep their verified step there, so with a cache directory the
+processes sharing it build and verify each lattice once: the first one to
+need a model builds it while holding the build lock (set_build_lock(), eg a
+pool-wide multiprocessing.RLock), the others then read it from disk.
+"""
+from __future__ import print_function
+from collections import OrderedDict
+from contextlib import nullcontext
+import numpy as np
+from .modelcache import model_key
+
+GRID_MEMSIZE = 2.0e8  # bytes of lattice models kept per process
+
+_grids = OrderedDict()  # per-process grids, so pool workers reuse them across slices
+_build = {"lock": None}  # lock held while building lattice models, shared by a pool
+
+
+def set_build_lock(lock):
+    """ lock (reentrant, eg multiprocessing.RLock) serialising lattice builds between processes """
+    _build["lock"] = lock
+
+
+def building():
+    return nullcontext() if _build["lock"] is None else _build["lock"]
+
+
+class OffsetModelGrid(object):
+
+    def __init__(self, fov, bandpass, over=1, pixscale=None, step=1.0/16,
+                 tol=1.0e-3, minstep=1.0/1024, span=0.5, memsize=GRID_MEMSIZE, key=None,
+                 **options):
+        """
+        fov, bandpass, over, pixscale: as in NRM_Model.make_model()
+        options: other make_model() options (fouriershift, smeared, maxbytes) 
+                 used for the lattice models
+        step: initial lattice step, detector pixels
+        tol: allowed interpolation error as a fraction of the model's peak
+        span: verify tol for offsets up to span pixels in x and y
+        memsize: bytes of lattice models kept (at least the 4 of one cell)
+        key: get_grid()'s key, to keep the verified step in the modelcache
+        """
+        self.fov = fov
+        self.bandpass = bandpass
+        self.over = over
+        self.pixscale = pixscale
+        self.step = step
+        self.tol = tol
+        self.minstep = minstep
+        self.span = span
+        self.memsize = memsize
+        self.options = options
+        self.key = key
+        self.nodes = OrderedDict()
+        self.nbytes = 0
+        self.verified = False
+        self.error = None
+
+    def exact(self, nrm, psf_offset):
+        """ model from nrm.make_model() at this psf offset, a copy """
+        return np.array(nrm.make_model(fov=self.fov, bandpass=self.bandpass,
+                                            over=self.over, psf_offset=psf_offset,
+                                            pixscale=self.pixscale, **self.options))
+
+    def node(self, nrm, i, j):
+        """ lattice model at psf offset (i*step, j*step) """
+        if (i, j) not in self.nodes:
+            with building():
+                self.nodes[(i, j)] = self.exact(nrm, (i * self.step, j * self.step))
+            self.nbytes += self.nodes[(i, j)].nbytes
+            while len(self.nodes) > 4 and self.nbytes > self.memsize:
+                self.nbytes -= self.nodes.popitem(last=False)[1].nbytes
+        self.nodes.move_to_end((i, j))
+        return self.nodes[(i, j)]
+
+    def interpolate(self, nrm, psf_offset):
+        x, y = psf_offset[0] / self.step, psf_offset[1] / self.step
+        i, j = int(np.floor(x)), int(np.floor(y))
+        tx, ty = x - i, y - j
+        return (1 - tx) * (1 - ty) * self.node(nrm, i, j) + \
+               tx * (1 - ty) * self.node(nrm, i + 1, j) + \
+               (1 - tx) * ty * self.node(nrm, i, j + 1) + \
+               tx * ty * self.node(nrm, i + 1, j + 1)
+
+    def cell_centers(self):
+        """ centers of the lattice cells at the corners, edges and middle of +/- span """
+        last = int(np.ceil(self.span / self.step)) - 1
+        ends = sorted(set((-last - 1, 0, last)))
+        return [((i + 0.5) * self.step, (j + 0.5) * self.step) for i in ends for j in ends]
+
+    def verify(self, nrm):
+        """
+        Compare interpolated and exact models at cell_centers(), halving the
+        step until the largest relative error is within tol.  Returns the error.
+        A step already verified by another process (in nrm's modelcache) is reused.
+        """
+        cache = nrm.modelcache if self.key is not None else None
+        with building():
+            known = cache.get(self.key + "-step") if cache is not None else None
+            if known is not None:
+                self.step, self.error = float(known[0]), float(known[1])
+                self.verified = True
+                return self.error
+            self.refine(nrm)
+            if cache is not None:
+                cache.put(self.key + "-step", np.array([self.step, self.error]))
+        self.verified = True
+        return self.error
+
+    def refine(self, nrm):
+        while True:
+            self.error = 0.0
+            for center in self.cell_centers():
+                exact = self.exact(nrm, center)
+                self.error = max(self.error, np.abs(self.interpolate(nrm, center) - exact).max() / 
+                                             np.abs(exact).max())
+            if self.error <= self.tol or self.step / 2.0 < self.minstep:
+                break
+            self.step /= 2.0
+            self.nodes = OrderedDict()
+            self.nbytes = 0
+        if self.error > self.tol:
+            print("OffsetModelGrid: interpolation error {0:.2e} exceeds tol {1:.2e} "
+                  "at minimum step {2}".format(self.error, self.tol, self.step))
+
+    def model(self, nrm, psf_offset):
+        """ returns the fringe model at psf_offset (detector pixels), lattice models from nrm """
+        if not self.verified:
+            self.verify(nrm)
+        return self.interpolate(nrm, psf_offset)
+
+
+def get_grid(nrm, fov, bandpass, over=1, pixscale=None, step=1.0/16, tol=1.0e-3,
+             memsize=GRID_MEMSIZE, **options):
+    """ 
+    returns this process's OffsetModelGrid for nrm's geometry and model settings
+    and these make_model() options, creating it if needed.  The process's grids 
+    hold at most about memsize bytes; least recently used go first.
+    """
+    pixweight = None if nrm.pixweight is None else tuple(np.ravel(nrm.pixweight))
+    key = model_key(nrm.ctrs, nrm.d, nrm.holeshape, pixscale, nrm.affine2d, bandpass,
+                    fov, over, (0, 0), step=step, tol=tol, grid=True,
+                    precision=np.dtype(nrm.precision).str, 
+                    tabulated_envelope=bool(nrm.tabulated_envelope),
+                    pixweight=pixweight, **options)
+    if key not in _grids:
+        _grids[key] = OffsetModelGrid(fov, bandpass, over=over, pixscale=pixscale,
+                                      step=step, tol=tol, memsize=memsize, key=key, **options)
+    _grids.move_to_end(key)
+    while len(_grids) > 1 and sum(g.nbytes for g in _grids.values()) > memsize:
+        _grids.popitem(last=False)
+    return _grids[key]
@@ -14,37 +14,27 @@ def rotatevectors(vectors, thetarad):
                              s*vector[0] + c*vector[1]])
     return np.array(ctrs_rotated)
 
-def weightpixels(array, weightarray):
-
-    if np.shape(weightarray)[0] !=np.shape(weightarray)[1]:
-        raise ValueError("Pixel Weight Array Is Not Square")
-
-    oversample = np.shape(weightarray)[0]
-    shapex = np.shape(array)[0]
-    shapey = np.shape(array)[1]
-    b = array.copy()
-    b = b.reshape(shapex//oversample, oversample, shapey//oversample, oversample)
-    d = b.copy()
-
-    for i in range(np.shape(weightarray)[0]):
-        for j in range(np.shape(weightarray)[1]):
-            d[:,i,:,j] = d[:,i,:,j]* weightarray[i,j]
-
+def binpixels(array, oversample, weightarray=None):
     """
-    # e.g 1 in the center, 0.8 on the edges:
-    d[:,1, :, 1] = d[:,1, :, 1]
-
-    d[:,0, :, :] = 0.8 * d[:,0, :, :] 
-    d[:,2, :, :] = 0.8 * d[:,2, :, :] 
-    d[:,:, :, 0] = 0.8 * d[:, :, :, 0] 
-    d[:,:, :, 2] = 0.8 * d[:, :, :, 2] 
-
-    for i in range(shapex):
-        for j in range(shapey):
-            d[i,:,j,:] = b[i,:,j,:] * weightarray
+    Bin an oversampled (nx*oversample, ny*oversample, ...) array to detector
+    pixels, (nx, ny, ...); trailing axes (eg model slices) are binned together.
+    weightarray: (oversample, oversample) intrapixel response; each sub-pixel
+    is multiplied by its weight in the same (einsum) pass as the sum.
+    None: plain flux-conserving sum, as utils.rebin.
     """
+    nx = np.shape(array)[0] // oversample
+    ny = np.shape(array)[1] // oversample
+    b = array[:nx*oversample, :ny*oversample].reshape((nx, oversample, ny, oversample) + 
+                                                      np.shape(array)[2:])
+    if weightarray is None:
+        return b.sum(axis=(1,3))
+    return np.einsum('iajb...,ab->ij...', b, weightarray)
 
-    return d.sum(-1).sum(1)
+def weightpixels(array, weightarray):
+    """ bin array by the size of the square intrapixel response weightarray, weighting sub-pixels """
+    if np.shape(weightarray)[0] !=np.shape(weightarray)[1]:
+        raise ValueError("Pixel Weight Array Is Not Square")
+    return binpixels(array, np.shape(weightarray)[0], np.asarray(weightarray, dtype=float))
 
 def pixelpowerprof(s = np.array([3,3]), power = 4, ctr = None ):
     shape = np.array(s)
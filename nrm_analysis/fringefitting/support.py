@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+"""
+Signal-support masks: fit only the pixels that carry fringe signal.
+
+Far from the PSF core the primary beam envelope drops to the noise floor, and
+those pixels add model evaluation and solve time but almost no information.
+support_mask() keeps the pixels
+
+    within radius lambda/d of the psf center (d the hole size), and/or
+    where the envelope exceeds threshold (fraction of its peak), and/or
+    where envelope * image peak exceeds snr * noise
+
+A model made with fov = support_fov(mask) (the smallest centered square around
+the support, same parity as the crop) is exactly the central part of the full
+crop's model, so only that square is evaluated; embed() pads it back to the
+crop size.  Pixels outside the support are NaN'd in the image, so the solvers
+drop them.
+"""
+from __future__ import print_function
+import numpy as np
+from nrm_analysis.misctools import utils
+from . import analyticnrm2
+
+
+def mean_wavelength(bandpass):
+    """ weighted mean wavelength of a (weight, wavelength) bandpass, or the wavelength itself """
+    if hasattr(bandpass, '__iter__'):
+        bandpass = np.asarray(bandpass, dtype=float)
+        return (bandpass[:,0] * bandpass[:,1]).sum() / bandpass[:,0].sum()
+    return bandpass
+
+
+def envelope_image(nrm, fov, lam, psf_offset):
+    """ detector-pixel primary beam at wavelength lam, unit peak """
+    pb = analyticnrm2.primarybeam(nrm.ctrs, lam, 1, nrm.pixel, fov, nrm.d,
+                                  psf_offset=psf_offset, shape=nrm.holeshape,
+                                  affine2d=nrm.affine2d)
+    return pb / pb.max()
+
+
+def support_mask(nrm, fov, bandpass, psf_offset, radius=None, threshold=None,
+                 snr=None, image=None, variance=None):
+    """
+    boolean (fov, fov) support for nrm's mask, pixel scale and hole shape
+    radius: lambda/d, lambda the bandpass mean wavelength
+    threshold: smallest envelope, fraction of peak
+    snr: smallest envelope * image.max() / sigma; sigma from variance if given,
+         else the robust scatter of image pixels where the envelope is < 1e-2
+    Criteria given together must all be met.
+    """
+    lam = mean_wavelength(bandpass)
+    support = np.ones((fov, fov), dtype=bool)
+    if radius is not None:
+        ctr = np.array(utils.centerpoint((fov, fov))) + np.array((psf_offset[1], psf_offset[0]))
+        r0, r1 = np.indices((fov, fov))
+        rpix = radius * lam / nrm.d / nrm.pixel
+        support &= (r0 - ctr[0])**2 + (r1 - ctr[1])**2 <= rpix * rpix
+    if threshold is not None or snr is not None:
+        env = envelope_image(nrm, fov, lam, psf_offset)
+        if threshold is not None:
+            support &= env >= threshold
+        if snr is not None:
+            if variance is not None:
+                sigma = np.sqrt(variance)
+            else:
+                faint = image[(env < 1.0e-2) & ~np.isnan(image)]
+                if len(faint) < 20:
+                    faint = image[~np.isnan(image)]
+                sigma = 1.4826 * np.median(np.abs(faint - np.median(faint)))
+            support &= env * np.nanmax(image) > snr * sigma
+    return support
+
+
+def support_fov(support):
+    """ side of the smallest centered square holding the support, same parity as the array """
+    fov = support.shape[0]
+    rows, cols = np.where(support)
+    c = (fov - 1) // 2
+    half = max(c - rows.min(), rows.max() - c, c - cols.min(), cols.max() - c) if len(rows) else 0
+    if fov % 2:
+        return min(fov, 2*half + 1)
+    return min(fov, 2*half + 2)
+
+
+def embed(model, fov):
+    """ zero-pad a centered (n, n, nslices) model to (fov, fov, nslices) """
+    n = model.shape[0]
+    if n == fov:
+        return model
+    full = np.zeros((fov, fov) + model.shape[2:], dtype=model.dtype)
+    lo = (fov - n) // 2
+    full[lo:lo+n, lo:lo+n] = model
+    return full
@@ -9,6 +9,7 @@ from astropy.table import hstack as tablehstack
 # from astropy.io import fits
 # from scipy.misc import comb
 from uncertainties import unumpy
+from . import fitrecords
 
 class NrmIntegrationResult(object):
     def __init__(self, solutions , closure_quantities , baseline_quantities ):
@@ -169,13 +170,26 @@ class FringeFitterResult(object):
         self.modelsolution_file = sorted(glob.glob(os.path.join(self.data_dir,'%s*.fits' % 'modelsolution_' )));
         self.residual_file   = sorted(glob.glob(os.path.join(self.data_dir,'%s*.fits' % 'residual_' )));
         
-        NINT = len(self.solutions_file)
+        # result store (nrm_core.FringeFitter's default output), if any
+        self.records = None
+        if fitrecords.has_store(self.data_dir):
+            self.records = fitrecords.read_store(self.data_dir)[0]
+            NINT = len(self.records)
+        else:
+            NINT = len(self.solutions_file)
         self.NINT = NINT
 
         # object arrays to hold results of each integration     
-        integration = np.ndarray((self.NINT,),dtype=np.object)
+        integration = np.ndarray((self.NINT,),dtype=object)
 
         for j,file_number in enumerate(np.arange(self.NINT)):
+            if self.records is not None:
+                rec = self.records[j]
+                solutions = Table([rec['soln']], names=('soln',))
+                closure_quantities = Table([rec['cas'], rec['cps']], names=('closure_amplitude', 'closure_phase'))
+                baseline_quantities = Table([rec['amplitudes'], rec['phases']], names=('fringe_amplitude', 'fringe_phase'))
+                integration[j] = NrmIntegrationResult( solutions , closure_quantities , baseline_quantities )
+                continue
             solutions = Table.read(self.solutions_file[file_number],format='ascii.no_header', guess=False,names=({'soln'}))
             CA = Table.read(self.CA_file[file_number],format='ascii.no_header',names=({'closure_amplitude'}))
             CP = Table.read(self.CP_file[file_number],format='ascii.no_header',names=({'closure_phase'}))
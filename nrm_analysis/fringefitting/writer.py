@@ -0,0 +1,105 @@
+#! /usr/bin/env python
+"""
+FitsWriter: background writer for FringeFitter's diagnostic FITS images.
+
+Fitting hands finished HDUs to put() and goes on to the next slice; a thread
+writes them out in batches of up to 'batch'.  The queue holds at most
+'maxsize' images: put() blocks while it is full, so a slow disk slows the
+fitting down instead of filling memory.  flush() waits until everything
+queued is on disk, close() drains and stops the thread.  Write errors are
+raised by the next put(), flush() or close().
+
+fits_writer() returns this process's writer (pool workers each get their
+own), drained when the process exits.
+"""
+from __future__ import print_function
+import os
+import threading
+import queue
+from multiprocessing import util
+import numpy as np
+from astropy.io import fits
+
+_writers = {} # per-process writer, by pid
+
+
+class FitsWriter(object):
+
+    def __init__(self, maxsize=16, batch=4):
+        """
+        maxsize: images queued before put() blocks
+        batch:   images written per wakeup of the writer thread
+        """
+        self.maxsize = maxsize
+        self.batch = batch
+        self.queue = queue.Queue(maxsize)
+        self.errors = []
+        self.thread = None
+        self.pid = None
+
+    def put(self, path, data, header=None):
+        """ queue data (copied) as the primary image of FITS file path """
+        self.check()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="FitsWriter", daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+        hdu = fits.PrimaryHDU(data=np.array(data), header=header)
+        self.queue.put((path, hdu))
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.batch:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in items:
+                if item is not None:
+                    self.write(*item)
+                self.queue.task_done()
+            if None in items:
+                return
+
+    def write(self, path, hdu):
+        # temporary file then rename: readers never see a partial image
+        try:
+            hdu.writeto(path + ".part", overwrite=True)
+            os.replace(path + ".part", path)
+        except Exception as e:
+            self.errors.append(e)
+
+    def check(self):
+        if self.errors:
+            error, self.errors = self.errors[0], []
+            raise error
+
+    def running(self):
+        # a forked child inherits the object but not the thread
+        return self.thread is not None and self.pid == os.getpid()
+
+    def flush(self):
+        """ wait until every queued image is written """
+        if self.running():
+            self.queue.join()
+        self.check()
+
+    def close(self):
+        """ write everything queued and stop the writer thread """
+        if self.running():
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.check()
+
+
+def fits_writer():
+    """ this process's FitsWriter, started on first use """
+    pid = os.getpid()
+    if pid not in _writers:
+        _writers.clear() # a forked child must not use its parent's thread
+        _writers[pid] = FitsWriter()
+        # runs at interpreter exit, and as pool workers exit
+        util.Finalize(None, _writers[pid].close, exitpriority=10)
+    return _writers[pid]
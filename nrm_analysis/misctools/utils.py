@@ -437,13 +437,15 @@ def crosscorrelatePSFs(a, A, ov, verbose=False):
 #    print("deprecated - switch to using  'center_imagepeak'")
 #    return center_imagepeak(img, r='default')
        
-def center_imagepeak(img, r='default', cntrimg = True):
+def center_imagepeak(img, r='default', cntrimg = True, box=False):
 
     """Return a cropped version of the input image centered on the peak pixel.
 
     Parameters
     ----------
     img : numpy input array
+    box : also return the crop as a tuple of slices, to crop eg a variance
+          image the same way
 
     Returns
     -------
@@ -457,10 +459,13 @@ def center_imagepeak(img, r='default', cntrimg = True):
     else:
         pass
 
-    cropped = img[int(peakx-r):int(peakx+r+1), int(peaky-r):int(peaky+r+1)]
+    crop = (slice(int(peakx-r), int(peakx+r+1)), slice(int(peaky-r), int(peaky+r+1)))
+    cropped = img[crop]
     print('Cropped image shape:',cropped.shape)
     print('value at center:', cropped[r,r])
     print(np.where(cropped == cropped.max()))
+    if box:
+        return cropped, crop
     return cropped
 
 
@@ -876,9 +881,16 @@ def fringes2pistons(fringephases, nholes):
     input: 1D array of fringe phases, and number of holes
     returns: pistons in same units as fringe phases
     """
-    Anrm = makeA(nholes)
-    Apinv = np.linalg.pinv(Anrm)
-    return np.dot(Apinv, fringephases)
+    return np.dot(makeA_pinv(nholes), fringephases)
+
+
+_makeA_pinv = {}  # per-process pinv(makeA(nh)), by nh
+
+def makeA_pinv(nh):
+    """ pseudo-inverse of makeA(nh), computed once per nh """
+    if nh not in _makeA_pinv:
+        _makeA_pinv[nh] = np.linalg.pinv(makeA(nh))
+    return _makeA_pinv[nh]
 
 def makeK(nh, verbose=False):
     """ 
@@ -925,8 +937,8 @@ def makeK(nh, verbose=False):
         """
 
     print("\nmakeK(): ")
-    nrow = comb(nh, 3)
-    ncol = nh*(nh-1)/2
+    nrow = int(comb(nh, 3))
+    ncol = nh*(nh-1)//2
 
     # first define the row selectors
     # k is a list that looks like [9, 9+8, 9+8+7, 9+8+7+6, 9+8+7+6+5, ...] 
@@ -1090,6 +1102,51 @@ def  rebin(a = None, rc=(2,2), verbose=None):  # Thinly-wrapped krebin
     return krebin(a, (a.shape[0]//rc[0],a.shape[1]//rc[1]))
 
 
+# Threads and tile size (rows) for fromfunction_threaded.  Set with
+# set_fromfunction_threads(), eg set_fromfunction_threads(32) on a 32-core node
+# for a single exposure.  Keep 1 thread in multiprocessing pool workers.
+FROMFUNCTION_THREADS = 1
+FROMFUNCTION_TILE = 32
+_fromfunction_pool = (None, None, None) # (pid, nthreads, ThreadPoolExecutor)
+
+def set_fromfunction_threads(nthreads=None, tilerows=None):
+    """ nthreads: worker threads (None: os.cpu_count()), tilerows: array rows per tile """
+    global FROMFUNCTION_THREADS, FROMFUNCTION_TILE
+    FROMFUNCTION_THREADS = nthreads if nthreads is not None else os.cpu_count()
+    if tilerows is not None:
+        FROMFUNCTION_TILE = tilerows
+
+
+def fromfunction_threaded(function, shape, **kwargs):
+    """
+    Drop-in replacement for np.fromfunction(function, shape, **kwargs) for 2-d 
+    elementwise kernels (Jinc, gfunction, interf, ffc...).  The array is made in 
+    tiles of FROMFUNCTION_TILE rows, evaluated concurrently by FROMFUNCTION_THREADS
+    threads (numpy ufuncs release the GIL).  Each tile gets the same float index
+    values np.fromfunction would pass, so results are bit-identical.
+    """
+    global _fromfunction_pool
+    nrows = shape[0]
+    tile = max(1, int(FROMFUNCTION_TILE))
+    if FROMFUNCTION_THREADS <= 1 or nrows <= tile:
+        return np.fromfunction(function, shape, **kwargs)
+
+    def evaluate(r0):
+        kx, ky = np.indices((min(tile, nrows - r0), shape[1]), dtype=float)
+        kx += r0
+        return function(kx, ky, **kwargs)
+
+    pid, nthreads, executor = _fromfunction_pool
+    if pid != os.getpid() or nthreads != FROMFUNCTION_THREADS: # eg forked into a pool worker
+        from concurrent.futures import ThreadPoolExecutor
+        if pid == os.getpid():
+            executor.shutdown() # thread count changed: stop the old threads
+        executor = ThreadPoolExecutor(max_workers=FROMFUNCTION_THREADS)
+        _fromfunction_pool = (os.getpid(), FROMFUNCTION_THREADS, executor)
+    tiles = list(executor.map(evaluate, range(0, nrows, tile)))
+    return np.concatenate(tiles, axis=0)
+
+
 # used in NRM_Model.py
 def rcrosscorrelate(a=None, b=None, verbose=True):
 
@@ -29,6 +29,7 @@ BinaryAnalyze - Detection, mcmc modeling, visualization tools
 from __future__ import print_function
 # Standard imports
 import os, sys, time
+import queue
 import numpy as np
 from astropy.io import fits
 from scipy.special import comb
@@ -40,12 +41,15 @@ import matplotlib.pyplot as plt
 
 # Module imports
 from nrm_analysis.fringefitting.LG_Model import NRM_Model
+from nrm_analysis.fringefitting.modelcache import ModelCache
+from nrm_analysis.fringefitting import offsetgrid, noise, support, leastsqnrm, fitrecords, writer
+from nrm_analysis.fringefitting.bandpass import compress_bandpass, max_opd
 from nrm_analysis.misctools import utils  # AS LG++
 from nrm_analysis.misctools.utils import mas2rad, baselinify, rad2mas
 from nrm_analysis.modeling.binarymodel import model_cp_uv, model_allvis_uv, model_v2_uv, model_t3amp_uv
 from nrm_analysis.modeling.multimodel import model_bispec_uv
 
-from multiprocessing import Pool
+from multiprocessing import Pool, Barrier, RLock, shared_memory, resource_tracker
 
 class FringeFitter:
     def __init__(self, instrument_data, **kwargs):
@@ -66,8 +70,97 @@ class FringeFitter:
         debug - will plot the FT of your data next to the FT of a reference PSF.
                 Needs poppy package to run
         verbose_save - saves more than the standard files
+        text_output - also write the per-slice text files (solutions_NN.txt, phases_NN.txt,
+                     amplitudes_NN.txt, CPs_NN.txt, CAs_NN.txt, and the optional 
+                     outputs).  Every exposure's results are always written to one 
+                     fitrecords.STORE_NAME table (one row per integration) in its 
+                     output directory.  Default False
+        diagnostics - per-slice FITS images: "none", "residual" (residual_NN.fits) or
+                     "all" (also centered_N.fits and modelsolution_NN.fits).  Handed
+                     to a background writer (writer.fits_writer()), so fitting does
+                     not wait on the disk; all written by the time fit_fringes returns.
+                     Default "all", or "none" with save_txt_only
         interactive - default True, prompts user to overwrite/create fresh directory.  
                       False will overwrite files where necessary.
+        modelcache - reuse fringe models across slices and files with identical
+                     geometry, bandpass and psf offset.  A directory name (shared
+                     by the worker processes, persists between runs), True for an
+                     in-memory cache only, or a ModelCache instance.  Default None.
+        model_offset_step - if set (detector pixels, eg 1/16), interpolate each slice's
+                     model from models precomputed on a lattice of psf offsets
+                     instead of building it exactly.  Each worker process keeps up to
+                     offsetgrid.GRID_MEMSIZE bytes of them.  The lattice models are built
+                     with model_fouriershift, model_smeared and model_maxbytes.
+                     A pool's workers build and verify each lattice once between them
+                     through the modelcache's directory: without one, threads > 0 
+                     uses savedir/offsetgrid_models.  Default None (exact models)
+        model_offset_tol - interpolation accuracy, fraction of the model peak, checked
+                     against the exact model (lattice refined until met).  Default 1e-3
+        model_fouriershift - build models at zero psf offset once and move them to each
+                     slice's offset with a Fourier shift (see NRM_Model.make_model).
+                     Uses the modelcache, an in-memory one if none given; each worker
+                     holds its own oversampled zero-offset model there (~400 MB at
+                     npix 81, oversample 11).  Default False
+        bandpass_nodes - compress polychromatic bandpasses to this many quadrature nodes
+                     before building models (see fringefitting/bandpass.py).  The
+                     error bound is printed per slice.  Default None (full bandpass)
+        bandpass_method - "moments" (default) or "legendre" quadrature
+        model_smeared - quick-look polychromatic models: fringes at the mean wavenumber
+                     with an analytic bandwidth-smearing envelope.  Default False
+        model_maxbytes - build models in detector-row blocks binned as they are made,
+                     never holding the oversampled model cube; working memory stays
+                     near this many bytes.  Default None (whole cube)
+        precision - np.float32 builds and stores models in single precision (see 
+                     NRM_Model) and solves in single precision with float64 refinement
+                     of the coefficients
+                     (leastsqnrm.precision_report compares its closure phases with
+                     the float64 path).  Default np.float64
+        tabulated_envelope - interpolate primary beams from a per-process table in
+                     dimensionless (d/lambda) theta coordinates, accurate to 1e-6
+                     of peak, instead of evaluating Jinc/hex transforms.  Default False
+        pixweight - (oversample, oversample) intrapixel response weighting the 
+                     oversampled model as it is binned to detector pixels.  
+                     Default None (uniform)
+        covariance - also fit with photon-noise weights and keep the covariance matrices 
+                     of fringe phases, fringe amplitudes, CPs and CAs in the result 
+                     store's records (phases_cov, amplitudes_cov, cps_cov, cas_cov).
+                     With text_output they are also written to *_cov_NN.txt, and the
+                     coefficient covariance to linearfit_result_NN.pkl.  Default False
+        noise_model - weighted fits with 1/sigma weights from a noise model
+                     (fringefitting.noise): PhotonNoise(gain, readnoise), 
+                     VarianceMap(variance) or JWSTErrDQ() for the ERR/DQ 
+                     extensions of JWST files.  Default None (unweighted)
+        clip_sigma - reject residual outliers (hot pixels, cosmic rays) above this
+                     many sigma and refit, up to clip_iterations (default 5) times.
+                     Rejected pixels are saved in rejected_NN.txt.  Default None
+        support_radius, support_threshold, support_snr - fit only pixels within
+                     support_radius lambda/d of the psf center, and/or where the
+                     envelope is above support_threshold of its peak, and/or where
+                     envelope * image peak > support_snr * noise (fringefitting.support).
+                     Models are only made for the centered square around these
+                     pixels.  Default None (whole crop)
+        fit_offset - number of Gauss-Newton steps fitting a psf offset correction to
+                     the centroid jointly with the fringe coefficients, from analytic
+                     model derivatives (NRM_Model.make_derivatives); the fitted offset
+                     is saved in psf_offset_NN.txt.  Default 0 (centroid offset held)
+        joint_channels - fit all the wavelength channels of a spectral cube (eg GPI
+                     PRISM) together: one centroid from the collapsed cube, every
+                     channel's model from one batched call sharing the geometry
+                     (NRM_Model.make_channel_models), and one batched solve 
+                     (leastsqnrm.channel_operations).  Not with clip_sigma, 
+                     support_*, fit_offset, covariance, model_offset_step,
+                     model_fouriershift, model_smeared, model_maxbytes or modelcache.  
+                     Default False (channels fitted independently)
+        fit_fringes(fns, threads>0) fits slices in a pool of threads worker processes
+        that is kept for later files (and fit_fringes calls) until close_pool().
+        Each file's cube is put in shared memory once; tasks carry only the slice
+        index and a small record.  Workers get the FringeFitter's options when 
+        the pool starts, so close_pool() after changing them.
+        kernel_threads - threads evaluating each analytic kernel (Jinc, hex, fringes)
+                     in tiles of kernel_tile rows (default 32); results are identical
+                     to the unthreaded ones.  Worth setting when fitting one slice at a
+                     time on a many-core node, leave at 1 with fit_fringes(threads>0).
+                     Default 1
 
         auto_pixscale - will search for the best pixel scale value for your data given instrument geometry
         auto_rotate - will search for the best rotation value for your data given instrument geometry
@@ -125,10 +218,123 @@ class FringeFitter:
             self.interactive = kwargs['interactive']
         else:
             self.interactive = True
+        if "text_output" in kwargs:
+            self.text_output = kwargs["text_output"]
+        else:
+            self.text_output = False
         if "save_txt_only" in kwargs:
             self.save_txt_only = kwargs["save_txt_only"]
         else:
             self.save_txt_only = False
+        if "diagnostics" in kwargs:
+            self.diagnostics = kwargs["diagnostics"]
+        elif self.save_txt_only:
+            self.diagnostics = "none"
+        else:
+            self.diagnostics = "all"
+        if self.diagnostics not in ("none", "residual", "all"):
+            raise ValueError("diagnostics must be 'none', 'residual' or 'all'")
+        if "modelcache" in kwargs:
+            if isinstance(kwargs["modelcache"], ModelCache) or kwargs["modelcache"] is None:
+                self.modelcache = kwargs["modelcache"]
+            elif kwargs["modelcache"] is True:
+                self.modelcache = ModelCache()
+            else:
+                self.modelcache = ModelCache(cachedir=kwargs["modelcache"])
+        else:
+            self.modelcache = None
+        if "model_offset_step" in kwargs:
+            self.model_offset_step = kwargs["model_offset_step"]
+        else:
+            self.model_offset_step = None
+        if "model_offset_tol" in kwargs:
+            self.model_offset_tol = kwargs["model_offset_tol"]
+        else:
+            self.model_offset_tol = 1.0e-3
+        if "model_fouriershift" in kwargs:
+            self.model_fouriershift = kwargs["model_fouriershift"]
+        else:
+            self.model_fouriershift = False
+        if self.model_fouriershift and self.modelcache is None:
+            self.modelcache = ModelCache()
+        if "bandpass_nodes" in kwargs:
+            self.bandpass_nodes = kwargs["bandpass_nodes"]
+        else:
+            self.bandpass_nodes = None
+        if "bandpass_method" in kwargs:
+            self.bandpass_method = kwargs["bandpass_method"]
+        else:
+            self.bandpass_method = "moments"
+        if "model_smeared" in kwargs:
+            self.model_smeared = kwargs["model_smeared"]
+        else:
+            self.model_smeared = False
+        if "model_maxbytes" in kwargs:
+            self.model_maxbytes = kwargs["model_maxbytes"]
+        else:
+            self.model_maxbytes = None
+        if "precision" in kwargs:
+            self.precision = kwargs["precision"]
+        else:
+            self.precision = np.float64
+        if "tabulated_envelope" in kwargs:
+            self.tabulated_envelope = kwargs["tabulated_envelope"]
+        else:
+            self.tabulated_envelope = False
+        if "pixweight" in kwargs:
+            self.pixweight = kwargs["pixweight"]
+        else:
+            self.pixweight = None
+        if "covariance" in kwargs:
+            self.covariance = kwargs["covariance"]
+        else:
+            self.covariance = False
+        if "noise_model" in kwargs:
+            self.noise_model = kwargs["noise_model"]
+        else:
+            self.noise_model = None
+        if "clip_sigma" in kwargs:
+            self.clip_sigma = kwargs["clip_sigma"]
+        else:
+            self.clip_sigma = None
+        if "clip_iterations" in kwargs:
+            self.clip_iterations = kwargs["clip_iterations"]
+        else:
+            self.clip_iterations = 5
+        for key in ("support_radius", "support_threshold", "support_snr"):
+            if key in kwargs:
+                setattr(self, key, kwargs[key])
+            else:
+                setattr(self, key, None)
+        if "fit_offset" in kwargs:
+            self.fit_offset = kwargs["fit_offset"]
+        else:
+            self.fit_offset = 0
+        if "joint_channels" in kwargs:
+            self.joint_channels = kwargs["joint_channels"]
+        else:
+            self.joint_channels = False
+        if self.joint_channels:
+            # per-slice fit options, and make_model options the channel models don't have
+            perslice = [key for key in ("clip_sigma", "support_radius", "support_threshold", 
+                        "support_snr", "fit_offset", "covariance", "model_offset_step",
+                        "model_fouriershift", "model_smeared", "model_maxbytes", "modelcache")
+                        if getattr(self, key)]
+            if perslice:
+                raise ValueError("joint_channels cannot be used with {0}".format(", ".join(perslice)))
+        self._pool = None
+        self._barrier = None
+        self._gridlock = None
+        self._poolsize = 0
+        self.results = {}
+        if "kernel_threads" in kwargs:
+            self.kernel_threads = kwargs["kernel_threads"]
+        else:
+            self.kernel_threads = 1
+        if "kernel_tile" in kwargs:
+            self.kernel_tile = kwargs["kernel_tile"]
+        else:
+            self.kernel_tile = 32
         #######################################################################
 
 
@@ -173,44 +379,110 @@ class FringeFitter:
     # May 2017 J Sahlmann updates: parallelized fringe-fitting!
     ###
 
-    def fit_fringes(self, fns, threads = 0):
+    def __getstate__(self):
+        # Workers get the options once, at pool start; never the pool or a file's data
+        state = self.__dict__.copy()
+        for key in ("_pool", "_barrier", "_gridlock", "scidata", "variance", "scihdr", "ctrd", "results"):
+            state.pop(key, None)
+        state["_poolsize"] = 0
+        return state
+
+    def worker_pool(self, threads):
+        """ this FringeFitter's pool of threads worker processes, started if needed """
+        if self._pool is not None and self._poolsize != threads:
+            self.close_pool()
+        if self._pool is None:
+            # workers must share this process's tracker, or theirs unlink the shared cubes
+            resource_tracker.ensure_running()
+            if self.model_offset_step is not None and \
+               (self.modelcache is None or self.modelcache.cachedir is None):
+                # workers share offset grid lattices through the disk tier
+                self.modelcache = ModelCache(cachedir=os.path.join(self.savedir, "offsetgrid_models"))
+            self._barrier = Barrier(threads)
+            self._gridlock = RLock()
+            self._pool = Pool(processes=threads, initializer=init_worker, 
+                              initargs=(self, self._barrier, self._gridlock))
+            self._poolsize = threads
+        return self._pool
+
+    def flush_output(self):
+        """ wait for the diagnostic images queued here and in the pool workers """
+        writer.fits_writer().flush()
+        if self._pool is not None:
+            # one task per worker: each waits at the barrier until all have flushed
+            self._pool.map(flush_worker, range(self._poolsize), chunksize=1)
+
+    def close_pool(self):
+        """ stop the worker pool (its workers drain their writers), if any """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._barrier = None
+            self._gridlock = None
+            self._poolsize = 0
+
+    def fit_fringes(self, fns, threads = 0, file_done=None):
+        """
+        Fit every slice of every file in fns.  With threads > 0 the slices of
+        all the files go through one queue to the worker pool (fit_fringes_scheduled),
+        so short files do not leave workers idle; each file is finished (shared 
+        memory released, reported, file_done(filename, outdir, records) called 
+        if given) as soon as its last slice is done.
+        self.results[filename] is each file's fitrecords structured array, one 
+        record per slice (fit results, centroid, chi2, timing).
+        """
         if type(fns) == str:
             fns = [fns, ]
+        self.results = {}
+
+        t2 = time.time()
+        if threads > 0 and not self.joint_channels:
+            fit_fringes_scheduled(self, fns, threads, file_done=file_done)
+            self.flush_output()
+            print("Parallel with {0} threads took {1}s to fit all fringes".format(\
+                   threads, time.time()-t2))
+            return
 
         # Can get fringes for images in parallel
         #tore_dict = [{"object":self, "file":self.datadir+"/"+fn,"id":jj} \ # AS remove self.datadir
         store_dict = [{"object":self, "file":                 fn,"id":jj} \
                         for jj,fn in enumerate(fns)]
 
-        t2 = time.time()
         for jj, fn in enumerate(fns):
             #it_fringes_parallel({"object":self, "file": self.datadir+"/"+fn,\ # AS remove self.datadir
-            fit_fringes_parallel({"object":self, "file":                  fn,\
+            self.results[fn] = fit_fringes_parallel({"object":self, "file":                  fn,\
                                   "id":jj}, threads)
+            self.flush_output()
+            if file_done is not None:
+                file_done(fn, self.savedir+self.sub_dir_str, self.results[fn])
         t3 = time.time()
         print("Parallel with {0} threads took {1}s to fit all fringes".format(\
                threads, t3-t2))
 
 
-    def save_output(self, slc, nrm):
-        # cropped & centered PSF
-        if self.save_txt_only==False:
-            fits.PrimaryHDU(data=self.ctrd, \
-                    header=self.scihdr).writeto(self.savedir+\
-                    self.sub_dir_str+"/centered_{0}.fits".format(slc), \
-                    overwrite=True)
-
+    def save_store(self, filename, outdir, records, header=None):
+        """ write an exposure's fit records to its result store (fitrecords.write_store) """
+        meta = {"FILENAME": os.path.basename(str(filename)), "OVERSAMP": self.oversample,
+                "HOLESHAP": self.instrument_data.holeshape, 
+                "PIXSCALE": (self.instrument_data.pscale_rad, "rad"),
+                "COVAR": bool(self.covariance)}
+        return fitrecords.write_store(outdir, records, header=header, meta=meta)
+
+    def save_diagnostics(self, slc, nrm):
+        """ queue the slice's diagnostics images with this process's background writer """
+        out = writer.fits_writer()
+        # put() blocks only while the writer's queue is full
+        out.put(self.savedir+self.sub_dir_str+"/residual_{0:02d}.fits".format(slc), nrm.residual)
+        if self.diagnostics == "all":
+            # cropped & centered PSF
+            out.put(self.savedir+self.sub_dir_str+"/centered_{0}.fits".format(slc), 
+                    self.ctrd, header=self.scihdr)
             model, modelhdu = nrm.plot_model(fits_true=1)
-            # save to fits files
-            fits.PrimaryHDU(data=nrm.residual).writeto(self.savedir+\
-                        self.sub_dir_str+"/residual_{0:02d}.fits".format(slc), \
-                        overwrite=True)
-            modelhdu.writeto(self.savedir+\
-                        self.sub_dir_str+"/modelsolution_{0:02d}.fits".format(slc),\
-                        overwrite=True)
-        else:
-            print("NOT SAVING ANY FITS FILES. SET save_txt_only=False TO SAVE.")
+            out.put(self.savedir+self.sub_dir_str+"/modelsolution_{0:02d}.fits".format(slc), 
+                    model)
 
+    def save_output(self, slc, nrm):
         # default save to text files
         np.savetxt(self.savedir+self.sub_dir_str+\
                    "/solutions_{0:02d}.txt".format(slc), nrm.soln)
@@ -229,6 +501,17 @@ class FringeFitter:
                        "/condition_{0:02d}.txt".format(slc), nrm.cond)
             np.savetxt(self.savedir+self.sub_dir_str+\
                        "/flux_{0:02d}.txt".format(slc), nrm.flux)
+        if self.fit_offset:
+            np.savetxt(self.savedir+self.sub_dir_str+\
+                       "/psf_offset_{0:02d}.txt".format(slc), nrm.psf_offset_fit)
+        if nrm.rejected is not None:
+            np.savetxt(self.savedir+self.sub_dir_str+\
+                       "/rejected_{0:02d}.txt".format(slc), np.argwhere(nrm.rejected), fmt="%d")
+        if self.covariance:
+            for name, cov in (("phases", nrm.fringephase_cov), ("amplitudes", nrm.fringeamp_cov),
+                              ("CPs", nrm.cp_cov), ("CAs", nrm.ca_cov)):
+                np.savetxt(self.savedir+self.sub_dir_str+\
+                           "/{0}_cov_{1:02d}.txt".format(name, slc), cov)
           
         print(nrm.linfit_result)
         if nrm.linfit_result is not None:          
@@ -252,11 +535,11 @@ class FringeFitter:
             plt.savefig(self.savedir+self.sub_dir_str+\
                         "/rotationcorrelation_{0:02d}.png".format(slc))
 
-def fit_fringes_parallel(args, threads):
-    self = args['object']
-    filename = args['file']
-    id_tag = args['id']
+def load_file(self, filename):
+    """ read filename's science data (and noise model variance) into self, make its output directory """
     self.scidata, self.scihdr = self.instrument_data.read_data(filename)
+    if self.noise_model is not None:
+        self.variance = self.noise_model.variance(self.scidata, filename)
 
     self.sub_dir_str = self.instrument_data.sub_dir_str
     try:
@@ -264,39 +547,273 @@ def fit_fringes_parallel(args, threads):
     except:
         pass
 
-    store_dict = [{"object":self, "slc":slc} for slc in \
-                  range(self.instrument_data.nwav)]
+def share_file(self):
+    """ 
+    put the loaded file's cube (and variance, and header as FITS card text) in 
+    shared memory: returns the SharedMemory blocks and one fit_fringes_shared 
+    task per slice, each holding only records of the shared arrays
+    """
+    shared = {"scidata":share_array(self.scidata), "variance":None, "scihdr":None}
+    if self.noise_model is not None:
+        shared["variance"] = share_array(self.variance)
+    if isinstance(self.scihdr, fits.Header):
+        shared["scihdr"] = share_array(np.frombuffer(self.scihdr.tostring().encode(), 
+                                                     dtype=np.uint8))
+    records = dict((key, None if sh is None else sh[1]) for key, sh in shared.items())
+    tasks = [dict(records, slc=slc, bandpass=self.instrument_data.wls[slc],
+                  sub_dir_str=self.sub_dir_str)
+             for slc in range(self.instrument_data.nwav)]
+    return [sh[0] for sh in shared.values() if sh is not None], tasks
+
+def release(blocks):
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
+
+def fit_fringes_parallel(args, threads):
+    """ 
+    fit every slice of args['file'] and write its result store; returns its records.
+    threads > 0 (not joint_channels) goes through fit_fringes_scheduled, the one pool path.
+    """
+    self = args['object']
+    filename = args['file']
+    id_tag = args['id']
+    if threads>0 and not self.joint_channels:
+        fit_fringes_scheduled(self, [filename], threads)
+        return self.results[filename]
+
+    load_file(self, filename)
+    if self.joint_channels:
+        records = fit_fringes_channels(self)
+    else:
+        records = fitrecords.gather([fit_fringes_single_integration({"object":self, "slc":slc})
+                                     for slc in range(self.instrument_data.nwav)])
+    self.save_store(filename, self.savedir+self.sub_dir_str, records, self.scihdr)
+    return records
 
-    if threads>0:
-        pool = Pool(processes=threads)
-        print("Running fit_fringes in parallel with {0} threads".format(threads))
-        pool.map(fit_fringes_single_integration, store_dict)
-        pool.close()
-        pool.join()
+def fit_fringes_scheduled(self, fns, threads, file_done=None, backlog=2):
+    """
+    Fit all the slices of all the files fns in self's worker pool as one queue
+    of (file, slice) tasks.  Files are read and shared only as the queue needs
+    them, keeping about backlog tasks per worker queued; a file is finished
+    (its shared memory released, its records gathered into self.results[filename]
+    and written to its result store, reported, and file_done(filename, outdir, 
+    records) called unless a slice failed) when its last slice completes, 
+    whatever the order.  After a failure no more files are started, and the first failed
+    slice's exception is raised once the submitted work is done.
+    """
+    pool = self.worker_pool(threads)
+    print("Running fit_fringes on {0} files in parallel with {1} threads".format(len(fns), threads))
+    done = queue.Queue()
+    files = {}
+    errors = []
+    inflight = 0
+    nextfile = 0
+    t0 = time.time()
+    try:
+        while nextfile < len(fns) or inflight:
+            while nextfile < len(fns) and inflight < backlog*threads and not errors:
+                load_file(self, fns[nextfile])
+                blocks, tasks = share_file(self)
+                files[nextfile] = {"blocks":blocks, "remaining":len(tasks), "failed":0,
+                                   "outdir":self.savedir+self.sub_dir_str, "records":[],
+                                   "scihdr":self.scihdr}
+                for task in tasks:
+                    pool.apply_async(fit_fringes_shared, (task,),
+                                     callback=lambda r, jj=nextfile: done.put((jj, r, None)),
+                                     error_callback=lambda e, jj=nextfile: done.put((jj, None, e)))
+                inflight += len(tasks)
+                nextfile += 1
+            if not inflight:
+                break
+            jj, record, err = done.get()
+            inflight -= 1
+            if err is not None:
+                errors.append(err)
+                files[jj]["failed"] += 1
+            else:
+                files[jj]["records"].append(record)
+            files[jj]["remaining"] -= 1
+            if files[jj]["remaining"] == 0:
+                entry = files.pop(jj)
+                release(entry["blocks"])
+                status = "done" if not entry["failed"] else \
+                         "FAILED in {0} slices".format(entry["failed"])
+                print("fit_fringes: {0} {1} ({2}/{3} files, {4:.1f}s)".format(fns[jj], status,
+                      nextfile - len(files), len(fns), time.time()-t0))
+                if not entry["failed"]:
+                    self.results[fns[jj]] = fitrecords.gather(entry["records"])
+                    self.save_store(fns[jj], entry["outdir"], self.results[fns[jj]], entry["scihdr"])
+                    if file_done is not None:
+                        file_done(fns[jj], entry["outdir"], self.results[fns[jj]])
+    finally:
+        # on interrupt or a file_done error, wait for submitted slices before unlinking
+        while inflight:
+            done.get()
+            inflight -= 1
+        for entry in files.values():
+            release(entry["blocks"])
+    if errors:
+        raise errors[0]
+
+# Per-process worker state: the pool's FringeFitter and the attached shared arrays
+_worker = {"fitter": None, "barrier": None, "attached": {}}
+
+def share_array(array):
+    """ copy array into new shared memory: returns the SharedMemory and its (name, shape, dtype) record """
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def attach_array(record):
+    """ read-only view of a share_array() record's array, attached once per worker """
+    name, shape, dtype = record
+    attached = _worker["attached"]
+    if name not in attached:
+        shm = shared_memory.SharedMemory(name=name)
+        view = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        view.flags.writeable = False
+        attached[name] = (shm, view)
+    return attached[name][1]
+
+def detach_arrays(keep):
+    """ detach this worker's shared arrays other than those named in keep (earlier files') """
+    attached = _worker["attached"]
+    for name in [name for name in attached if name not in keep]:
+        shm, view = attached.pop(name)
+        del view
+        try:
+            shm.close()
+        except BufferError: # a view is still referenced; unmapped when it goes
+            pass
+
+def init_worker(fitter, barrier, gridlock):
+    """ pool initializer: keep the FringeFitter (options only), the pool's flush barrier
+    and its offset grid build lock in this worker """
+    _worker["fitter"] = fitter
+    _worker["barrier"] = barrier
+    _worker["attached"] = {}
+    offsetgrid.set_build_lock(gridlock)
+
+def flush_worker(ii):
+    """ pool task: write this worker's queued images, then wait for the other workers' """
+    writer.fits_writer().flush()
+    _worker["barrier"].wait()
+
+def fit_fringes_shared(args):
+    """ pool task: fit slice args["slc"] of the shared cube described by args """
+    self = _worker["fitter"]
+    records = [rec for rec in (args["scidata"], args["variance"], args["scihdr"]) 
+               if rec is not None]
+    if any(rec[0] not in _worker["attached"] for rec in records):
+        self.scidata = self.variance = self.ctrd = None # release the last file's views
+        detach_arrays([rec[0] for rec in records])
+        # header parsed once per file
+        self.scihdr = None if args["scihdr"] is None else \
+            fits.Header.fromstring(attach_array(args["scihdr"]).tobytes().decode())
+    self.scidata = attach_array(args["scidata"])
+    if args["variance"] is not None:
+        self.variance = attach_array(args["variance"])
+    self.sub_dir_str = args["sub_dir_str"]
+    return fit_fringes_single_integration({"object":self, "slc":args["slc"],
+                                           "bandpass":args["bandpass"]})
+
+def new_model(self):
+    """ NRM_Model for the instrument data with the FringeFitter's model options """
+    return NRM_Model(mask=self.instrument_data.mask,
+                    pixscale=self.instrument_data.pscale_rad,
+                    holeshape=self.instrument_data.holeshape,
+                    affine2d=self.instrument_data.affine2d,
+                    over = self.oversample,
+                    modelcache = self.modelcache,
+                    precision = self.precision,
+                    tabulated_envelope = self.tabulated_envelope,
+                    pixweight = self.pixweight)
+
+def center_crop(self, image):
+    """ image cropped and centered on its peak pixel, and the crop's (slice, slice) """
+    if self.instrument_data.arrname=="NIRC2_9NRM":
+        return utils.center_imagepeak(image, 
+                        r = (self.npix -1)//2 - 2, cntrimg=False, box=True)  
+    elif self.instrument_data.arrname=="gpi_g10s40":
+        return utils.center_imagepeak(image, 
+                        r = (self.npix -1)//2 - 2, cntrimg=True, box=True)  
+    return utils.center_imagepeak(image, box=True)  
 
+def fit_fringes_channels(self):
+    """
+    joint_channels: fit all the channels of self.scidata together.  The crop
+    and centroid come from the collapsed cube, the channel models from one 
+    make_channel_models() call, and the solutions from one batched solve.
+    Each channel's results are saved as fit_fringes_single_integration's.
+    Returns the channels' fitrecords, ordered by channel.
+    """
+    t0 = time.time()
+    utils.set_fromfunction_threads(self.kernel_threads, self.kernel_tile)
+    nrm = new_model(self)
+    if self.npix == 'default':
+        self.npix = self.scidata.shape[1]
+
+    collapsed, crop = center_crop(self, np.nansum(self.scidata, axis=0))
+    cube = self.scidata[:, crop[0], crop[1]]
+    weights = None
+    if self.noise_model is not None:
+        weights = noise.weights(self.variance[:, crop[0], crop[1]])
+
+    centroid = utils.find_centroid(collapsed, self.instrument_data.threshold) # offsets from array ctr
+    print(">>>> nrm_core: centroid offsets {0} from the collapsed cube <<<<".format(centroid))
+    nrm.xpos = centroid[1]  # flip 0 and 1, as fit_fringes_single_integration
+    nrm.ypos = centroid[0]
+    if self.hold_centering == False:
+        nrm.bestcenter = nrm.xpos, nrm.ypos
     else:
-        for slc in range(self.instrument_data.nwav):
-            fit_fringes_single_integration({"object":self, "slc":slc})
+        nrm.bestcenter = self.psf_offset
+
+    bandpasses = [self.instrument_data.wls[slc] for slc in range(self.instrument_data.nwav)]
+    if self.bandpass_nodes is not None:
+        bandpasses = [compress_bandpass(bp, nodes=self.bandpass_nodes, method=self.bandpass_method,
+                                        maxopd=max_opd(nrm.ctrs, nrm.d, cube.shape[1], nrm.pixel))[0]
+                      if hasattr(bp, '__iter__') else bp for bp in bandpasses]
+    models = nrm.make_channel_models(cube.shape[1], bandpasses, over=self.oversample,
+                                     psf_offset=nrm.bestcenter, pixscale=nrm.pixel)
+    x, res, cond = leastsqnrm.channel_operations(cube, models, weights=weights)
+
+    records = []
+    seconds = (time.time() - t0) / len(bandpasses) # the shared work, per channel
+    for slc in range(len(bandpasses)):
+        nrm.bandpass = bandpasses[slc]
+        nrm.reference = self.ctrd = cube[slc]
+        nrm.use_solution(x[slc], res[slc], cond[slc], models[slc], weighted=weights is not None)
+        if self.text_output:
+            self.save_output(slc, nrm)
+        if self.diagnostics != "none":
+            self.save_diagnostics(slc, nrm)
+        records.append(fitrecords.fit_record(nrm, slc, seconds, 
+                                             None if weights is None else weights[slc]))
+    return fitrecords.gather(records)
 
 def fit_fringes_single_integration(args):
+    # returns the slice's fitrecords.fit_record()
+    t0 = time.time()
     self = args["object"]
     slc = args["slc"]
     id_tag = args["slc"]
 
-    nrm = NRM_Model(mask=self.instrument_data.mask,
-                    pixscale=self.instrument_data.pscale_rad,
-                    holeshape=self.instrument_data.holeshape,
-                    affine2d=self.instrument_data.affine2d,
-                    over = self.oversample)
+    utils.set_fromfunction_threads(self.kernel_threads, self.kernel_tile)
+    nrm = new_model(self)
 
-    nrm.bandpass = self.instrument_data.wls[slc]
+    if "bandpass" in args:
+        nrm.bandpass = args["bandpass"]
+    else:
+        nrm.bandpass = self.instrument_data.wls[slc]
 
     if self.npix == 'default':
         self.npix = self.scidata[slc,:,:].shape[0]
 
     DBG = False # AS testing gross psf orientatioun while getting to LG++ beta release 2018 09
     if DBG:
-        nrm.simulate(fov=self.npix, bandpass=self.instrument_data.wls[slc], over=self.oversample)
+        nrm.simulate(fov=self.npix, bandpass=nrm.bandpass, over=self.oversample)
         fits.PrimaryHDU(data=nrm.psf).writeto(self.savedir + "perfect.fits", overwrite=True)
 
     # New or modified in LG++
@@ -304,14 +821,12 @@ def fit_fringes_single_integration(args):
     # AS subtract 1 from "r" below  for testing >1/2 pixel offsets
     # AG 03-2019 -- is above comment still relevant?
     
-    if self.instrument_data.arrname=="NIRC2_9NRM":
-        self.ctrd = utils.center_imagepeak(self.scidata[slc, :,:], 
-                        r = (self.npix -1)//2 - 2, cntrimg=False)  
-    elif self.instrument_data.arrname=="gpi_g10s40":
-        self.ctrd = utils.center_imagepeak(self.scidata[slc, :,:], 
-                        r = (self.npix -1)//2 - 2, cntrimg=True)  
+    self.ctrd, crop = center_crop(self, self.scidata[slc, :,:])
+    if self.noise_model is not None:
+        variance = self.variance[slc][crop]
+        weights = noise.weights(variance)
     else:
-        self.ctrd = utils.center_imagepeak(self.scidata[slc, :,:])  
+        variance = weights = None
         # Old AG LG++ version
         #self.ctrd = utils.center_imagepeak(self.scidata[slc, :,:], 
         #                r = (self.npix -1)//2 - 2)  
@@ -348,11 +863,52 @@ def fit_fringes_single_integration(args):
         print(">>>> nrm_core.fit_image(): hold_centering UNTESTED w/ new utils.centroid().  psf_offset from user... <<<<")
         nrm.bestcenter = self.psf_offset # if center already known, python-style offsets from array center are here.
 
-    nrm.make_model(fov = self.ctrd.shape[0], bandpass=nrm.bandpass, 
-                   over=self.oversample,
-                   psf_offset=nrm.bestcenter,  
-                   pixscale=nrm.pixel)
-    nrm.fit_image(self.ctrd, modelin=nrm.model, psf_offset=nrm.bestcenter)
+    if self.bandpass_nodes is not None and hasattr(nrm.bandpass, '__iter__'):
+        nrm.bandpass, bperr = compress_bandpass(nrm.bandpass, nodes=self.bandpass_nodes,
+                                  method=self.bandpass_method,
+                                  maxopd=max_opd(nrm.ctrs, nrm.d, self.ctrd.shape[0], nrm.pixel))
+        print(">>>> nrm_core: bandpass compressed to {0} nodes, fractional model error < {1:.1e}".format(
+              len(nrm.bandpass), bperr))
+
+    fitimage = self.ctrd
+    modelfov = self.ctrd.shape[0]
+    if (self.support_radius, self.support_threshold, self.support_snr) != (None, None, None):
+        fitsupport = support.support_mask(nrm, self.ctrd.shape[0], nrm.bandpass, nrm.bestcenter,
+                                          radius=self.support_radius,
+                                          threshold=self.support_threshold, snr=self.support_snr,
+                                          image=self.ctrd, variance=variance)
+        fitimage = np.where(fitsupport, self.ctrd, np.nan)
+        modelfov = support.support_fov(fitsupport)
+        print(">>>> nrm_core: fitting {0} support pixels, model fov {1}".format(
+              fitsupport.sum(), modelfov))
+
+    if self.model_offset_step is None:
+        nrm.make_model(fov = modelfov, bandpass=nrm.bandpass, 
+                       over=self.oversample,
+                       psf_offset=nrm.bestcenter,  
+                       pixscale=nrm.pixel,
+                       fouriershift=self.model_fouriershift,
+                       smeared=self.model_smeared,
+                       maxbytes=self.model_maxbytes)
+    else:
+        grid = offsetgrid.get_grid(nrm, modelfov, nrm.bandpass,
+                                   over=self.oversample, pixscale=nrm.pixel,
+                                   step=self.model_offset_step, tol=self.model_offset_tol,
+                                   fouriershift=self.model_fouriershift,
+                                   smeared=self.model_smeared,
+                                   maxbytes=self.model_maxbytes)
+        nrm.model = grid.model(nrm, nrm.bestcenter)
+    nrm.model = support.embed(nrm.model, self.ctrd.shape[0])
+    derivatives = None
+    if self.fit_offset:
+        derivatives = nrm.make_derivatives(modelfov, nrm.bandpass, over=self.oversample,
+                                           psf_offset=nrm.bestcenter, pixscale=nrm.pixel)
+        derivatives = np.array([support.embed(dm, self.ctrd.shape[0]) for dm in derivatives])
+    nrm.fov = self.ctrd.shape[0]
+    nrm.fit_image(fitimage, modelin=nrm.model, psf_offset=nrm.bestcenter,
+                  covariance=self.covariance, weights=weights,
+                  clip=self.clip_sigma, clipiter=self.clip_iterations,
+                  derivatives=derivatives, offsetiter=self.fit_offset)
     """
     Attributes now stored in nrm object:
 
@@ -380,8 +936,11 @@ def fit_fringes_single_integration(args):
         plt.imshow(np.sqrt(abs(refft)), cmap="bone")
         plt.show()
     
-    self.save_output(slc, nrm)
-    return None
+    if self.text_output:
+        self.save_output(slc, nrm)
+    if self.diagnostics != "none":
+        self.save_diagnostics(slc, nrm)
+    return fitrecords.fit_record(nrm, slc, time.time() - t0, weights, covariance=self.covariance)
 
 class Calibrate:
     """
@@ -553,12 +1112,19 @@ class Calibrate:
                     pass
                 expflag=[]
                 for qq in range(nexps):
-                    # nwav files
-                    cpfiles = [f for f in os.listdir(objpaths[ii]+exps[qq]) if "CPs" in f] 
-                    print(cpfiles)
-                    ampfiles = [f for f in os.listdir(objpaths[ii]+exps[qq]) \
-                                if "amplitudes" in f]
-                    phafiles = [f for f in os.listdir(objpaths[ii]+exps[qq]) if "phase" in f] 
+                    if fitrecords.has_store(objpaths[ii]+exps[qq]):
+                        records = fitrecords.read_store(objpaths[ii]+exps[qq])[0]
+                        amp[:len(records), qq,:] = records["amplitudes"]
+                        cps[:len(records), qq,:] = records["cps"]
+                        pha[:len(records), qq,:] = records["phases"]
+                        cpfiles = []
+                    else:
+                        # nwav files
+                        cpfiles = [f for f in os.listdir(objpaths[ii]+exps[qq]) if "CPs" in f] 
+                        print(cpfiles)
+                        ampfiles = [f for f in os.listdir(objpaths[ii]+exps[qq]) \
+                                    if "amplitudes" in f]
+                        phafiles = [f for f in os.listdir(objpaths[ii]+exps[qq]) if "phase" in f] 
                     for slc in range(len(cpfiles)):
                         amp[slc, qq,:] = np.loadtxt(objpaths[ii]+exps[qq]+"/"+ampfiles[slc])
                         cps[slc, qq,:] = np.loadtxt(objpaths[ii]+exps[qq]+"/"+cpfiles[slc])
@@ -610,10 +1176,17 @@ class Calibrate:
             print("else")
             for ii in range(self.nobjs):
 
-                cpfiles = [f for f in os.listdir(objpaths[ii]) if "CPs" in f] 
-                ampfiles = [f for f in os.listdir(objpaths[ii]) if "amplitudes" in f]
-                phafiles = [f for f in os.listdir(objpaths[ii]) if "phase" in f]
-                nexps = len(cpfiles)
+                if fitrecords.has_store(objpaths[ii]):
+                    # one row per integration, each integration an "exposure"
+                    records = fitrecords.read_store(objpaths[ii])[0]
+                    cpfiles = []
+                    nexps = len(records)
+                else:
+                    records = None
+                    cpfiles = [f for f in os.listdir(objpaths[ii]) if "CPs" in f] 
+                    ampfiles = [f for f in os.listdir(objpaths[ii]) if "amplitudes" in f]
+                    phafiles = [f for f in os.listdir(objpaths[ii]) if "phase" in f]
+                    nexps = len(cpfiles)
                 print("nexp: "+str(nexps))
 
                 amp = np.zeros((nexps, self.nbl))
@@ -622,13 +1195,18 @@ class Calibrate:
                 print(nexps)
                 expflag=[]
                 for qq in range(nexps):
-                    amp[qq,:] = np.loadtxt(objpaths[ii]+"/"+ampfiles[qq])
+                    if records is not None:
+                        amp[qq,:] = records["amplitudes"][qq]
+                        pha[qq,:] = records["phases"][qq]
+                        cps[qq,:] = records["cps"][qq]
+                    else:
+                        amp[qq,:] = np.loadtxt(objpaths[ii]+"/"+ampfiles[qq])
+                        print(cpfiles[qq])
+                        pha[qq,:] = np.loadtxt(objpaths[ii]+"/"+phafiles[qq])
+                        cps[qq,:] = np.loadtxt(objpaths[ii]+"/"+cpfiles[qq])
                     if True in (amp[qq,:]>1):
-                        print('amp > 1 for {}'.format(ampfiles[qq]))
+                        print('amp > 1 for {}'.format(qq))
                         expflag.append(qq)
-                    print(cpfiles[qq])
-                    pha[qq,:] = np.loadtxt(objpaths[ii]+"/"+phafiles[qq])
-                    cps[qq,:] = np.loadtxt(objpaths[ii]+"/"+cpfiles[qq])
 
                 # Covariance 06/27/2017
                 if ii == 0:
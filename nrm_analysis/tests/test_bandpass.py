@@ -0,0 +1,66 @@
+import unittest
+import numpy as np
+from astropy import units as u
+
+from nrm_analysis.fringefitting.LG_Model import NRM_Model
+from nrm_analysis.fringefitting.bandpass import compress_bandpass, max_opd
+
+"""
+    Test bandpass quadrature compression against models built on the full bandpass
+
+    run with pytest -s _moi_.py to see stdout on screen
+    All units SI unless units in variable name
+"""
+
+arcsec2rad = u.arcsec.to(u.rad)
+
+
+class BandpassTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pixel = 0.0656 * arcsec2rad
+        self.fov = 15
+        self.over = 1
+        lam = np.linspace(4.05e-6, 4.45e-6, 150)
+        wght = np.exp(-((lam - 4.3e-6)/1.5e-7)**4) * (1 + 0.3*np.sin(lam*3.0e7))
+        self.bandpass = np.array([wght, lam]).T
+
+    def test_moments(self):
+        wght, sigma = self.bandpass[:,0], 1.0/self.bandpass[:,1]
+        compressed, err = compress_bandpass(self.bandpass, nodes=4)
+        wc, sc = compressed[:,0], 1.0/compressed[:,1]
+        for k in range(8): # exact for polynomials in sigma up to degree 2*nodes-1
+            sk = ((sigma - sigma.mean())/sigma.std())**k
+            sck = ((sc - sigma.mean())/sigma.std())**k
+            self.assertAlmostEqual((wght*sk).sum()/wght.sum(), (wc*sck).sum()/wght.sum(), 9)
+        self.assertTrue(err is None)
+
+    def test_model_error_bound(self):
+        jw = NRM_Model(mask='jwst', holeshape="hex", pixscale=self.pixel, over=self.over)
+        maxopd = max_opd(jw.ctrs, jw.d, self.fov, self.pixel)
+        for method in ("moments", "legendre"):
+            compressed, err = compress_bandpass(self.bandpass, nodes=7, method=method,
+                                                maxopd=maxopd)
+            jw.bandpass = self.bandpass
+            full = jw.make_model(fov=self.fov, bandpass=self.bandpass, over=self.over).copy()
+            jw.bandpass = compressed
+            comp = jw.make_model(fov=self.fov, bandpass=compressed, over=self.over)
+            # bound excludes the envelope amplitude's slow wavelength dependence
+            self.assertTrue(np.abs(comp - full).max() <= (err + 1e-6)*np.abs(full).max(), method)
+        self.assertTrue(err < 0.01)
+
+    def test_smeared_model(self):
+        jw = NRM_Model(mask='jwst', holeshape="hex", pixscale=self.pixel, over=3)
+        jw.bandpass = self.bandpass
+        full = jw.make_model(fov=self.fov, bandpass=self.bandpass, over=3).copy()
+        smeared = jw.make_model(fov=self.fov, bandpass=self.bandpass, over=3, smeared=True)
+        self.assertTrue(np.abs(smeared - full).max() < 5e-3*np.abs(full).max())
+        # a single wavelength has no smearing
+        mono = np.array([(2.0, 4.3e-6)])
+        full = jw.make_model(fov=self.fov, bandpass=mono, over=3).copy()
+        smeared = jw.make_model(fov=self.fov, bandpass=mono, over=3, smeared=True)
+        self.assertTrue(np.abs(smeared - full).max() < 1e-12*np.abs(full).max())
+
+
+if __name__ == "__main__":
+    unittest.main()
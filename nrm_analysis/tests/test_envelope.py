@@ -0,0 +1,56 @@
+import unittest
+import numpy as np
+from astropy import units as u
+
+from nrm_analysis.misctools.utils import Affine2d
+from nrm_analysis.fringefitting import analyticnrm2, envelope
+from nrm_analysis.fringefitting.LG_Model import NRM_Model
+
+"""
+    Test tabulated primary beams against the analytic Jinc and hex transforms
+
+    run with pytest -s _moi_.py to see stdout on screen
+    All units SI unless units in variable name
+"""
+
+arcsec2rad = u.arcsec.to(u.rad)
+
+
+class EnvelopeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pixel = 0.0656 * arcsec2rad
+        self.fov = 35
+        self.over = 3
+        self.affine2d = Affine2d(rotradccw=np.pi*7.0/180.0, name="7")
+        self.ctrs = np.zeros((7,2))
+
+    def test_primarybeam(self):
+        for shape in ('circ', 'hex'):
+            table = envelope.get_table(shape)
+            self.assertTrue(table.error <= table.tol)
+            for lam, offset in ((4.3e-6, (0.0, 0.0)), (2.77e-6, (0.3, -0.2))):
+                exact = analyticnrm2.primarybeam(self.ctrs, lam, self.over, self.pixel,
+                                                 self.fov, 0.82, psf_offset=offset,
+                                                 shape=shape, affine2d=self.affine2d)
+                tabulated = analyticnrm2.primarybeam(self.ctrs, lam, self.over, self.pixel,
+                                                     self.fov, 0.82, psf_offset=offset,
+                                                     shape=shape, affine2d=self.affine2d,
+                                                     envtable=table)
+                self.assertTrue(np.abs(tabulated - exact).max() < 2*table.tol*exact.max(),
+                                "{0} {1} {2}".format(shape, lam, offset))
+
+    def test_tabulated_model(self):
+        jw = NRM_Model(mask='jwst', holeshape="hex", pixscale=self.pixel, over=self.over,
+                       affine2d=self.affine2d, tabulated_envelope=True)
+        jw.bandpass = 4.3e-6
+        tabulated = jw.make_model(fov=self.fov, bandpass=4.3e-6, over=self.over,
+                                  psf_offset=(0.1, 0.2)).copy()
+        jw.tabulated_envelope = False
+        exact = jw.make_model(fov=self.fov, bandpass=4.3e-6, over=self.over,
+                              psf_offset=(0.1, 0.2))
+        self.assertTrue(np.abs(tabulated - exact).max() < 1e-5*np.abs(exact).max())
+
+
+if __name__ == "__main__":
+    unittest.main()
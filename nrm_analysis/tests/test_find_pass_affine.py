@@ -1,6 +1,6 @@
 
 
-import unittest, os, glob
+import unittest, os
 import numpy as np
 from astropy.io import fits
 from astropy.table import Table
@@ -25,6 +25,7 @@ import nrm_analysis.nrm_core as nrm_core
 import nrm_analysis.InstrumentData as InstrumentData
 import nrm_analysis.find_affine2d_parameters as FAP
 import nrm_analysis.misctools.utils as utils
+import nrm_analysis.fringefitting.fitrecords as fitrecords
 
 
 
@@ -146,9 +147,9 @@ class FindPassAffine2dTestCase(unittest.TestCase):
         threads = 1
         ff.fit_fringes([filename])
 
-        CP_file = sorted(glob.glob(os.path.join(datadir,'%s/%s*.txt' % (filename.split('.')[0],'CPs_') )));
-        print("CP_file: ", type(CP_file), len(CP_file))
-        CP = Table.read(CP_file[0],format='ascii.no_header',names=({'closure_phase'}))
+        records = fitrecords.read_store(os.path.join(datadir, filename.split('.')[0]))[0]
+        print("stored integrations: ", len(records))
+        CP = Table([records['cps'][0]], names=('closure_phase',))
 
         #         perform the actual test
         self.assertTrue(np.mean(np.array(CP['closure_phase'])) < 1e-7, 
@@ -199,9 +200,9 @@ class FindPassAffine2dTestCase(unittest.TestCase):
         threads = 1
         ff.fit_fringes([filename])
 
-        CP_file = sorted(glob.glob(os.path.join(datadir,'%s/%s*.txt' % (filename.split('.')[0],'CPs_') )));
-        print("CP_file: ", type(CP_file), len(CP_file))
-        CP = Table.read(CP_file[0],format='ascii.no_header',names=({'closure_phase'}))
+        records = fitrecords.read_store(os.path.join(datadir, filename.split('.')[0]))[0]
+        print("stored integrations: ", len(records))
+        CP = Table([records['cps'][0]], names=('closure_phase',))
 
         #         perform the actual test
         self.assertTrue(np.mean(np.array(CP['closure_phase'])) < 1e-7, 
@@ -0,0 +1,64 @@
+import shutil
+import tempfile
+import unittest
+import pickle
+import numpy as np
+from astropy import units as u
+from astropy.io import fits
+
+from nrm_analysis.fringefitting import fitrecords
+from nrm_analysis.fringefitting.LG_Model import NRM_Model
+
+"""
+    Test the fixed-dtype fit result records returned by fringe fitting workers
+
+    run with pytest -s _moi_.py to see stdout on screen
+"""
+
+arcsec2rad = u.arcsec.to(u.rad)
+
+
+class FitRecordsTestCase(unittest.TestCase):
+
+    def test_fit_record(self):
+        np.random.seed(5)
+        jw = NRM_Model(mask='jwst', holeshape="hex", pixscale=0.0656*arcsec2rad, over=1)
+        psf = jw.simulate(fov=25, bandpass=4.3e-6, over=1, psf_offset=(0.1, -0.2))
+        img = 1.0e5 * psf / psf.max() + np.random.normal(0.0, 10.0, psf.shape)
+        img[2, 3] = np.nan
+        model = jw.make_model(fov=25, bandpass=4.3e-6, over=1, psf_offset=(0.1, -0.2))
+        records = []
+        for slc in (2, 0, 1):
+            jw.fit_image(img, modelin=model, psf_offset=(0.1, -0.2))
+            records.append(fitrecords.fit_record(jw, slc, seconds=0.5))
+        rec = records[0]
+        self.assertEqual(rec.dtype, fitrecords.record_dtype(7))
+        self.assertTrue(np.array_equal(rec["cps"], jw.redundant_cps))
+        self.assertTrue(np.array_equal(rec["cas"], jw.redundant_cas))
+        self.assertEqual(rec["ndof"], 25*25 - 1 - 44)
+        self.assertTrue(np.isclose(rec["chi2"], np.nansum(jw.residual**2)))
+        self.assertTrue(len(pickle.dumps(rec)) < 4096)
+        gathered = fitrecords.gather(records)
+        self.assertTrue(np.array_equal(gathered["slc"], [0, 1, 2]))
+        self.assertEqual(gathered["phases"].shape, (3, 21))
+
+    def test_store(self):
+        records = np.zeros(3, dtype=fitrecords.record_dtype(7, covariance=True))
+        records["slc"] = np.arange(3)
+        records["cps"] = np.random.random((3, 35))
+        records["cps_cov"] = np.random.random((3, 35, 35))
+        header = fits.Header([("TARGNAME", "star")])
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fitrecords.write_store(tmpdir, records, header=header, meta={"OVERSAMP": 3})
+            self.assertTrue(fitrecords.has_store(tmpdir))
+            stored, hdr = fitrecords.read_store(tmpdir)
+            self.assertEqual(stored.dtype, records.dtype)
+            self.assertTrue(np.array_equal(stored, records))
+            self.assertEqual(hdr["TARGNAME"], "star")
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    unittest.main()
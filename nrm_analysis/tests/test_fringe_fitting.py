@@ -23,6 +23,7 @@ except ImportError:
     raise ImportError('Module oifits not found. Please include it in your path')
 
 from nrm_analysis import nrm_core, InstrumentData
+from nrm_analysis.fringefitting import fitrecords
 
 
 
@@ -123,8 +124,8 @@ class FringeFittingTestCase(unittest.TestCase):
         threads = 1
         ff.fit_fringes([file_name])
 
-        CP_file = sorted(glob.glob(os.path.join(data_dir,'%s/%s*.txt' % (file_name.split('.')[0],'CPs_') )));
-        CP = Table.read(CP_file[0],format='ascii.no_header',names=({'closure_phase'}))
+        records = fitrecords.read_store(os.path.join(data_dir, file_name.split('.')[0]))[0]
+        CP = Table([records['cps'][0]], names=('closure_phase',))
 
         #         perform the actual test
         print("Closure phases standard deviation (radians)", (np.array(CP['closure_phase'])).std())
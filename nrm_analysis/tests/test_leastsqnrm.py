@@ -0,0 +1,220 @@
+import unittest
+import numpy as np
+from astropy import units as u
+import uncertainties
+
+from nrm_analysis.fringefitting.LG_Model import NRM_Model
+from nrm_analysis.fringefitting import leastsqnrm
+
+"""
+    Test the least squares fringe solvers on a noisy simulated NIRISS-like image
+
+    run with pytest -s _moi_.py to see stdout on screen
+    All units SI unless units in variable name
+"""
+
+arcsec2rad = u.arcsec.to(u.rad)
+
+
+class LeastSqTestCase(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(17)
+        self.pixel = 0.0656 * arcsec2rad
+        self.fov = 35
+        self.over = 3
+        self.wave = 4.3e-6 # m
+        self.psf_offset = (0.2, -0.1) # detpix
+        self.jw = NRM_Model(mask='jwst', holeshape="hex", pixscale=self.pixel, over=self.over)
+        self.jw.set_pistons(np.random.normal(0.0, 2.0e-7, self.jw.N))
+        img = self.jw.simulate(fov=self.fov, bandpass=self.wave, over=self.over,
+                               psf_offset=self.psf_offset)
+        self.img = 1.0e5 * img / img.max() + np.random.normal(0.0, 10.0, img.shape)
+        self.img[3,4] = np.nan
+        self.model = self.jw.make_model(fov=self.fov, bandpass=self.wave, over=self.over,
+                                        psf_offset=self.psf_offset)
+
+    def test_single_precision(self):
+        report = leastsqnrm.precision_report(self.img, self.model, N=self.jw.N)
+        self.assertTrue(report["cp"] < 1e-6)
+        self.assertTrue(report["ca"] < 1e-6)
+        jw32 = NRM_Model(mask='jwst', holeshape="hex", pixscale=self.pixel, over=self.over,
+                         precision=np.float32)
+        jw32.bandpass = self.wave
+        model32 = jw32.make_model(fov=self.fov, bandpass=self.wave, over=self.over,
+                                  psf_offset=self.psf_offset)
+        self.assertEqual(model32.dtype, np.float32)
+        self.assertEqual(jw32.fringes.dtype, np.float32) # built, not just stored, in float32
+        self.assertTrue(np.abs(model32 - self.model).max() < 1e-6*np.abs(self.model).max())
+        x64, res64 = leastsqnrm.matrix_operations(self.img, self.model)[:2]
+        x32, res32 = leastsqnrm.matrix_operations(self.img, model32)[:2]
+        self.assertEqual(x32.dtype, np.float64)
+        self.assertTrue(np.abs(x32 - x64).max() < 1e-5*np.abs(x64).max())
+        self.assertTrue(np.isnan(res32[3,4]))
+
+    def test_multi_matrix_operations(self):
+        cube = np.array([self.img + np.random.normal(0.0, 10.0, self.img.shape)
+                         for slc in range(5)])
+        cube[3, 10, 11] = np.nan # downdated from the common pattern
+        cube[4, 3, 4] = 0.0      # updated: a pixel NaN in the common pattern is good
+        cube[1, 5:15, 5:15] = np.nan # too many to downdate, rebuilt
+        x, res, cond = leastsqnrm.multi_matrix_operations(cube, self.model)
+        self.assertEqual(x.shape, (5, self.model.shape[2]))
+        self.assertEqual(res.shape, cube.shape)
+        for slc in range(5):
+            xs, ress, conds = leastsqnrm.matrix_operations(cube[slc], self.model)[:3]
+            self.assertTrue(np.abs(x[slc] - xs).max() < 1e-9*np.abs(xs).max())
+            self.assertTrue(np.allclose(res[slc], ress, rtol=0, atol=1e-6, equal_nan=True))
+            self.assertTrue(abs(cond[slc] - conds) < 1e-6*conds)
+        weights = 1.0/np.sqrt(np.abs(np.nan_to_num(self.img)) + 100.0)
+        x = leastsqnrm.multi_matrix_operations(cube, self.model, weights=weights)[0]
+        for slc in (0, 3):
+            xs = leastsqnrm.weighted_operations(cube[slc], self.model, weights)[0]
+            self.assertTrue(np.abs(x[slc] - xs).max() < 1e-9*np.abs(xs).max())
+
+    def test_covariance(self):
+        x, res, cond, fit = leastsqnrm.matrix_operations(self.img, self.model, linfit=True)
+        good = ~np.isnan(self.img.ravel())
+        flatmodel = self.model.reshape(-1, self.model.shape[2])[good]
+        flatimg = self.img.ravel()[good]
+        weights = np.where(np.abs(flatimg) <= 1.0, 0.0, 1.0/np.abs(flatimg))
+        dense = np.linalg.inv(np.dot(flatmodel.T, np.dot(np.diag(weights), flatmodel)))
+        self.assertTrue(np.abs(fit.p_formal_covariance_matrix - dense).max() <
+                        1e-9*np.abs(dense).max())
+        self.assertTrue(np.abs(fit.p - x).max() < 1e-2*np.abs(x).max())
+        # analytic Jacobians against uncertainties' (autodifferentiated) propagation
+        cov = fit.p_normalised_covariance_matrix
+        phcov, ampcov, cpcov, cacov = leastsqnrm.observable_covariances(x, cov, N=self.jw.N)
+        ux = np.array(uncertainties.correlated_values(x, cov))
+        amp, phase = leastsqnrm.tan2visibilities(ux/ux[0])
+        cps = leastsqnrm.redundant_cps(phase, N=self.jw.N)[0]
+        cas = leastsqnrm.return_CAs(amp, N=self.jw.N)
+        for ours, theirs in ((phcov, phase), (ampcov, amp), (cpcov, cps), (cacov, cas)):
+            ref = np.array(uncertainties.covariance_matrix(list(theirs)))
+            self.assertTrue(np.abs(ours - ref).max() < 1e-8*np.abs(ref).max())
+
+    def test_observable_geometry(self):
+        for N in (7, 10):
+            nbl = N*(N-1)//2
+            geometry = leastsqnrm.get_geometry(N)
+            self.assertTrue(geometry is leastsqnrm.get_geometry(N))
+            self.assertEqual((len(geometry.triangles), len(geometry.quads)),
+                             (N*(N-1)*(N-2)//6, N*(N-1)*(N-2)*(N-3)//24))
+            stack = np.random.normal(size=(4, 2*nbl+2)) + 3.0
+            soln, amp, phase, pistons, cps, cas = geometry.observables(stack)
+            for row in range(4):
+                a, p = leastsqnrm.tan2visibilities(stack[row]/stack[row,0])
+                self.assertTrue(np.array_equal(amp[row], a))
+                self.assertTrue(np.array_equal(phase[row], p))
+                self.assertTrue(np.abs(cps[row] - np.dot(geometry.K, p)).max() < 1e-12)
+                self.assertTrue(np.abs(np.log(cas[row]) - np.dot(geometry.L, np.log(a))).max()
+                                < 1e-12)
+                self.assertTrue(np.abs(pistons[row] - np.dot(geometry.Apinv, p)).max() < 1e-12)
+
+    def test_weighted_operations(self):
+        variance = np.clip(np.nan_to_num(self.img), 0.0, None) + 100.0
+        weights = 1.0/np.sqrt(variance)
+        x, res, cond = leastsqnrm.weighted_operations(self.img, self.model, weights)
+        good = ~np.isnan(self.img.ravel())
+        a = self.model.reshape(-1, self.model.shape[2])[good]
+        c = np.diag(1.0/variance.ravel()[good])
+        dense = np.linalg.solve(np.dot(a.T, np.dot(c, a)),
+                                np.dot(a.T, np.dot(c, self.img.ravel()[good])))
+        self.assertTrue(np.abs(x - dense).max() < 1e-9*np.abs(dense).max())
+        self.assertTrue(np.isnan(res[3,4]))
+        # per-slice weights, solved as a stack
+        cube = np.array([self.img + np.random.normal(0.0, 10.0, self.img.shape)
+                         for slc in range(3)])
+        cube[1, 10, 11] = np.nan
+        wcube = np.array([1.0/np.sqrt(np.clip(np.nan_to_num(im), 0.0, None) + 100.0)
+                          for im in cube])
+        xs, ress, conds = leastsqnrm.multi_matrix_operations(cube, self.model, weights=wcube)
+        for slc in range(3):
+            x, res, cond = leastsqnrm.weighted_operations(cube[slc], self.model, wcube[slc])
+            self.assertTrue(np.abs(xs[slc] - x).max() < 1e-9*np.abs(x).max())
+            self.assertTrue(np.allclose(ress[slc], res, rtol=0, atol=1e-6, equal_nan=True))
+            self.assertTrue(abs(conds[slc] - cond) < 1e-6*cond)
+
+    def test_channel_operations(self):
+        waves = [3.9e-6, 4.3e-6, 4.7e-6]
+        models = self.jw.make_channel_models(self.fov, waves, over=self.over,
+                                             psf_offset=self.psf_offset)
+        cube = []
+        for wave in waves:
+            img = self.jw.simulate(fov=self.fov, bandpass=wave, over=self.over,
+                                   psf_offset=self.psf_offset)
+            cube.append(1.0e5 * img / img.max() + np.random.normal(0.0, 10.0, img.shape))
+        cube = np.array(cube)
+        cube[1, 10, 11] = np.nan
+        xs, ress, conds = leastsqnrm.channel_operations(cube, models)
+        wcube = 1.0/np.sqrt(np.clip(np.nan_to_num(cube), 0.0, None) + 100.0)
+        wxs = leastsqnrm.channel_operations(cube, models, weights=wcube)[0]
+        for chan in range(3):
+            x, res, cond = leastsqnrm.matrix_operations(cube[chan], models[chan])[:3]
+            self.assertTrue(np.abs(xs[chan] - x).max() < 1e-9*np.abs(x).max())
+            self.assertTrue(np.allclose(ress[chan], res, rtol=0, atol=1e-6, equal_nan=True))
+            self.assertTrue(abs(conds[chan] - cond) < 1e-6*cond)
+            x = leastsqnrm.weighted_operations(cube[chan], models[chan], wcube[chan])[0]
+            self.assertTrue(np.abs(wxs[chan] - x).max() < 1e-9*np.abs(x).max())
+
+    def test_clipped_operations(self):
+        img = self.img.copy()
+        hot = [(5, 20), (17, 17), (30, 2)] # hot pixels and a cosmic ray on the core
+        for pix in hot:
+            img[pix] += 5.0e4
+        x, res, cond, rejected = leastsqnrm.clipped_operations(img, self.model, nsigma=5.0)
+        self.assertTrue(all(rejected[pix] for pix in hot))
+        self.assertTrue(rejected.sum() < 10)
+        # same as a from-scratch fit with the rejected pixels masked
+        masked = np.where(rejected, np.nan, img)
+        xs, ress, conds = leastsqnrm.matrix_operations(masked, self.model)[:3]
+        self.assertTrue(np.abs(x - xs).max() < 1e-9*np.abs(xs).max())
+        self.assertTrue(abs(cond - conds) < 1e-6*conds)
+        self.assertTrue(np.isnan(res[3,4]) and not np.isnan(res[hot[0]]))
+        clean = leastsqnrm.matrix_operations(self.img, self.model)[0]
+        self.assertTrue(np.abs(x - clean).max() < 1e-3*np.abs(clean).max())
+
+    def test_offset_operations(self):
+        # image centered 0.05, -0.03 pixels away from the model's psf_offset
+        img = self.jw.simulate(fov=self.fov, bandpass=self.wave, over=self.over,
+                               psf_offset=(self.psf_offset[0] + 0.05, self.psf_offset[1] - 0.03))
+        img = 1.0e5 * img / img.max()
+        derivs = self.jw.make_derivatives(self.fov, self.wave, over=self.over,
+                                          psf_offset=self.psf_offset)
+        x, res, cond, design = leastsqnrm.offset_operations(img, self.model, derivs, niter=2)
+        self.assertEqual(design.shape[-1], self.model.shape[-1] + 2)
+        self.assertTrue(np.abs(x[-2:] - (0.05, -0.03)).max() < 1e-3)
+        # the held-offset fit's fringe phases are off by the centering error, the offset fit's not
+        truth = self.jw.make_model(fov=self.fov, bandpass=self.wave, over=self.over,
+                                   psf_offset=(self.psf_offset[0] + 0.05, self.psf_offset[1] - 0.03))
+        xtrue = leastsqnrm.matrix_operations(img, truth)[0]
+        xheld = leastsqnrm.matrix_operations(img, self.model)[0]
+        phases = [leastsqnrm.tan2visibilities(c/c[0])[1] for c in (xtrue, xheld, x[:-2])]
+        self.assertTrue(np.abs(phases[2] - phases[0]).max() <
+                        0.02*np.abs(phases[1] - phases[0]).max())
+
+    def test_fit_image_offset(self):
+        img = self.jw.simulate(fov=self.fov, bandpass=self.wave, over=self.over,
+                               psf_offset=(self.psf_offset[0] + 0.05, self.psf_offset[1] - 0.03))
+        img = 1.0e5 * img / img.max()
+        derivs = self.jw.make_derivatives(self.fov, self.wave, over=self.over,
+                                          psf_offset=self.psf_offset)
+        solves = []
+        matrix_operations = leastsqnrm.matrix_operations
+        def counted(*args, **kwargs):
+            solves.append(1)
+            return matrix_operations(*args, **kwargs)
+        leastsqnrm.matrix_operations = counted
+        try:
+            self.jw.fit_image(img, modelin=self.model, psf_offset=self.psf_offset,
+                              derivatives=derivs, offsetiter=2)
+        finally:
+            leastsqnrm.matrix_operations = matrix_operations
+        self.assertEqual(len(solves), 3) # the starting solve and 2 offset steps
+        # modelsolution image from the offset-corrected model agrees with the residual
+        modelpsf = self.jw.plot_model()[0]
+        self.assertTrue(np.abs(img - self.jw.residual - modelpsf).max() < 1e-3*img.max())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+import unittest
+import numpy as np
+from astropy import units as u
+
+from nrm_analysis.misctools import utils
+from nrm_analysis.misctools.utils import Affine2d
+from nrm_analysis.fringefitting import analyticnrm2, hextransformEE, subpix, envelope
+from nrm_analysis.fringefitting.modelcache import ModelCache
+from nrm_analysis.fringefitting.LG_Model import NRM_Model
+
+"""
+    Test the batched (all baselines at once) fringe engine in model_array
+    against the one-baseline-at-a-time harmonicfringes() calculation.
+
+    run with pytest -s _moi_.py to see stdout on screen
+    All units SI unless units in variable name
+"""
+
+arcsec2rad = u.arcsec.to(u.rad)
+
+
+class ModelArrayTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pixel = 0.0656 * arcsec2rad
+        self.fov = 21
+        self.over = 3
+        self.wave = 4.3e-6 # m
+        self.psf_offset = (0.3, -0.2) # detpix
+        self.affine2d = Affine2d(rotradccw=np.pi*10.0/180.0, name="10")
+        self.jw = NRM_Model(mask='jwst', holeshape="hex", affine2d=self.affine2d)
+
+    def test_fringes_match_harmonicfringes(self):
+        pb, ff = analyticnrm2.model_array(self.jw.ctrs, self.wave, self.over,
+                                          self.pixel, self.fov, self.jw.d,
+                                          psf_offset=self.psf_offset,
+                                          shape="hex", affine2d=self.affine2d)
+        nbl = self.jw.N*(self.jw.N-1)//2
+        self.assertEqual(ff.shape, (2*nbl+1, self.fov*self.over, self.fov*self.over))
+        self.assertTrue(np.all(ff[0] == self.jw.N))
+        for k, bl in enumerate(analyticnrm2.baselines(self.jw.ctrs)):
+            cosfringe, sinfringe = analyticnrm2.harmonicfringes(fov=self.fov,
+                                       pitch=self.pixel, psf_offset=self.psf_offset,
+                                       baseline=bl, oversample=self.over,
+                                       lam=self.wave, affine2d=self.affine2d)
+            self.assertTrue(np.abs(ff[2*k+1] - cosfringe).max() < 1e-12,
+                            'batched cosine fringe {0} differs'.format(k))
+            self.assertTrue(np.abs(ff[2*k+2] - sinfringe).max() < 1e-12,
+                            'batched sine fringe {0} differs'.format(k))
+
+    def test_multiplyenv(self):
+        env = np.arange(16.0).reshape(4,4)
+        terms = np.random.random((5,4,4))
+        full = analyticnrm2.multiplyenv(env, terms)
+        self.assertEqual(full.shape, (4,4,6))
+        for sl in range(5):
+            self.assertTrue(np.all(full[:,:,sl] == env*terms[sl]))
+        self.assertTrue(np.all(full[:,:,-1] == 1.0))
+
+    def test_binned_model(self):
+        self.jw.pixel = self.pixel
+        self.jw.bandpass = self.wave
+        whole = self.jw.make_model(fov=self.fov, bandpass=self.wave, over=self.over,
+                                   psf_offset=self.psf_offset).copy()
+        # about 4 detector rows per block, last block short
+        rowbytes = 2 * 21 * self.over * self.fov * self.over * 8
+        streamed = self.jw.make_model(fov=self.fov, bandpass=self.wave, over=self.over,
+                                      psf_offset=self.psf_offset, maxbytes=4.5*rowbytes)
+        self.assertTrue(self.jw.fringes is None)
+        self.assertTrue(np.abs(streamed - whole).max() < 1e-12*np.abs(whole).max())
+
+    def test_fourier_shift(self):
+        arr = np.random.random((9,8,3))
+        shifted = analyticnrm2.fourier_shift(arr, (2, -3))
+        self.assertTrue(np.abs(shifted - np.roll(arr, (2, -3), axis=(0,1))).max() < 1e-12)
+
+    def test_fourier_shifted_model(self):
+        self.jw.pixel = self.pixel
+        self.jw.bandpass = self.wave
+        exact = self.jw.make_model(fov=self.fov, bandpass=self.wave, over=self.over,
+                                   psf_offset=self.psf_offset).copy()
+        shifted = self.jw.make_model(fov=self.fov, bandpass=self.wave, over=self.over,
+                                     psf_offset=self.psf_offset, fouriershift=True)
+        self.assertEqual(shifted.shape, exact.shape)
+        self.assertTrue(np.abs(shifted - exact).max() < 2e-4*np.abs(exact).max())
+
+    def test_fourier_shift_cache_keys(self):
+        # zero-offset models built with different envelope tables are cached apart
+        self.jw.pixel = self.pixel
+        self.jw.bandpass = self.wave
+        self.jw.modelcache = ModelCache()
+        self.jw.make_model(fov=self.fov, bandpass=self.wave, over=self.over)
+        simbandpass = [(1.0, self.wave)]
+        for envtable in (None, envelope.get_table("hex", 1e-6), envelope.get_table("hex", 1e-4)):
+            self.jw.fourier_shifted_model(simbandpass, self.psf_offset, 2, envtable=envtable)
+        self.assertEqual(len(self.jw.modelcache._mem), 4) # the make_model one and 3 zero models
+
+    def test_fromfunction_threaded(self):
+        kw = dict(d=0.82, c=(31.4, 30.2), lam=self.wave, pixel=self.pixel/self.over,
+                  affine2d=self.affine2d, minus=False)
+        serial = np.fromfunction(hextransformEE.gfunction, (63, 63), **kw)
+        try:
+            utils.set_fromfunction_threads(4, 7) # last tile short
+            threaded = utils.fromfunction_threaded(hextransformEE.gfunction, (63, 63), **kw)
+            first = utils._fromfunction_pool[2]
+            utils.set_fromfunction_threads(3, 7)
+            self.assertTrue(np.array_equal(threaded, 
+                            utils.fromfunction_threaded(hextransformEE.gfunction, (63, 63), **kw)))
+            self.assertTrue(first._shutdown) # replaced executor's threads stopped
+            pb = analyticnrm2.primarybeam(self.jw.ctrs, self.wave, self.over, self.pixel,
+                                          self.fov, self.jw.d, psf_offset=self.psf_offset,
+                                          shape="circ", affine2d=self.affine2d)
+        finally:
+            utils.set_fromfunction_threads(1, 32)
+        self.assertTrue(np.array_equal(threaded, serial))
+        self.assertTrue(np.array_equal(pb, analyticnrm2.primarybeam(self.jw.ctrs, self.wave,
+                                   self.over, self.pixel, self.fov, self.jw.d,
+                                   psf_offset=self.psf_offset, shape="circ",
+                                   affine2d=self.affine2d)))
+
+    def test_offset_derivatives(self):
+        self.jw.pixel = self.pixel
+        self.jw.bandpass = self.wave
+        derivs = self.jw.make_derivatives(self.fov, self.wave, over=self.over,
+                                          psf_offset=self.psf_offset).copy()
+        h = 1e-4
+        for axis in (0, 1):
+            step = np.zeros(2)
+            step[axis] = h
+            plus = self.jw.make_model(fov=self.fov, bandpass=self.wave, over=self.over,
+                                      psf_offset=tuple(np.add(self.psf_offset, step))).copy()
+            minus = self.jw.make_model(fov=self.fov, bandpass=self.wave, over=self.over,
+                                       psf_offset=tuple(np.subtract(self.psf_offset, step)))
+            fd = (plus - minus) / (2*h)
+            self.assertTrue(np.abs(derivs[axis] - fd).max() < 1e-6*np.abs(fd).max())
+
+    def test_channel_models(self):
+        self.jw.pixel = self.pixel
+        bandpasses = [4.0e-6, [(0.4, 4.2e-6), (0.6, 4.4e-6)]]
+        models = self.jw.make_channel_models(self.fov, bandpasses, over=self.over,
+                                             psf_offset=self.psf_offset)
+        for chan, bandpass in enumerate(bandpasses):
+            self.jw.bandpass = bandpass
+            model = self.jw.make_model(fov=self.fov, bandpass=bandpass, over=self.over,
+                                       psf_offset=self.psf_offset)
+            self.assertTrue(np.abs(models[chan] - model).max() < 1e-12*np.abs(model).max())
+
+    def test_pixweight(self):
+        pixw = np.array([[0.8, 0.9, 0.8], [0.9, 1.0, 0.9], [0.8, 0.9, 0.8]])
+        arr = np.random.random((12, 9, 4))
+        loop = np.zeros((4, 3, 4))
+        for i in range(3):
+            for j in range(3):
+                loop += pixw[i,j] * arr[i::3, j::3]
+        self.assertTrue(np.allclose(subpix.weightpixels(arr, pixw), loop, rtol=1e-14))
+        self.jw.pixel = self.pixel
+        self.jw.bandpass = self.wave
+        plain = self.jw.make_model(fov=self.fov, bandpass=self.wave, over=self.over,
+                                   psf_offset=self.psf_offset).copy()
+        self.jw.pixweight = np.ones((3, 3))
+        flat = self.jw.make_model(fov=self.fov, bandpass=self.wave, over=self.over,
+                                  psf_offset=self.psf_offset).copy()
+        self.assertTrue(np.abs(flat - plain).max() < 1e-12*np.abs(plain).max())
+        self.jw.pixweight = pixw
+        whole = self.jw.make_model(fov=self.fov, bandpass=self.wave, over=self.over,
+                                   psf_offset=self.psf_offset).copy()
+        self.assertTrue(np.allclose(whole[:,:,-1], pixw.sum()))
+        streamed = self.jw.make_model(fov=self.fov, bandpass=self.wave, over=self.over,
+                                      psf_offset=self.psf_offset, maxbytes=1e5)
+        self.assertTrue(np.abs(streamed - whole).max() < 1e-12*np.abs(whole).max())
+        self.jw.pixweight = np.ones((2, 2))
+        self.assertRaises(ValueError, self.jw.make_model, fov=self.fov, bandpass=self.wave,
+                          over=self.over)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from astropy import units as u
+
+from nrm_analysis.misctools.utils import Affine2d
+from nrm_analysis.fringefitting.LG_Model import NRM_Model
+from nrm_analysis.fringefitting.modelcache import ModelCache, model_key
+
+"""
+    Test the content-addressed fringe model cache used by make_model
+
+    run with pytest -s _moi_.py to see stdout on screen
+    All units SI unless units in variable name
+"""
+
+arcsec2rad = u.arcsec.to(u.rad)
+
+
+class ModelCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.pixel = 0.0656 * arcsec2rad
+        self.fov = 15
+        self.over = 3
+        self.bandpass = np.array([(0.5, 4.2e-6), (0.5, 4.4e-6)])
+        self.affine2d = Affine2d(rotradccw=np.pi*5.0/180.0, name="5")
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def make(self, cache, psf_offset=(0.1, -0.2)):
+        jw = NRM_Model(mask='jwst', holeshape="hex", pixscale=self.pixel,
+                       over=self.over, affine2d=self.affine2d, modelcache=cache)
+        jw.bandpass = self.bandpass
+        return jw.make_model(fov=self.fov, bandpass=self.bandpass, over=self.over,
+                             psf_offset=psf_offset, pixscale=self.pixel)
+
+    def test_cached_model_matches(self):
+        exact = self.make(None)
+        cache = ModelCache(cachedir=self.cachedir)
+        first = self.make(cache)
+        self.assertEqual(cache.misses, 1)
+        self.assertTrue(np.all(first == exact))
+        # new cache on the same directory: disk hit, memory mapped
+        cache2 = ModelCache(cachedir=self.cachedir)
+        cache2._mem.clear() # the memory tier is shared within a process
+        second = self.make(cache2)
+        self.assertEqual(cache2.hits, 1)
+        self.assertTrue(np.all(second == exact))
+        self.assertFalse(second.flags.writeable)
+        # a different psf offset is a different model
+        self.make(cache2, psf_offset=(0.0, 0.0))
+        self.assertEqual(cache2.misses, 1)
+
+    def test_disk_eviction(self):
+        cache = ModelCache(cachedir=self.cachedir, memsize=0, disksize=3000)
+        for n in range(4):
+            cache.put("k{0}".format(n), np.zeros(200)) # 1600 bytes + header each
+        files = [f for f in os.listdir(self.cachedir) if f.endswith(".npy")]
+        self.assertEqual(files, ["k3.npy"])
+        self.assertTrue(model_key(np.zeros((7,2)), 0.8, "hex", 1e-6, self.affine2d,
+                                  self.bandpass, 15, 3, (0,0)) !=
+                        model_key(np.zeros((7,2)), 0.8, "circ", 1e-6, self.affine2d,
+                                  self.bandpass, 15, 3, (0,0)))
+
+    def test_memory_eviction(self):
+        cache = ModelCache(memsize=5000)
+        cache._mem.clear()
+        for n in range(4):
+            cache.put("m{0}".format(n), np.zeros(200)) # 1600 bytes each
+        cache.put("m3", np.zeros(100)) # replaced, not counted twice
+        self.assertEqual(list(cache._mem), ["m1", "m2", "m3"])
+        self.assertEqual(cache._mem.nbytes, 4000)
+        cache._mem.clear()
+        self.assertEqual(cache._mem.nbytes, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from astropy.io import fits
+
+from nrm_analysis.fringefitting import noise
+
+"""
+    Test the per-pixel noise models used for weighted fringe fitting
+
+    run with pytest -s _moi_.py to see stdout on screen
+"""
+
+
+class NoiseModelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        np.random.seed(5)
+        self.sci = np.random.normal(100.0, 30.0, (3, 8, 8))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_photon_noise(self):
+        var = noise.PhotonNoise(gain=2.0, readnoise=3.0).variance(self.sci)
+        self.assertEqual(var.shape, self.sci.shape)
+        self.assertTrue(np.allclose(var, np.maximum(self.sci, 0.0)/2.0 + 9.0))
+        w = noise.weights(var)
+        self.assertTrue(np.allclose(w, 1.0/np.sqrt(var)))
+
+    def test_variance_map(self):
+        var = noise.VarianceMap(np.full((8, 8), 4.0)).variance(self.sci)
+        self.assertEqual(var.shape, self.sci.shape)
+        self.assertTrue(np.all(noise.weights(var) == 0.5))
+
+    def test_jwst_err_dq(self):
+        err = np.full(self.sci.shape, 2.0)
+        dq = np.zeros(self.sci.shape, dtype=np.uint32)
+        dq[1, 2, 3] = 1   # DO_NOT_USE
+        dq[2, 4, 4] = 4   # JUMP_DET
+        fn = os.path.join(self.tmpdir, "jw_calints.fits")
+        fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(self.sci, name="SCI"),
+                      fits.ImageHDU(err, name="ERR"),
+                      fits.ImageHDU(dq, name="DQ")]).writeto(fn)
+        w = noise.weights(noise.JWSTErrDQ().variance(self.sci, fn))
+        self.assertEqual((w == 0).sum(), 2)
+        self.assertTrue(w[1, 2, 3] == 0 and w[2, 4, 4] == 0 and w[0, 0, 0] == 0.5)
+        w = noise.weights(noise.JWSTErrDQ(dqmask=1).variance(self.sci, fn))
+        self.assertEqual((w == 0).sum(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
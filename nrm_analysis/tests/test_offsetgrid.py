@@ -0,0 +1,105 @@
+import unittest
+import tempfile
+import shutil
+import numpy as np
+from astropy import units as u
+
+from nrm_analysis.fringefitting.LG_Model import NRM_Model
+from nrm_analysis.fringefitting.modelcache import ModelCache, _memtiers
+from nrm_analysis.fringefitting import offsetgrid
+from nrm_analysis.fringefitting.offsetgrid import OffsetModelGrid, get_grid
+
+"""
+    Test sub-pixel offset model interpolation against exact make_model output
+
+    run with pytest -s _moi_.py to see stdout on screen
+    All units SI unless units in variable name
+"""
+
+arcsec2rad = u.arcsec.to(u.rad)
+
+
+class OffsetGridTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pixel = 0.0656 * arcsec2rad
+        self.fov = 11
+        self.over = 3
+        self.wave = 4.3e-6 # m
+        self.jw = NRM_Model(mask='jwst', holeshape="hex", pixscale=self.pixel, over=self.over)
+        self.jw.bandpass = self.wave
+
+    def test_interpolated_model(self):
+        tol = 2.0e-3
+        grid = OffsetModelGrid(self.fov, self.wave, over=self.over,
+                               pixscale=self.pixel, step=1.0/4, tol=tol)
+        error = grid.verify(self.jw)
+        self.assertTrue(error <= tol)
+        self.assertTrue(grid.step < 1.0/4) # 1/4 pixel lattice is too coarse at 2e-3
+        for offset in [(0.0, 0.0), (0.137, -0.291), (-0.45, 0.08), (0.47, 0.49)]:
+            exact = grid.exact(self.jw, offset)
+            interp = grid.model(self.jw, offset)
+            self.assertTrue(np.abs(interp - exact).max() <= tol*np.abs(exact).max(),
+                            'interpolated model at {0} out of tolerance'.format(offset))
+
+    def test_memsize(self):
+        nodebytes = self.fov * self.fov * 44 * 8
+        grid = OffsetModelGrid(self.fov, self.wave, over=self.over, pixscale=self.pixel,
+                               step=1.0/4, tol=1.0, memsize=6*nodebytes)
+        for offset in [(0.1, 0.1), (0.6, -0.3), (-0.7, 0.9), (0.1, 0.2)]:
+            model = grid.model(self.jw, offset)
+            self.assertTrue(len(grid.nodes) <= 6 and grid.nbytes <= 6*nodebytes)
+        self.assertTrue(np.allclose(model, OffsetModelGrid(self.fov, self.wave, 
+                        over=self.over, pixscale=self.pixel, step=1.0/4, tol=1.0).model(self.jw, (0.1, 0.2))))
+
+    def test_options(self):
+        band = np.array([[0.5, 4.2e-6], [0.5, 4.4e-6]])
+        self.jw.bandpass = band # make_model reads the monochromatic case from the object
+        plain = get_grid(self.jw, self.fov, band, over=self.over, pixscale=self.pixel)
+        smeared = get_grid(self.jw, self.fov, band, over=self.over, pixscale=self.pixel, smeared=True)
+        self.assertFalse(plain is smeared)
+        self.assertTrue(np.array_equal(smeared.exact(self.jw, (0.1, 0.2)),
+                        self.jw.make_model(fov=self.fov, bandpass=band, over=self.over,
+                                           psf_offset=(0.1, 0.2), pixscale=self.pixel, smeared=True)))
+
+    def test_model_settings(self):
+        grid = get_grid(self.jw, self.fov, self.wave, over=self.over, pixscale=self.pixel)
+        self.assertFalse(hasattr(grid, "nrm")) # grids must not keep an NRM_Model alive
+        for settings in [dict(precision=np.float32), dict(tabulated_envelope=True),
+                         dict(pixweight=np.ones((self.over, self.over)))]:
+            other = NRM_Model(mask='jwst', holeshape="hex", pixscale=self.pixel, 
+                              over=self.over, **settings)
+            self.assertFalse(get_grid(other, self.fov, self.wave, over=self.over, 
+                                      pixscale=self.pixel) is grid, str(settings))
+        single = NRM_Model(mask='jwst', holeshape="hex", pixscale=self.pixel, 
+                           over=self.over, precision=np.float32)
+        single.bandpass = self.wave
+        model = get_grid(single, self.fov, self.wave, over=self.over, step=1.0/4, tol=1.0,
+                         pixscale=self.pixel).model(single, (0.1, 0.2))
+        self.assertEqual(model.dtype, np.float32)
+
+    def test_shared_build(self):
+        # a second process with the same cache directory reuses the verified step and nodes
+        cachedir = tempfile.mkdtemp()
+        try:
+            self.jw.modelcache = ModelCache(cachedir=cachedir)
+            first = get_grid(self.jw, self.fov, self.wave, over=self.over, pixscale=self.pixel,
+                             step=1.0/4, tol=2.0e-3)
+            model = first.model(self.jw, (0.137, -0.291))
+            offsetgrid._grids.clear()
+            _memtiers.clear()
+            self.jw.modelcache = ModelCache(cachedir=cachedir)
+            second = get_grid(self.jw, self.fov, self.wave, over=self.over, pixscale=self.pixel,
+                              step=1.0/4, tol=2.0e-3)
+            self.assertFalse(second is first)
+            self.assertTrue(np.allclose(second.model(self.jw, (0.137, -0.291)), model))
+            self.assertEqual(second.step, first.step)
+            self.assertEqual(self.jw.modelcache.misses, 0)
+        finally:
+            self.jw.modelcache = None
+            _memtiers.pop(cachedir, None)
+            shutil.rmtree(cachedir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,188 @@
+import os
+import pickle
+import shutil
+import tempfile
+from types import SimpleNamespace
+import unittest
+import numpy as np
+from astropy import units as u
+from astropy.io import fits
+
+from nrm_analysis import nrm_core
+from nrm_analysis.fringefitting import fitrecords, offsetgrid
+from nrm_analysis.fringefitting.utility_classes import FringeFitterResult
+from nrm_analysis.fringefitting.LG_Model import NRM_Model
+from nrm_analysis.misctools.utils import Affine2d
+
+"""
+    Test the shared-memory science cubes handed to FringeFitter's worker pool,
+    and the cross-file scheduler feeding it
+
+    run with pytest -s _moi_.py to see stdout on screen
+"""
+
+
+class CubeFiles(object):
+    # minimal instrument data: read_data() serves in-memory cubes by name
+    def __init__(self, cubes, pixel):
+        self.cubes = cubes
+        self.mask = 'jwst'
+        self.pscale_rad = pixel
+        self.holeshape = 'hex'
+        self.affine2d = Affine2d(mx=1.0, my=1.0, sx=0.0, sy=0.0, xo=0.0, yo=0.0, name="Ideal")
+        self.wls = [4.3e-6] * 8
+        self.arrname = "jwst_g7s6c"
+        self.threshold = 0.02
+        self.header = None
+
+    def read_data(self, fn):
+        self.sub_dir_str = "/" + fn
+        self.nwav = len(self.cubes[fn])
+        return self.cubes[fn], self.header
+
+
+class SharedCubeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_share_attach(self):
+        cube = np.random.random((3, 7, 6)).astype(np.float32)
+        shm, record = nrm_core.share_array(cube)
+        try:
+            view = nrm_core.attach_array(record)
+            self.assertTrue(np.array_equal(view, cube))
+            self.assertEqual(view.dtype, np.float32)
+            self.assertFalse(view.flags.writeable)
+            self.assertTrue(nrm_core.attach_array(record) is view) # attached once
+            del view
+            nrm_core.detach_arrays([])
+            self.assertEqual(nrm_core._worker["attached"], {})
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def test_share_file(self):
+        # tasks carry records of shared arrays only: the header is shared once per file
+        cubes = {"a": np.random.random((4, 9, 9))}
+        ff = nrm_core.FringeFitter(CubeFiles(cubes, 1e-7), savedir=self.tmpdir, interactive=False)
+        nrm_core.load_file(ff, "a")
+        ff.scihdr = fits.Header([("TARGNAME", "star"), ("EXPTIME", 10.0)])
+        blocks, tasks = nrm_core.share_file(ff)
+        try:
+            self.assertEqual(len(tasks), 4)
+            self.assertTrue(all(len(pickle.dumps(task)) < 512 for task in tasks))
+            header = fits.Header.fromstring(nrm_core.attach_array(tasks[3]["scihdr"]).tobytes().decode())
+            self.assertEqual(header["TARGNAME"], "star")
+            nrm_core.detach_arrays([])
+        finally:
+            nrm_core.release(blocks)
+
+    def test_scheduled(self):
+        np.random.seed(3)
+        pixel = 0.0656 * u.arcsec.to(u.rad)
+        jw = NRM_Model(mask='jwst', holeshape="hex", pixscale=pixel, over=1)
+        psf = 1.0e5 * jw.simulate(fov=25, bandpass=4.3e-6, over=1, psf_offset=(0.1, -0.2))
+        cubes = dict((fn, psf + np.random.normal(0.0, 10.0, (n,) + psf.shape))
+                     for fn, n in (("a", 3), ("b", 1), ("c", 2)))
+        finished = {}
+        results = {}
+        for threads in (0, 2):
+            outdir = "{0}/out{1}".format(self.tmpdir, threads)
+            ff = nrm_core.FringeFitter(CubeFiles(cubes, pixel), oversample=1, savedir=outdir,
+                                       interactive=False, save_txt_only=True)
+            ff.fit_fringes(["a", "b", "c"], threads=threads,
+                           file_done=lambda fn, d, recs: finished.setdefault(threads, []).append(fn))
+            results[threads] = ff.results
+        # fit_fringes_parallel with threads goes through the same scheduler
+        records = nrm_core.fit_fringes_parallel({"object":ff, "file":"c", "id":0}, 2)
+        ff.close_pool()
+        self.assertTrue(np.array_equal(records["cps"], results[0]["c"]["cps"]))
+        self.assertEqual(sorted(finished[2]), ["a", "b", "c"])
+        for fn in cubes:
+            self.assertTrue(np.array_equal(results[2][fn]["slc"], np.arange(len(cubes[fn]))))
+            self.assertTrue(np.array_equal(results[2][fn]["cps"], results[0][fn]["cps"]))
+        for fn in cubes:
+            stored = [fitrecords.read_store("{0}/out{1}/{2}".format(self.tmpdir, threads, fn))[0]
+                      for threads in (0, 2)]
+            self.assertTrue(np.array_equal(stored[0]["cps"], stored[1]["cps"]))
+            self.assertTrue(np.array_equal(stored[1]["phases"], results[2][fn]["phases"]))
+
+    def test_offset_grid_pool(self):
+        # workers build and verify the offset grid once, through the pool's disk cache
+        np.random.seed(5)
+        pixel = 0.0656 * u.arcsec.to(u.rad)
+        jw = NRM_Model(mask='jwst', holeshape="hex", pixscale=pixel, over=1)
+        psf = 1.0e5 * jw.simulate(fov=25, bandpass=4.3e-6, over=1, psf_offset=(0.1, -0.2))
+        cubes = dict((fn, psf + np.random.normal(0.0, 10.0, (3,) + psf.shape)) for fn in ("a", "b"))
+        results = {}
+        for threads in (0, 2):
+            ff = nrm_core.FringeFitter(CubeFiles(cubes, pixel), oversample=1, interactive=False,
+                                       savedir="{0}/out{1}".format(self.tmpdir, threads),
+                                       save_txt_only=True, model_offset_step=1.0/4, 
+                                       model_offset_tol=0.1)
+            ff.fit_fringes(["a", "b"], threads=threads)
+            ff.close_pool()
+            results[threads] = ff.results
+            offsetgrid._grids.clear() # or forked workers inherit the serial run's grid
+        cachedir = "{0}/out2/offsetgrid_models".format(self.tmpdir)
+        self.assertEqual(ff.modelcache.cachedir, cachedir)
+        self.assertEqual(len([fn for fn in os.listdir(cachedir) if fn.endswith("-step.npy")]), 1)
+        for fn in cubes:
+            self.assertTrue(np.allclose(results[2][fn]["cps"], results[0][fn]["cps"]))
+
+    def test_default_outputs(self):
+        # a default run leaves everything Calibrate and FringeFitterResult read
+        np.random.seed(4)
+        pixel = 0.0656 * u.arcsec.to(u.rad)
+        jw = NRM_Model(mask='jwst', holeshape="hex", pixscale=pixel, over=1)
+        psf = 1.0e5 * jw.simulate(fov=25, bandpass=4.3e-6, over=1)
+        cubes = dict((fn, psf + np.random.normal(0.0, 10.0, (3,) + psf.shape)) for fn in ("t", "c"))
+        ff = nrm_core.FringeFitter(CubeFiles(cubes, pixel), oversample=1, savedir=self.tmpdir, interactive=False)
+        ff.fit_fringes(["t", "c"])
+        result = FringeFitterResult(self.tmpdir + "/t")
+        self.assertEqual(result.NINT, 3)
+        self.assertTrue(np.array_equal(result.integration[2].closure_quantities["closure_phase"],
+                                       ff.results["t"]["cps"][2]))
+        maskdata = SimpleNamespace(mask=SimpleNamespace(ctrs=jw.ctrs), nwav=1)
+        calib = nrm_core.Calibrate([self.tmpdir + "/t", self.tmpdir + "/c"], maskdata,
+                                   savedir=self.tmpdir + "/calib", interactive=False)
+        self.assertTrue(np.allclose(calib.cp_mean_tar[0], ff.results["t"]["cps"].mean(axis=0)))
+        self.assertTrue(np.allclose(calib.cp_calibrated[0], ff.results["t"]["cps"].mean(axis=0) - 
+                                                            ff.results["c"]["cps"].mean(axis=0)))
+
+    def test_joint_options(self):
+        data = CubeFiles({}, 1e-7)
+        for option in ({"model_smeared":True}, {"model_maxbytes":1e6}, {"modelcache":True},
+                       {"model_fouriershift":True}, {"fit_offset":1}):
+            self.assertRaises(ValueError, nrm_core.FringeFitter, data, savedir=self.tmpdir,
+                              interactive=False, joint_channels=True, **option)
+
+    def test_diagnostics(self):
+        pixel = 0.0656 * u.arcsec.to(u.rad)
+        jw = NRM_Model(mask='jwst', holeshape="hex", pixscale=pixel, over=1)
+        psf = 1.0e5 * jw.simulate(fov=25, bandpass=4.3e-6, over=1)
+        cubes = {"a": np.array([psf] * 3), "b": np.array([psf] * 2)}
+        data = CubeFiles(cubes, pixel)
+        data.header = fits.Header([("TARGNAME", "star")])
+        ff = nrm_core.FringeFitter(data, oversample=1, savedir=self.tmpdir,
+                                   interactive=False, diagnostics="residual")
+        ff.fit_fringes(["a"], threads=2)
+        written = sorted(os.listdir(self.tmpdir + "/a"))
+        self.assertEqual(written, [fitrecords.STORE_NAME] + 
+                                  ["residual_{0:02d}.fits".format(slc) for slc in range(3)])
+        self.assertEqual(fits.getdata(self.tmpdir + "/a/residual_01.fits").shape, (25, 25))
+        # workers rebuild each file's header from shared memory
+        ff.close_pool()
+        ff.diagnostics = "all"
+        ff.fit_fringes(["a", "b"], threads=2)
+        ff.close_pool()
+        self.assertEqual(fits.getheader(self.tmpdir + "/b/centered_1.fits")["TARGNAME"], "star")
+        self.assertEqual(fits.getheader(self.tmpdir + "/a/centered_2.fits")["TARGNAME"], "star")
+
+
+if __name__ == "__main__":
+    unittest.main()
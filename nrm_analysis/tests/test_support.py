@@ -0,0 +1,62 @@
+import unittest
+import numpy as np
+from astropy import units as u
+
+from nrm_analysis.fringefitting.LG_Model import NRM_Model
+from nrm_analysis.fringefitting import leastsqnrm, support
+
+"""
+    Test signal-support masks: fitting only the pixels near the PSF core with a
+    model made for the centered square around them
+
+    run with pytest -s _moi_.py to see stdout on screen
+    All units SI unless units in variable name
+"""
+
+arcsec2rad = u.arcsec.to(u.rad)
+
+
+class SupportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(11)
+        self.pixel = 0.0656 * arcsec2rad
+        self.fov = 35
+        self.over = 3
+        self.wave = 4.3e-6 # m
+        self.psf_offset = (0.2, -0.1) # detpix
+        self.jw = NRM_Model(mask='jwst', holeshape="hex", pixscale=self.pixel, over=self.over)
+        self.jw.bandpass = self.wave
+        img = self.jw.simulate(fov=self.fov, bandpass=self.wave, over=self.over,
+                               psf_offset=self.psf_offset)
+        self.img = 1.0e5 * img / img.max() + np.random.normal(0.0, 10.0, img.shape)
+
+    def test_support_mask(self):
+        mask = support.support_mask(self.jw, self.fov, self.wave, self.psf_offset, radius=0.5)
+        rpix = 0.5 * self.wave / self.jw.d / self.pixel
+        self.assertTrue(abs(mask.sum() - np.pi*rpix**2) < 4*rpix)
+        self.assertTrue(mask[17, 17] and not mask[0, 0])
+        self.assertEqual(support.support_fov(mask) % 2, 1)
+        env = support.support_mask(self.jw, self.fov, self.wave, self.psf_offset, threshold=1e-2)
+        snr = support.support_mask(self.jw, self.fov, self.wave, self.psf_offset, snr=5.0,
+                                   image=self.img)
+        self.assertTrue(0 < snr.sum() < self.fov**2 and 0 < env.sum() < self.fov**2)
+        self.assertEqual(support.support_fov(np.ones((10, 10), dtype=bool)), 10)
+
+    def test_support_fit(self):
+        full = self.jw.make_model(fov=self.fov, bandpass=self.wave, over=self.over,
+                                  psf_offset=self.psf_offset).copy()
+        mask = support.support_mask(self.jw, self.fov, self.wave, self.psf_offset, radius=0.8)
+        modelfov = support.support_fov(mask)
+        self.assertTrue(modelfov < self.fov)
+        small = support.embed(self.jw.make_model(fov=modelfov, bandpass=self.wave,
+                                                 over=self.over, psf_offset=self.psf_offset),
+                              self.fov)
+        self.assertTrue(np.abs(small[mask] - full[mask]).max() < 1e-12*np.abs(full).max())
+        x = leastsqnrm.matrix_operations(np.where(mask, self.img, np.nan), small)[0]
+        xfull = leastsqnrm.matrix_operations(self.img, full)[0]
+        self.assertTrue(np.abs(x/x[0] - xfull/xfull[0]).max() < 1e-3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from astropy.io import fits
+
+from nrm_analysis.fringefitting.writer import FitsWriter
+
+"""
+    Test the background FITS writer used for fringe fitting diagnostics
+
+    run with pytest -s _moi_.py to see stdout on screen
+"""
+
+
+class WriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_writer(self):
+        out = FitsWriter(maxsize=2, batch=2)
+        data = np.arange(12.0).reshape(3, 4)
+        for ii in range(5): # more than maxsize: put() waits for the writer
+            out.put(os.path.join(self.tmpdir, "im_{0}.fits".format(ii)), data + ii,
+                    header=fits.Header([("SLICE", ii)]))
+        data[...] = 0.0 # queued arrays are copies
+        out.flush()
+        self.assertEqual(len(os.listdir(self.tmpdir)), 5)
+        self.assertTrue(np.array_equal(fits.getdata(os.path.join(self.tmpdir, "im_4.fits")),
+                                       np.arange(12.0).reshape(3, 4) + 4))
+        self.assertEqual(fits.getheader(os.path.join(self.tmpdir, "im_4.fits"))["SLICE"], 4)
+        out.put(os.path.join(self.tmpdir, "missing", "im.fits"), data)
+        self.assertRaises(IOError, out.close)
+        self.assertTrue(out.thread is None)
+
+
+if __name__ == "__main__":
+    unittest.main()